@@ -0,0 +1,3 @@
+# 各实验脚本共用的仿真模块
+# 先于 neuron 的其他 import: 无 GUI 启动, 见 core/env.py
+from core import env
@@ -0,0 +1,255 @@
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from functools import partial
+
+from neuron import h
+
+from core.env import ROOT, setup
+from core.rig import point_process_counts
+
+# 各实验的基准: 每个在新的 spawn 进程里跑, 工作目录是临时目录 (图和 .sim_cache 都写在那里, 缓存是冷的)
+#  - setup: import 脚本 + 建模型 + import matplotlib, 不计时间; 之后调一次实验函数, 计 wall time
+#  - 仿真数: 每次 finitialize 算一次 run, run 里有几棵树 (CellArray 的一批细胞) 就算几个仿真
+#  - 仿真时长: 每个 run 从第一步到最后一步的模型时间 (warm start 从快照的时间算起), 按树数加权
+#  - peak RSS 是 worker 进程的 ru_maxrss; hoc 对象是实验函数返回之后还活着的 section / Vector / 点过程 / NetCon,
+#    每次跑都在涨就是有泄漏
+# 结果写成 JSON; --baseline 和之前存的结果比, 超过阈值的算回归, 退出码 1
+# 在仓库根目录下运行: python -m core.bench --output bench.json --baseline bench_baseline.json
+
+# 比基线差多少 (相对) 算回归; sims_per_s / sim_ms_per_s 是越大越好, 其余越小越好
+THRESHOLDS = {'wall_s': 0.25, 'sims_per_s': 0.2, 'sim_ms_per_s': 0.2, 'peak_rss_mb': 0.2, 'hoc_objects': 0.0}
+HIGHER_IS_BETTER = ('sims_per_s', 'sim_ms_per_s')
+
+
+class SimCounter:
+    # 用一个 Vector 记录 t: finitialize 和 frecord_init (warm start 的 restore 之后) 都会让它从头记,
+    # FInitializeHandler 3 在 finitialize 最开始调用, 这时里面是上一个 run 从开始到结束的时间
+    # (脚本在 h.run() 之前会自己设 h.t = 0, 所以不能直接读 h.t)
+
+    def __init__(self):
+        self.runs = 0
+        self.sims = 0
+        self.sim_ms = 0.0
+        self._trees = 0
+        self._t = None
+        self._handler = h.FInitializeHandler(3, self._init)
+
+    def _count_trees(self):
+        roots = h.SectionList()
+        roots.allroots()
+        return max(1, len(list(roots)))
+
+    def _end(self):
+        if self._trees and self._t.size() > 1:
+            self.sim_ms += (self._t[self._t.size() - 1] - self._t[0]) * self._trees
+
+    def _init(self):
+        # 记录 t 要有 section, 第一次 finitialize 时才建 (phase2 的细胞是实验函数里建的)
+        if self._t is None:
+            self._t = h.Vector().record(h._ref_t)
+        self._end()
+        self.runs += 1
+        self._trees = self._count_trees()
+        self.sims += self._trees
+
+    def close(self):
+        if self._t is not None:
+            self._end()
+            self._t.play_remove()
+        self._trees = 0
+        self._t = self._handler = None
+        return {'runs': self.runs, 'sims': self.sims, 'sim_ms': self.sim_ms}
+
+
+def hoc_objects():
+    counts = point_process_counts()
+    counts['Section'] = len(list(h.allsec()))
+    counts['Vector'] = int(h.List('Vector').count())
+    return counts
+
+
+def _rss_mb():
+    # linux 上 ru_maxrss 的单位是 KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _script(name):
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    return __import__(name)
+
+
+def _phase1():
+    from core.model import PHASE1_SPEC, build_model
+    build_model(PHASE1_SPEC)
+    return _script('phase1_test').main
+
+
+def _phase2():
+    # phase2_tuning.py 的 __main__ 里默认走的批量版本, 网格也一样
+    phase2 = _script('phase2_tuning')
+    return partial(phase2.run_all_trials_batched, [0.052, 0.054, 0.055, 0.056, 0.058],
+                   [0.0012, 0.0014, 0.0016, 0.0018])
+
+
+def _phase3(func):
+    def prepare():
+        phase3 = _script('phase3_final')
+        soma, dend = phase3.build_model()
+        # 脚本里这些是第一个实验 (speed tuning) 设的, 后面的实验沿用
+        h.tstop, h.celsius, h.v_init = 100, 30, -70
+        return partial(getattr(phase3, func), soma, dend)
+    return prepare
+
+
+def _search():
+    search = _script('search')
+    soma, dend = search.build_model()
+    return partial(search.run_grid_search_plasticity, soma, dend)
+
+
+def _learn():
+    # 不查 RPE 表, 70 个 trial 每个都仿真一次
+    import random
+    learn = _script('learn')
+    soma, dend = learn.build_model()
+    random.seed(0)
+    return partial(learn.run_loop, 'rpe', soma, dend)
+
+
+BENCHMARKS = {
+    'phase1': _phase1,
+    'phase2_tuning': _phase2,
+    'speed_tuning': _phase3('run_speed_tuning'),
+    'direction': _phase3('run_direction_test'),
+    'ttx': _phase3('run_mechanism_proof'),
+    'jitter': _phase3('run_jitter_test'),
+    'attention': _phase3('run_attention_test'),
+    'secondary_conditioning': _phase3('run_secondary_conditioning'),
+    'morphological_rpe': _phase3('run_morphological_rpe_experiment'),
+    'search_grid': _search,
+    'learn_agent': _learn,
+}
+
+
+def run_benchmark(name):
+    # 在 worker 进程里调用; 脚本画的图写进临时目录, 跑完删掉
+    from core.plotting import plt
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix=f'bench_{name}_') as tmp:
+        os.chdir(tmp)
+        try:
+            start = time.perf_counter()
+            setup()
+            func = BENCHMARKS[name]()
+            plt._load()
+            setup_s = time.perf_counter() - start
+            rss_setup = _rss_mb()
+            counter = SimCounter()
+            with open(os.devnull, 'w') as devnull:
+                stdout, sys.stdout = sys.stdout, devnull
+                try:
+                    start = time.perf_counter()
+                    func()
+                    wall = time.perf_counter() - start
+                finally:
+                    sys.stdout = stdout
+            counts = counter.close()
+            plt.close('all')
+        finally:
+            os.chdir(cwd)
+    objects = hoc_objects()
+    return dict(counts, wall_s=wall, setup_s=setup_s,
+                sims_per_s=counts['sims'] / wall, sim_ms_per_s=counts['sim_ms'] / wall,
+                peak_rss_mb=_rss_mb(), setup_rss_mb=rss_setup,
+                hoc_objects=sum(objects.values()), hoc_counts=objects)
+
+
+def run_suite(names=None, repeat=1):
+    # 每个基准每次一个新进程; repeat > 1 时取 wall 最小的一次
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    for name in names or BENCHMARKS:
+        runs = []
+        for _ in range(repeat):
+            with ProcessPoolExecutor(1, mp_context=ctx) as ex:
+                runs.append(ex.submit(run_benchmark, name).result())
+        results[name] = min(runs, key=lambda r: r['wall_s'])
+    return results
+
+
+def compare(results, baseline, thresholds=THRESHOLDS):
+    # 返回 [(基准, 指标, 基线, 现在, 相对变化)], 只列超过阈值的; 基线里没有的基准不比
+    regressions = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        for metric, tol in thresholds.items():
+            old, new = base.get(metric), r.get(metric)
+            if old is None or new is None:
+                continue
+            if metric in HIGHER_IS_BETTER:
+                change = (old - new) / old if old else 0.0
+            else:
+                change = (new - old) / old if old else float(new > 0)
+            if change > tol:
+                regressions.append((name, metric, old, new, change))
+    return regressions
+
+
+def _print_table(results, baseline):
+    print(f"{'benchmark':<24}{'wall s':>9}{'runs':>7}{'sims':>7}{'sims/s':>9}{'sim ms/s':>10}"
+          f"{'RSS MB':>8}{'hoc obj':>9}{'vs base':>9}")
+    for name, r in results.items():
+        base = baseline.get(name)
+        ratio = f"{r['wall_s'] / base['wall_s']:.2f}x" if base else '-'
+        print(f"{name:<24}{r['wall_s']:>9.3f}{r['runs']:>7}{r['sims']:>7}{r['sims_per_s']:>9.1f}"
+              f"{r['sim_ms_per_s']:>10.0f}{r['peak_rss_mb']:>8.0f}{r['hoc_objects']:>9}{ratio:>9}")
+
+
+def _threshold(text):
+    metric, value = text.split('=')
+    if metric not in THRESHOLDS:
+        raise argparse.ArgumentTypeError(f"unknown metric {metric!r}, one of {', '.join(THRESHOLDS)}")
+    return metric, float(value)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('names', nargs='*', help=f"默认全部: {' '.join(BENCHMARKS)}")
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--output', default='bench.json')
+    parser.add_argument('--baseline', default=None, help='之前的 --output, 不存在时把这次的结果存成基线')
+    parser.add_argument('--threshold', type=_threshold, action='append', default=[],
+                        help='例如 wall_s=0.1 (比基线慢 10%% 以上算回归)')
+    args = parser.parse_args()
+
+    unknown = [name for name in args.names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmark(s): {' '.join(unknown)}")
+    results = run_suite(args.names, args.repeat)
+    baseline = {}
+    if args.baseline is not None and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    meta = {'python': sys.version.split()[0], 'neuron': h.nrnversion(), 'cpus': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'repeat': args.repeat}
+    with open(args.output, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=1)
+    _print_table(results, baseline)
+    if args.baseline is not None and not baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=1)
+        print(f"no baseline yet, saved this run as {args.baseline}")
+    regressions = compare(results, baseline, dict(THRESHOLDS, **dict(args.threshold)))
+    for name, metric, old, new, change in regressions:
+        print(f"REGRESSION {name}: {metric} {old:.4g} -> {new:.4g} ({change:+.0%} worse)")
+    sys.exit(1 if regressions else 0)
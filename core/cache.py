@@ -0,0 +1,255 @@
+import glob
+import hashlib
+import json
+import os
+import numpy as np
+from neuron import h
+
+from core.env import ROOT, density_mechanisms
+from core.fingerprint import CACHE_DIR, fingerprint, mechanism_params, model_description, point_process_types
+from core.integrator import record, sample_dt, sample_times
+
+# 仿真结果缓存: key 是整个仿真设置的哈希
+#  - 模型: 所有 section 的几何、插入的机制和参数, 以及 .mod 文件内容
+#  - 刺激: 所有点过程的位置和参数, NetCon 的连接 / 权重 / 延迟
+#  - 积分设置: dt, tstop, celsius, v_init, CVODE
+#  - 机制的 GLOBAL PARAMETER: 离子初始浓度 (cai0_ca_ion), usetable_hh 这类对所有 section 都起作用的值
+# 任何一项变了 key 就变, 只有受影响的那些条目失效
+# 要记录的量不进 key: 同一个仿真在不同实验里记录不同的曲线时共用一个条目, 缺的曲线补算后合并进去
+# 每个条目一个 .npz (曲线 + 每条曲线的最大值), 总大小超过上限时删最久没用过的
+
+DEFAULT_MAX_BYTES = 512 * 1024 ** 2
+
+# 只观察不影响仿真的点过程, 不进 key
+OBSERVERS = ['APCount', 'Tracker']
+
+# key 的内容变了 (加了新的一项) 时加一, 旧条目不再命中
+CACHE_FORMAT = 2
+
+_global_names = {}
+
+
+def mod_file_hashes(root=ROOT):
+    hashes = {}
+    for path in sorted(glob.glob(os.path.join(root, '*.mod'))):
+        with open(path, 'rb') as f:
+            hashes[os.path.basename(path)] = hashlib.sha256(f.read()).hexdigest()
+    return hashes
+
+
+def _mechanism_globals(mech_name):
+    # MechanismStandard(name, -1) 列出 GLOBAL PARAMETER, 数组的话带长度
+    if mech_name not in _global_names:
+        ms = h.MechanismStandard(mech_name, -1)
+        name = h.ref('')
+        names = []
+        for i in range(int(ms.count())):
+            size = int(ms.name(name, i))
+            names.append((name[0], size))
+        _global_names[mech_name] = names
+    return _global_names[mech_name]
+
+
+def globals_description():
+    values = {}
+    for mech_name in density_mechanisms() + point_process_types():
+        if mech_name in OBSERVERS:
+            continue
+        for name, size in _mechanism_globals(mech_name):
+            if size == 1:
+                values[name] = getattr(h, name)
+            else:
+                values[name] = [getattr(h, name)[i] for i in range(size)]
+    return values
+
+
+def stimulus_description():
+    # 所有点过程按类型和创建顺序排好, NetCon 用下标指向它的源和目标
+    desc = []
+    index = {}
+    for name in point_process_types():
+        if name in OBSERVERS:
+            continue
+        params = mechanism_params(name)
+        for pp in h.List(name):
+            loc = None
+            if pp.has_loc():
+                seg = pp.get_segment()
+                loc = [seg.sec.name(), seg.x]
+            index[pp.hname()] = len(desc)
+            desc.append([name, loc, [getattr(pp, p) for p in params]])
+
+    netcons = []
+    for nc in h.List('NetCon'):
+        pre, syn = nc.pre(), nc.syn()
+        if pre is not None:
+            source = index[pre.hname()]
+        elif nc.preseg() is not None:
+            source = [nc.preseg().sec.name(), nc.preseg().x, nc.threshold]
+        else:
+            source = None
+        target = None if syn is None else index[syn.hname()]
+        netcons.append([source, target, [nc.weight[i] for i in range(int(nc.wcnt()))], nc.delay])
+    return {'point_processes': desc, 'netcons': netcons}
+
+
+def integrator_description():
+    cv = h.CVode()
+    return {
+        'dt': sample_dt(), 'tstop': h.tstop, 'celsius': h.celsius, 'v_init': h.v_init,
+        'secondorder': h.secondorder, 'steps_per_ms': h.steps_per_ms,
+        'cvode': cv.active(), 'local_dt': cv.use_local_dt(), 'atol': cv.atol(), 'rtol': cv.rtol(),
+    }
+
+
+def has_noise():
+    # NetStim 开了噪声的话每次结果都不一样, 不缓存
+    return any(ns.noise > 0 and ns.number > 0 for ns in h.List('NetStim'))
+
+
+def spike_count(v, thresh=0):
+    # 和 APCount 一样数上穿阈值的次数
+    above = np.asarray(v) > thresh
+    return int(np.count_nonzero(above[1:] & ~above[:-1]) + above[0])
+
+
+def _trace_name(target):
+    # records 里的一项 -> 条目里的曲线名, 例如 'dend(1.0).cai'
+    if target == 't':
+        return 't'
+    seg, var = target
+    return f'{seg.sec.name()}({seg.x}).{var}'
+
+
+class ResultCache:
+
+    def __init__(self, cache_dir=os.path.join(CACHE_DIR, 'results'), max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.stats = {'hit': 0, 'miss': 0, 'uncached': 0}
+        self._mod_hashes = None
+
+    def key(self):
+        if self._mod_hashes is None:
+            self._mod_hashes = mod_file_hashes()
+        return fingerprint({
+            'model': model_description(h.allsec()),
+            'mod_files': self._mod_hashes,
+            'stimulus': stimulus_description(),
+            'integrator': integrator_description(),
+            'globals': globals_description(),
+            'format': CACHE_FORMAT,
+        })
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.npz')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                traces = json.loads(str(data['names']))
+                entry = {
+                    'traces': {name: data[f'trace_{i}'] for i, name in enumerate(traces)},
+                    'scalars': json.loads(str(data['scalars'])),
+                }
+        except (OSError, ValueError, KeyError):
+            return None
+        # LRU: 用 mtime 记录最近一次使用
+        os.utime(path)
+        return entry
+
+    def put(self, key, entry):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        tmp = path[:-len('.npz')] + '.tmp.npz'
+        names = list(entry['traces'])
+        arrays = {f'trace_{i}': entry['traces'][name] for i, name in enumerate(names)}
+        np.savez(tmp, names=json.dumps(names), scalars=json.dumps(entry['scalars']), **arrays)
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path in glob.glob(os.path.join(self.cache_dir, '*.npz')):
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def run(self, records):
+        # 代替 h.run(): 调用前和 h.run() 一样设置好模型 / 刺激 / h.tstop 等
+        # records: {名字: 't' 或者 (seg, 变量名)}
+        # 返回 {'traces': {名字: array}, 'scalars': {'<名字>_max': float}}
+        # 命中缓存时不会仿真, 结果只能从返回值里读, 不要再读 Vector / APCount
+        if has_noise():
+            self.stats['uncached'] += 1
+            return self._select(self.simulate(records.values()), records)
+
+        key = self.key()
+        entry = self.get(key)
+        missing = [target for target in records.values()
+                   if entry is None or _trace_name(target) not in entry['traces']]
+        if entry is not None and not missing:
+            self.stats['hit'] += 1
+            return self._select(entry, records)
+
+        self.stats['miss'] += 1
+        new = self.simulate(missing)
+        if entry is not None:
+            # 同一个仿真, 之前记录的曲线照旧, 只把新的并进去
+            new['traces'] = dict(entry['traces'], **new['traces'])
+            new['scalars'] = dict(entry['scalars'], **new['scalars'])
+        self.put(key, new)
+        return self._select(new, records)
+
+    def simulate(self, targets):
+        vecs = {}
+        cvode = h.CVode().active()
+        for target in targets:
+            if target == 't':
+                # CVODE 下曲线按固定间隔采样, 时间轴跑完再补
+                vec = None if cvode else h.Vector().record(h._ref_t)
+            else:
+                seg, var = target
+                vec = record(getattr(seg, '_ref_' + var))
+            vecs[_trace_name(target)] = vec
+        h.run()
+        traces = {name: vec.as_numpy().copy() for name, vec in vecs.items() if vec is not None}
+        if 't' in vecs and vecs['t'] is None:
+            n = len(next(iter(traces.values()))) if traces else int(round(h.tstop / sample_dt()))
+            traces['t'] = sample_times(n)
+        scalars = {f'{name}_max': float(tr.max()) for name, tr in traces.items() if len(tr)}
+        return {'traces': traces, 'scalars': scalars}
+
+    def _select(self, entry, records):
+        names = {name: _trace_name(target) for name, target in records.items()}
+        return {
+            'traces': {name: entry['traces'][tn] for name, tn in names.items()},
+            'scalars': {f'{name}_max': entry['scalars'][f'{tn}_max'] for name, tn in names.items()
+                        if f'{tn}_max' in entry['scalars']},
+        }
+
+
+_default_cache = None
+
+
+def default_cache():
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = ResultCache()
+    return _default_cache
+
+
+def cached_run(records, cache=None):
+    return (cache or default_cache()).run(records)
@@ -0,0 +1,323 @@
+from functools import partial
+from neuron import h
+import numpy as np
+
+from core.integrator import FIXED_DT
+from core.model import AGENT_SPEC, CHANNEL_PARAMS, DEFAULT_SPEC, Cell
+from core.recording import Recorder, Tracker
+from core.rig import START_TIME, SynapseRig
+from core.sweep import run_sweep
+from core.trace_store import TraceStore
+from core.warmstart import warm_run
+
+# 把 build_model() 的 ball-and-stick 复制 N 份放进同一个 NEURON 实例,
+# 每个细胞有自己的参数和刺激, 一次 h.run() 同时推进所有细胞
+
+# 按细胞改的通道参数的默认值, 和 build_model() (core/model.py) 一致
+DEFAULT_PARAMS = {k: getattr(DEFAULT_SPEC, k) for k in CHANNEL_PARAMS}
+
+# learn.py / llama.py 的模型 (AGENT_SPEC)
+AGENT_PARAMS = {k: getattr(AGENT_SPEC, k) for k in CHANNEL_PARAMS}
+
+# 需要整条曲线时记录的位置: 名字 -> (section, x, 变量)
+TRACE_CHANNELS = {
+    'v_soma': ('soma', 0.5, 'v'),
+    'cai': ('dend', 1.0, 'cai'),
+    'v_prox': ('dend', 0.01, 'v'),
+}
+
+
+def _per_cell(value, n):
+    # 标量广播成 n 份, 序列原样检查长度
+    if np.ndim(value) == 0:
+        return [value] * n
+    value = list(value)
+    if len(value) != n:
+        raise ValueError(f"expected {n} values, got {len(value)}")
+    return value
+
+
+def _per_cell_weights(weights, n):
+    # 每个细胞 5 个突触权重: 标量 / 长度 n / (n, 5)
+    w = np.asarray(weights, dtype=float)
+    if w.ndim == 0:
+        return np.full((n, 5), float(w))
+    if w.ndim == 1:
+        if len(w) != n:
+            raise ValueError(f"expected {n} weights, got {len(w)}")
+        return np.repeat(w[:, None], 5, axis=1)
+    if w.shape != (n, 5):
+        raise ValueError(f"expected weights of shape ({n}, 5), got {w.shape}")
+    return w
+
+
+_cell_ids = iter(range(10**9))
+
+
+class BallStick:
+
+    def __init__(self, params):
+        # params: ModelSpec 的字段, 没给的用 DEFAULT_SPEC; section 名字带 cell 编号, 只改自己的 section
+        idx = next(_cell_ids)
+        self.cell = Cell(DEFAULT_SPEC.replace(**params), prefix=f'cell{idx}_')
+        self.soma, self.dend = self.cell.soma, self.cell.dend
+
+        self.ap_count = h.APCount(self.soma(0.5))
+        self.ap_count.thresh = 0
+        # 钙峰在仿真过程中算, 不记录曲线
+        self.ca_tracker = Tracker(self.dend(1.0), 'cai')
+
+        self.rig = SynapseRig(self.dend)
+        self.extras = []
+
+    @property
+    def params(self):
+        return {k: getattr(self.cell.spec, k) for k in CHANNEL_PARAMS}
+
+    def set_params(self, params):
+        # 只改变了的参数; 返回 nseg 是否变了
+        nseg = self.cell.spec.dend_nseg
+        self.cell.update(**params)
+        if self.cell.spec.dend_nseg == nseg:
+            return False
+        self.ca_tracker.attach()
+        for obj in self.extras:
+            if isinstance(obj, Tracker):
+                obj.attach()
+        return True
+
+    def set_delay_line(self, direction, dt_stim, weights):
+        self.rig.set(direction, dt_stim, weights)
+
+
+class CellArray:
+
+    def __init__(self, n, params=None, **overrides):
+        # params / overrides 里的每一项可以是标量或长度 n 的序列
+        self.n = n
+        base = dict(params or {})
+        base.update(overrides)
+        per_cell = {k: _per_cell(v, n) for k, v in base.items()}
+        self.cells = [BallStick({k: per_cell[k][i] for k in per_cell}) for i in range(n)]
+        self.rpe_offsets = None
+        self.rpe_trackers = None
+        self.recorders = None
+
+    def resize(self, n):
+        # 改细胞数: 多出来的细胞删掉 (section 跟着释放, 不会再被积分), 不够的按第一个细胞的模型补上
+        # 刺激 / 记录都清掉, 之后重新加
+        self.clear_extras()
+        self.recorders = None
+        if n < self.n:
+            del self.cells[n:]
+        else:
+            params = self.cells[0].cell.spec.diff(DEFAULT_SPEC)
+            self.cells.extend(BallStick(params) for _ in range(n - self.n))
+        self.n = n
+
+    def record_traces(self, channels=TRACE_CHANNELS, tstop=100, Dt=None):
+        # 每个细胞一个 Recorder, 缓冲区只分配一次; run() 之后 recorders[i].view(name) 就是第 i 个细胞的曲线
+        self.recorders = []
+        for cell in self.cells:
+            recorder = Recorder(tstop=tstop)
+            for name, (part, x, var) in channels.items():
+                recorder.add(name, getattr(getattr(cell, part)(x), '_ref_' + var), Dt=Dt)
+            self.recorders.append(recorder)
+        return self.recorders
+
+    def set_params(self, **params):
+        per_cell = {k: _per_cell(v, self.n) for k, v in params.items()}
+        resized = [cell.set_params({k: per_cell[k][i] for k in per_cell}) for i, cell in enumerate(self.cells)]
+        if any(resized):
+            # 记录的 segment 没了, 下次 record_traces 重新建
+            self.recorders = None
+
+    def set_delay_line(self, direction, dt_stim, weights):
+        # setup_synapses_weighted 的批量版本
+        directions = _per_cell(direction, self.n)
+        dts = _per_cell(dt_stim, self.n)
+        w = _per_cell_weights(weights, self.n)
+        for i, cell in enumerate(self.cells):
+            cell.set_delay_line(directions[i], dts[i], w[i])
+
+    def clear_extras(self):
+        for cell in self.cells:
+            cell.extras = []
+        self.rpe_offsets = None
+        self.rpe_trackers = None
+
+    def add_single_stim(self, pos, time, weight, tau2=20, delay=0):
+        # setup_single_stim 的批量版本
+        weights = _per_cell(weight, self.n)
+        times = _per_cell(time, self.n)
+        for i, cell in enumerate(self.cells):
+            syn = h.Exp2Syn(cell.dend(pos)); syn.tau1, syn.tau2 = 1, tau2
+            ns = h.NetStim(); ns.number, ns.start, ns.noise = 1, times[i], 0
+            nc = h.NetCon(ns, syn); nc.weight[0], nc.delay = weights[i], delay
+            cell.extras.extend([syn, ns, nc])
+
+    def add_soma_iclamp(self, delay, dur, amp):
+        amps = _per_cell(amp, self.n)
+        for i, cell in enumerate(self.cells):
+            stim = h.IClamp(cell.soma(0.5))
+            stim.delay = delay; stim.dur = dur; stim.amp = amps[i]
+            cell.extras.append(stim)
+
+    def add_inhibition(self, pos=0.1, g_max=0.0, seeds=None):
+        # setup_inhibition 的批量版本, 每个细胞各自独立的泊松输入
+        # seeds: 每个细胞的 Random123 流编号, 给了的话结果和细胞在哪一批 / 哪个进程无关
+        g = _per_cell(g_max, self.n)
+        for i, cell in enumerate(self.cells):
+            inh_syn = h.Exp2Syn(cell.dend(pos))
+            inh_syn.tau1 = 0.5; inh_syn.tau2 = 10; inh_syn.e = -80
+            stim = h.NetStim()
+            stim.number = 1000; stim.interval = 5; stim.start = 0; stim.noise = 1
+            if seeds is not None:
+                stim.noiseFromRandom123(int(seeds[i]), 0, 0)
+            nc = h.NetCon(stim, inh_syn)
+            nc.weight[0] = g[i]
+            cell.extras.extend([inh_syn, stim, nc])
+
+    def add_rpe_clamp(self, confidence, is_correct, dur=100):
+        # calculate_rpe_signal 的批量版本: 胞体钳位在 -70 + 25 * confidence
+        conf = np.asarray(_per_cell(confidence, self.n), dtype=float)
+        correct = _per_cell(is_correct, self.n)
+        soma_voltage = -70 + 25 * conf
+        for i, cell in enumerate(self.cells):
+            v_clamp = h.SEClamp(cell.soma(0.5))
+            v_clamp.dur1, v_clamp.amp1, v_clamp.rs = dur, soma_voltage[i], 1e-3
+            cell.extras.append(v_clamp)
+        self.add_single_stim(0.8, 40, [0.005 if c else 0.0 for c in correct])
+        self.rpe_offsets = soma_voltage
+        self.rpe_trackers = [Tracker(cell.dend(0.01), 'v') for cell in self.cells]
+        for cell, tracker in zip(self.cells, self.rpe_trackers):
+            cell.extras.append(tracker)
+
+    def run(self, tstop=100, celsius=30, v_init=-70, dt=0.025, rpe_window=(41, 50), t_start=None):
+        # t_start: 第一个事件的时间, 给了就从 SaveState 快照开始算 (见 core/warmstart.py)
+        # CVODE 打开时 (core/integrator.py) 不用快照, 从头算
+        # 钙峰和 RPE 峰值都由 Tracker 在仿真过程中算出来 (core/recording.py)
+        if self.rpe_trackers is not None:
+            for tracker in self.rpe_trackers:
+                tracker.set_window(rpe_window)
+
+        h.t = 0; h.v_init = v_init; h.celsius = celsius; h.dt = dt; h.tstop = tstop
+        if t_start is None or h.CVode().active():
+            h.run()
+        else:
+            warm_run(t_start, tstop, v_init)
+
+        results = {
+            'ca_peak': np.array([cell.ca_tracker.max for cell in self.cells]),
+            'spikes': np.array([cell.ap_count.n for cell in self.cells], dtype=int),
+        }
+        if self.rpe_trackers is not None:
+            v_peak = np.array([tracker.max for tracker in self.rpe_trackers])
+            results['rpe_peak'] = v_peak - self.rpe_offsets
+        return results
+
+
+def _batches(n_points, batch_size):
+    for start in range(0, n_points, batch_size):
+        yield start, min(start + batch_size, n_points)
+
+
+def _batch_size(n_points, batch_size, workers):
+    # 多进程时每个 worker 至少分到一批
+    return max(1, min(batch_size, n_points, -(-n_points // max(workers, 1))))
+
+
+def _pad(values, size, fill):
+    return list(values) + [fill] * (size - len(values))
+
+
+def _delay_line_batch(cells, batch, tstop=100, celsius=30, warm=True, store=None, Dt=None):
+    # 一批参数点, 点数不超过 cells.n; 多出来的细胞权重置零, 结果丢掉
+    # store: TraceStore 的路径, 给了就把每个点的曲线写进去 (每个进程自己写自己的块)
+    w, directions, dts, params, inhibition, seeds = batch
+    size, k = cells.n, len(w)
+    batch_w = np.zeros((size,) + w.shape[1:])
+    batch_w[:k] = w
+    cells.set_delay_line(_pad(directions, size, 'preferred'), _pad(dts, size, dts[0]), batch_w)
+    if params:
+        cells.set_params(**{key: _pad(v, size, v[0]) for key, v in params.items()})
+    if inhibition is not None:
+        cells.clear_extras()
+        cells.add_inhibition(g_max=_pad(inhibition, size, 0.0), seeds=_pad(seeds, size, 0))
+    if store is not None and cells.recorders is None:
+        cells.record_traces(tstop=tstop, Dt=Dt)
+    # 存曲线时从 0 开始算, 曲线的时间轴和 store 里写的一致
+    warm = warm and store is None
+    res = cells.run(tstop=tstop, celsius=celsius, t_start=START_TIME if warm else None)
+    if store is not None:
+        with TraceStore(store).writer(chunk_size=k) as writer:
+            for i in range(k):
+                row = {'point': seeds[i], 'w0': w[i].tolist(), 'direction': directions[i], 'dt_stim': dts[i],
+                       'inhibition': None if inhibition is None else inhibition[i]}
+                row.update({key: v[i] for key, v in params.items()})
+                writer.append(row, {'ca_peak': res['ca_peak'][i], 'spikes': res['spikes'][i]},
+                              {name: cells.recorders[i].view(name) for name in TRACE_CHANNELS})
+    return res['ca_peak'][:k], res['spikes'][:k]
+
+
+def create_delay_line_store(path, tstop=100, Dt=None, params=(), attrs=None, overwrite=False, dtype='float32'):
+    # simulate_delay_line(..., store=path) 用的 TraceStore: 每行一个参数点, TRACE_CHANNELS 的三条曲线
+    # params: simulate_delay_line 的 params 里会改的参数名
+    Dt = Dt or FIXED_DT
+    channels = {name: {'samples': int(round(tstop / Dt)) + 1, 'dt': Dt, 'dtype': dtype,
+                       'location': f'{part}({x}).{var}'}
+                for name, (part, x, var) in TRACE_CHANNELS.items()}
+    return TraceStore.create(path, channels, ['point', 'w0', 'direction', 'dt_stim', 'inhibition'] + list(params),
+                             ['ca_peak', 'spikes'], attrs=dict({'tstop': tstop}, **(attrs or {})),
+                             overwrite=overwrite)
+
+
+def simulate_delay_line(weights, directions, dt_stim=3, batch_size=100, params=None,
+                        tstop=100, celsius=30, warm=True, inhibition=None, workers=1, store=None, Dt=None):
+    # 每个参数点一个细胞, 每批一次 h.run(); 返回长度 N 的 ca_peak / spikes
+    # warm: 跳过第一个突触事件 (START_TIME) 之前的 20 ms
+    # inhibition: 每个点 dend(0.1) 上泊松抑制的 g_max, 随机流编号就是点的下标
+    # workers > 1 时各批分给进程池 (core/sweep.py), 结果不变
+    # store: create_delay_line_store 建好的目录, 每个点的曲线按 Dt 采样写进去 (这时不用 warm)
+    w = np.asarray(weights, dtype=float)
+    n_points = len(w)
+    directions = _per_cell(directions, n_points)
+    dts = _per_cell(dt_stim, n_points)
+    params = {k: _per_cell(v, n_points) for k, v in (params or {}).items()}
+    if inhibition is not None:
+        inhibition = _per_cell(inhibition, n_points)
+
+    size = _batch_size(n_points, batch_size, workers)
+    batches = [(w[start:stop], directions[start:stop], dts[start:stop],
+                {k: v[start:stop] for k, v in params.items()},
+                None if inhibition is None else inhibition[start:stop],
+                list(range(start, stop)))
+               for start, stop in _batches(n_points, size)]
+    task = partial(_delay_line_batch, tstop=tstop, celsius=celsius, warm=warm, store=store, Dt=Dt)
+    results = list(run_sweep(task, batches, build=partial(CellArray, size), workers=workers))
+    ca_peak = np.concatenate([r[0] for r in results])
+    spikes = np.concatenate([r[1] for r in results]).astype(int)
+    return ca_peak, spikes
+
+
+def _rpe_batch(cells, batch, celsius=6.3):
+    conf, correct = batch
+    size, k = cells.n, len(conf)
+    cells.clear_extras()
+    cells.add_rpe_clamp(_pad(conf, size, conf[0]), _pad(correct, size, False))
+    res = cells.run(tstop=100, celsius=celsius)
+    return res['rpe_peak'][:k]
+
+
+def simulate_rpe(confidences, is_correct, batch_size=100, params=None, celsius=6.3, workers=1):
+    # learn.py 没有设置 celsius, 沿用 NEURON 默认的 6.3
+    conf = np.asarray(confidences, dtype=float)
+    n_points = len(conf)
+    correct = _per_cell(is_correct, n_points)
+    params = dict(AGENT_PARAMS, **(params or {}))
+
+    size = _batch_size(n_points, batch_size, workers)
+    batches = [(list(conf[start:stop]), correct[start:stop]) for start, stop in _batches(n_points, size)]
+    results = run_sweep(partial(_rpe_batch, celsius=celsius), batches,
+                        build=partial(CellArray, size, params), workers=workers)
+    return np.concatenate(list(results))
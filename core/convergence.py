@@ -0,0 +1,94 @@
+import time
+import numpy as np
+
+from core.cell_array import simulate_delay_line, simulate_rpe
+from core.integrator import output_errors
+from core.model import AGENT_SPEC, DEFAULT_SPEC, d_lambda_nseg
+
+# 树突 nseg 的收敛检查: 以很细的离散 (ref_nseg) 为参照, 看不同 nseg 下
+#  - 方向测试里 dend(1.0) 的钙峰 (相对误差) 和胞体发放数
+#  - RPE 钳位实验里 dend(0.01) 的电压峰值 (mV)
+# 差多少, 以及每个点的耗时; smallest_accurate() 给出满足误差范围的最小 nseg
+# 在仓库根目录下运行: python -m core.convergence --d-lambdas 0.3 0.1 0.05 0.03 --nsegs 51
+
+D_LAMBDAS = (0.3, 0.1, 0.05, 0.03)
+
+
+def _direction(nseg, n):
+    w_range = np.linspace(0.0008, 0.0016, n)
+    ca_peak, spikes = simulate_delay_line(np.concatenate([w_range, w_range]), ['preferred'] * n + ['null'] * n,
+                                          batch_size=2 * n, params={'dend_nseg': nseg})
+    return {'ca_peak': ca_peak, 'spikes': spikes}
+
+
+def _rpe(nseg, n):
+    conf = np.linspace(0.4, 1.0, n)
+    return {'rpe_peak': simulate_rpe(np.concatenate([conf, conf]), [True] * n + [False] * n, batch_size=2 * n,
+                                     params={'dend_nseg': nseg})}
+
+
+def _timed(func, nseg, n):
+    start = time.perf_counter()
+    out = func(nseg, n)
+    return out, (time.perf_counter() - start) / (2 * n)
+
+
+def convergence(nsegs, ref_nseg=201, n=10, verbose=True):
+    # 返回 {nseg: {'errors': {...}, 'ms_per_point': ...}}, 参照本身也在里面 (误差为 0)
+    ref_dir, ref_dir_t = _timed(_direction, ref_nseg, n)
+    ref_rpe, ref_rpe_t = _timed(_rpe, ref_nseg, n)
+    report = {}
+    for nseg in sorted(set(nsegs) | {ref_nseg}):
+        if nseg == ref_nseg:
+            out_dir, out_rpe, t_dir, t_rpe = ref_dir, ref_rpe, ref_dir_t, ref_rpe_t
+        else:
+            out_dir, t_dir = _timed(_direction, nseg, n)
+            out_rpe, t_rpe = _timed(_rpe, nseg, n)
+        errors = dict(output_errors(out_dir, ref_dir), **output_errors(out_rpe, ref_rpe))
+        report[nseg] = {'errors': errors, 'ms_per_point': {'direction': t_dir * 1e3, 'rpe': t_rpe * 1e3}}
+
+    if verbose:
+        print(f"reference nseg={ref_nseg}; {n} weights x 2 directions, {n} confidences x correct/wrong")
+        print(f"{'nseg':>6}{'ca_peak rel':>13}{'spikes':>8}{'rpe_peak mV':>13}{'ms/pt dir':>11}{'ms/pt rpe':>11}")
+        for nseg, r in report.items():
+            e, t = r['errors'], r['ms_per_point']
+            print(f"{nseg:>6}{e['ca_peak']:>13.3g}{e['spikes']:>8}{e['rpe_peak']:>13.3g}"
+                  f"{t['direction']:>11.2f}{t['rpe']:>11.2f}")
+    return report
+
+
+def smallest_accurate(report, bounds):
+    # bounds: {'ca_peak': 相对误差, 'spikes': 个数, 'rpe_peak': mV}; 都不满足时 None
+    for nseg in sorted(report):
+        errors = report[nseg]['errors']
+        if all(errors[k] <= v for k, v in bounds.items()):
+            return nseg
+    return None
+
+
+if __name__ == '__main__':
+    import argparse
+    from core.env import setup
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--d-lambdas', type=float, nargs='+', default=list(D_LAMBDAS))
+    parser.add_argument('--freq', type=float, default=100)
+    parser.add_argument('--nsegs', type=int, nargs='*', default=[DEFAULT_SPEC.dend_nseg],
+                        help='另外要比较的 nseg, 默认是原来的 51')
+    parser.add_argument('--ref-nseg', type=int, default=201)
+    parser.add_argument('--n', type=int, default=10)
+    parser.add_argument('--ca-rtol', type=float, default=0.01)
+    parser.add_argument('--spike-tol', type=int, default=0)
+    parser.add_argument('--rpe-atol', type=float, default=0.05)
+    args = parser.parse_args()
+
+    setup()
+    # 方向测试和 RPE 实验的树突几何一样 (AGENT_SPEC 只改了通道密度), d_lambda 给出的 nseg 相同
+    by_rule = {d: DEFAULT_SPEC.with_d_lambda(d, args.freq).dend_nseg for d in args.d_lambdas}
+    assert all(AGENT_SPEC.with_d_lambda(d, args.freq).dend_nseg == nseg for d, nseg in by_rule.items())
+    for d, nseg in by_rule.items():
+        print(f"d_lambda={d:g} at {args.freq:g} Hz -> nseg={nseg}")
+    report = convergence(list(by_rule.values()) + args.nsegs, ref_nseg=args.ref_nseg, n=args.n)
+    bounds = {'ca_peak': args.ca_rtol, 'spikes': args.spike_tol, 'rpe_peak': args.rpe_atol}
+    best = smallest_accurate(report, bounds)
+    print("smallest nseg within " + ", ".join(f"{k} <= {v:g}" for k, v in bounds.items()) + f": {best}")
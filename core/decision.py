@@ -0,0 +1,125 @@
+import weakref
+
+from neuron import h
+
+from core.warmstart import warm_run
+
+# 判决模式: 很多 trial 只关心 dend(1.0) 的 cai 最大值有没有超过阈值, 不需要跑满 tstop
+#  - cai 上穿阈值: 结果是 True, 马上 stoprun
+#    (阈值事件用 StateTransitionEvent; 挂一个 NetCon 在 _ref_cai 上也行,
+#     但多出来的 NetCon 会让 SaveState 快照每个 trial 都对不上, warm_run 就白做了)
+#  - 所有突触事件都送达之后, cai 在阈值以下并且连续 n_decay 个检查间隔都在下降:
+#    结果是 False, 也 stoprun
+# 模型的胞体一直在发放, bAP 会让 cai 小幅起伏, 所以下降要跨过几个检查间隔才算数
+
+
+def last_event_time(netstims=None, netcons=None):
+    # 不传参数时扫描整个模型: 所有 NetStim 驱动的 NetCon 加上 IClamp 的结束时间
+    if netstims is not None:
+        return max(ns.start + (ns.number - 1) * ns.interval + nc.delay
+                   for ns, nc in zip(netstims, netcons))
+    times = [0.0]
+    for nc in h.List('NetCon'):
+        ns = nc.pre()
+        if ns is not None and ns.hname().startswith('NetStim') and ns.number > 0 and nc.weight[0] != 0:
+            times.append(ns.start + (ns.number - 1) * ns.interval + nc.delay)
+    for stim in h.List('IClamp'):
+        if stim.amp != 0:
+            times.append(stim.delay + stim.dur)
+    return max(times)
+
+
+class DecisionRun:
+
+    def __init__(self, seg, threshold, check_interval=2.5, n_decay=2):
+        self.seg = seg
+        self.check_interval = check_interval
+        self.n_decay = n_decay
+        self._threshold = h.ref(threshold)
+        self.ste = h.StateTransitionEvent(2)
+        self.ste.transition(0, 1, seg._ref_cai, self._threshold, self._crossed)
+        self.fih = h.FInitializeHandler(self._schedule)
+        self.t_last_event = None
+        self.t_arm = 0
+        self.decision = None
+        self.t_decision = None
+        self.n_runs = 0
+        self.total_time = 0.0
+
+    @property
+    def threshold(self):
+        return self._threshold[0]
+
+    @threshold.setter
+    def threshold(self, value):
+        self._threshold[0] = value
+
+    def _decide(self, outcome):
+        if self.decision is None:
+            self.decision = outcome
+            self.t_decision = h.t
+            h.stoprun = 1
+
+    def _crossed(self):
+        # 只在 self.run() 里生效; warm_run 第一次会预跑到 t_start 前一步存快照,
+        # 这段时间里也不能 stoprun
+        if self.t_last_event is None or h.t < self.t_arm:
+            return
+        self._decide(True)
+
+    def _schedule(self):
+        # finitialize 会清空事件队列, 每次初始化都要重新排检查
+        self.ste.state(0)
+        self.decision = None
+        self.t_decision = None
+        self.last_ca = None
+        self.n_falling = 0
+        if self.t_last_event is not None:
+            self._check_at(self.t_last_event)
+
+    def _check_at(self, t):
+        # 事件队列里只放弱引用: warm_run 的快照是在排好检查之后存的, SaveState 会一直拿着队列里的回调
+        ref = weakref.ref(self)
+        h.CVode().event(t, lambda: ref() is not None and ref()._check())
+
+    def _check(self):
+        if self.decision is not None:
+            return
+        ca = self.seg.cai
+        if self.last_ca is not None and ca < self.last_ca and ca < self.threshold:
+            self.n_falling += 1
+        else:
+            self.n_falling = 0
+        self.last_ca = ca
+        if self.n_falling >= self.n_decay:
+            self._decide(False)
+        else:
+            self._check_at(h.t + self.check_interval)
+
+    def run(self, t_last_event, tstop=100, v_init=-70, t_start=None):
+        # 返回 (是否超过阈值, 判决时间); t_start 给了就用 warm_run
+        self.t_last_event = t_last_event
+        h.tstop = tstop; h.v_init = v_init
+        if t_start is None:
+            h.run()
+        else:
+            self.t_arm = t_start - h.dt / 2
+            warm_run(t_start, tstop, v_init)
+            self.t_arm = 0
+        self.t_last_event = None
+        if self.decision is None:
+            # 跑满 tstop 都没上穿阈值
+            self.decision = False
+            self.t_decision = h.t
+        self.n_runs += 1
+        self.total_time += self.t_decision
+        return self.decision, self.t_decision
+
+    def close(self):
+        # FInitializeHandler / StateTransitionEvent 在 hoc 里拿着 bound method, Python 的 GC 拆不开这个环,
+        # 不 close 的话这个对象和它看的 segment 一直活着, 之后每次 finitialize 还会调 _schedule
+        self.fih = self.ste = None
+        self.seg = None
+
+    def mean_time(self):
+        return self.total_time / max(self.n_runs, 1)
@@ -0,0 +1,57 @@
+import os
+import sys
+
+# 无 GUI 启动 NEURON, 在 import neuron 之前设置:
+#  - 默认 -nogui, 要图形界面时自己设 NEURON_MODULE_OPTIONS 再 from neuron import gui
+#  - neuron/__init__ 装了 IPython 就会 import 它 (只为 notebook 里的 html 显示), 命令行下多 300 ms, 这里先挡掉
+# core/__init__.py 先 import 这个模块, 所以脚本里 core 的 import 要放在 neuron 前面
+os.environ.setdefault('NEURON_MODULE_OPTIONS', '-nogui')
+if 'neuron' not in sys.modules and 'IPython' not in sys.modules:
+    sys.modules['IPython'] = None
+    try:
+        import neuron
+    finally:
+        del sys.modules['IPython']
+import neuron
+from neuron import h
+
+from core.fingerprint import point_process_types
+
+# 仓库根目录, nrnivmodl 编译出来的机制在 ROOT/x86_64 下
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MECHANISMS = ['ca_hva', 'cad']
+# tracker.mod (core/recording.py); x86_64 是加了它之前编译的话 ca_hva / cad 在, 它不在
+POINT_PROCESSES = ['Tracker']
+
+
+def density_mechanisms():
+    mt = h.MechanismType(0)
+    name = h.ref('')
+    names = []
+    for i in range(int(mt.count())):
+        mt.select(i)
+        mt.selected(name)
+        names.append(name[0])
+    return names
+
+
+_ready = False
+
+
+def setup():
+    # 在仓库根目录下运行时 import neuron 已经自动加载了 x86_64, 再加载一次会报错;
+    # 子进程 / 别的目录下运行时这里补上
+    # 脚本在 import 时不做这些, 第一次建模型 (build_model) 时才调用, 之后再调用直接返回
+    global _ready
+    if _ready:
+        return
+    loaded = density_mechanisms()
+    if not all(name in loaded for name in MECHANISMS):
+        neuron.load_mechanisms(ROOT)
+    missing = [name for name in MECHANISMS if name not in density_mechanisms()]
+    missing += [name for name in POINT_PROCESSES if name not in point_process_types()]
+    if missing:
+        raise RuntimeError(f"NEURON mechanisms {', '.join(missing)} not loaded; "
+                           f"re-run nrnivmodl in {ROOT}")
+    h.load_file('stdrun.hoc')
+    _ready = True
@@ -0,0 +1,66 @@
+import hashlib
+import json
+from neuron import h
+
+# 缓存文件默认放在运行目录下
+CACHE_DIR = '.sim_cache'
+
+_param_names = {}
+
+
+def mechanism_params(mech_name):
+    # 只取 PARAMETER, 状态量和 ASSIGNED 会随仿真变化, 不能进指纹
+    if mech_name not in _param_names:
+        ms = h.MechanismStandard(mech_name, 1)
+        name = h.ref('')
+        names = []
+        for i in range(int(ms.count())):
+            ms.name(name, i)
+            names.append(name[0])
+        _param_names[mech_name] = names
+    return _param_names[mech_name]
+
+
+def point_process_types():
+    # 已加载的所有点过程类型 (IClamp, Exp2Syn, NetStim, APCount ...)
+    mt = h.MechanismType(1)
+    name = h.ref('')
+    names = []
+    for i in range(int(mt.count())):
+        mt.select(i)
+        mt.selected(name)
+        names.append(name[0])
+    return names
+
+
+def model_description(sections):
+    sections = list(sections)
+    index = {sec: i for i, sec in enumerate(sections)}
+    desc = []
+    for sec in sections:
+        parent = sec.parentseg()
+        entry = {
+            'L': sec.L,
+            'nseg': sec.nseg,
+            'Ra': sec.Ra,
+            'parent': None if parent is None else [index.get(parent.sec, parent.sec.name()), parent.x],
+            'segments': [],
+        }
+        for seg in sec:
+            params = {'x': seg.x, 'diam': seg.diam, 'cm': seg.cm}
+            for mech in seg:
+                for name in mechanism_params(mech.name()):
+                    params[name] = getattr(seg, name)
+            entry['segments'].append(params)
+        desc.append(entry)
+    return desc
+
+
+def fingerprint(obj):
+    text = json.dumps(obj, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+def model_fingerprint(sections, **extra):
+    # extra 放刺激协议 / 积分设置等同样决定结果的东西
+    return fingerprint({'model': model_description(sections), 'extra': extra})
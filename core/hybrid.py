@@ -0,0 +1,325 @@
+import copy
+import json
+import os
+import time
+from functools import partial
+
+import numpy as np
+
+from core.cell_array import AGENT_PARAMS, CellArray
+from core.env import ROOT
+from core.rpe_server import _serve_batch
+from core.sweep import default_workers, pool_task, worker_pool
+
+# LLM + 神经元的混合循环: 语言模型提出规则, 神经元的 RPE 给它打分
+#  - 很多个 episode 同时跑, 每个 episode 有自己藏起来的规则; 每个 trial 所有 episode 的 prompt 一起批量生成
+#  - prompt = 共用的任务说明 (前缀) + 每个 episode 定长的状态行; 前缀的 KV cache 只算一次, 之后每批复制一份
+#    (按批大小重复) 接着算; 状态行格式是定长的 (字节 tokenizer 下 token 数也定长), 一批里不用 padding
+#  - episode 分成 groups 组轮流: 一组生成完就把 RPE 交给进程池 (CellArray 一批一次 h.run(), 同 core/rpe_server.py),
+#    生成下一组的同时上一组的 RPE 在别的进程里算
+#  - 模型: model/config.json 等比例缩小的 Qwen3, 随机初始化, CPU 上就能跑 (仓库里没有权重和词表), 用来测吞吐;
+#    生成的文字里认不出规则名时按生成的 token 选一个规则
+#  - confidence 和 RPE_Agent 一样: 换规则时 0.4, RPE > 0 加 0.1, 否则加 0.05 (最多 1.0)
+# torch / transformers 只在建模型和生成时才 import, 进程池的 worker (spawn 会重新 import 这个模块) 用不到
+# 在仓库根目录下运行: python -m core.hybrid --episodes 64 --trials 20 [--no-prefix-cache]
+
+MODEL_CONFIG = os.path.join(ROOT, 'model', 'config.json')
+GENERATION_CONFIG = os.path.join(ROOT, 'model', 'generation_config.json')
+
+# 规则的顺序和 learn.py 的 BaseAgent.possible_rules 一样
+RULES = ('add_one', 'multiply_by_two', 'square_the_number')
+RULE_CODES = ('add1', 'mul2', 'sqr ')
+
+# 缩小的模型: 层数 / 宽度改小, 其余 (rope / norm / 激活 / GQA 比例) 沿用 model/config.json
+TINY = {'hidden_size': 64, 'intermediate_size': 192, 'num_hidden_layers': 2, 'num_attention_heads': 4,
+        'num_key_value_heads': 2, 'head_dim': 16, 'max_window_layers': 2, 'max_position_embeddings': 4096,
+        'torch_dtype': 'float32'}
+
+TASK_PROMPT = """You are the policy of an agent playing a rule-guessing game.
+Each trial the environment shows an integer x between 2 and 10 and the agent must predict f(x).
+The hidden rule f is one of:
+  add1: f(x) = x + 1
+  mul2: f(x) = x * 2
+  sqr : f(x) = x * x
+After each trial a neuron reports a reward prediction error (RPE) in mV.
+A large positive RPE means the prediction was right; an RPE below -1.0 means a confident prediction was wrong
+and the rule should be changed. Answer with the code of the rule to use next.
+Example: x=04 last=add1 rpe=-01.08 -> next: mul2
+Example: x=07 last=mul2 rpe=+00.54 -> next: mul2
+"""
+
+
+class ByteTokenizer:
+    # 一个字节一个 token, 另外 bos / eos; 仓库里只有 merges.txt, 没有 Qwen 的词表
+
+    bos_token_id = 256
+    eos_token_id = 257
+    vocab_size = 258
+
+    def encode(self, text):
+        return list(text.encode('utf-8'))
+
+    def decode(self, ids):
+        return bytes(i for i in ids if i < 256).decode('utf-8', errors='replace')
+
+
+def tiny_config(path=MODEL_CONFIG, vocab_size=ByteTokenizer.vocab_size, **overrides):
+    with open(path) as f:
+        config = json.load(f)
+    config.update(TINY)
+    config.update(vocab_size=vocab_size, bos_token_id=ByteTokenizer.bos_token_id,
+                  eos_token_id=ByteTokenizer.eos_token_id)
+    config.update(overrides)
+    return config
+
+
+def build_tiny_model(seed=0, threads=None, **overrides):
+    import torch
+    from transformers import Qwen3Config, Qwen3ForCausalLM
+    if threads:
+        torch.set_num_threads(threads)
+    torch.manual_seed(seed)
+    config = Qwen3Config(**tiny_config(**overrides))
+    return Qwen3ForCausalLM(config).eval()
+
+
+def generation_defaults(path=GENERATION_CONFIG):
+    with open(path) as f:
+        config = json.load(f)
+    return {'temperature': config.get('temperature', 1.0), 'top_k': config.get('top_k', 0)}
+
+
+class PrefixCachedGenerator:
+    # prompts 都是 prefix + 一行定长的后缀; prefix_cache=False 时每批都从头算整个 prompt (对照)
+
+    def __init__(self, model, tokenizer, prefix, max_new_tokens=8, temperature=0.6, top_k=20,
+                 prefix_cache=True, seed=0):
+        import torch
+        self.torch = torch
+        self.model = model
+        self.tokenizer = tokenizer
+        self.prefix_ids = [tokenizer.bos_token_id] + tokenizer.encode(prefix)
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_k = top_k
+        self.prefix_cache = prefix_cache
+        self.generator = torch.Generator().manual_seed(seed)
+        # 前缀的 KV cache, 只算一次 (批大小 1); 用的时候复制一份再按批大小重复
+        self._prefix = None
+        self.stats = {'prefill_tokens': 0, 'generated_tokens': 0, 'prefill_s': 0.0, 'decode_s': 0.0, 'batches': 0}
+
+    def _prefix_cache(self, batch):
+        if self._prefix is None:
+            torch = self.torch
+            ids = torch.tensor([self.prefix_ids])
+            with torch.no_grad():
+                out = self.model(input_ids=ids, use_cache=True)
+            self.stats['prefill_tokens'] += ids.numel()
+            self._prefix = out.past_key_values
+        cache = copy.deepcopy(self._prefix)
+        cache.batch_repeat_interleave(batch)
+        return cache
+
+    def _sample(self, logits):
+        torch = self.torch
+        if self.temperature <= 0:
+            return logits.argmax(-1)
+        logits = logits / self.temperature
+        if self.top_k:
+            values, index = torch.topk(logits, self.top_k, dim=-1)
+            choice = torch.multinomial(torch.softmax(values, dim=-1), 1, generator=self.generator)
+            return index.gather(-1, choice).squeeze(-1)
+        return torch.multinomial(torch.softmax(logits, dim=-1), 1, generator=self.generator).squeeze(-1)
+
+    def prefill(self, suffixes):
+        # 算 prompt (前缀 + 后缀), 返回模型输出 (logits 只有后缀的位置, 和 KV cache) 和 attention mask
+        torch = self.torch
+        rows = [self.tokenizer.encode(s) for s in suffixes]
+        if len(set(map(len, rows))) != 1:
+            raise ValueError("suffixes must have the same token length")
+        batch = len(rows)
+        with torch.no_grad():
+            if self.prefix_cache:
+                cache = self._prefix_cache(batch)
+                ids = torch.tensor(rows)
+                past = len(self.prefix_ids)
+            else:
+                cache = None
+                ids = torch.tensor([self.prefix_ids + r for r in rows])
+                past = 0
+            mask = torch.ones(batch, past + ids.shape[1], dtype=torch.long)
+            out = self.model(input_ids=ids, past_key_values=cache, attention_mask=mask, use_cache=True,
+                             logits_to_keep=len(rows[0]))
+        self.stats['prefill_tokens'] += ids.numel()
+        return out, mask
+
+    def generate(self, suffixes):
+        # 返回每个 prompt 生成的 token id 列表
+        torch = self.torch
+        batch = len(suffixes)
+        start = time.perf_counter()
+        out, mask = self.prefill(suffixes)
+        prefill = time.perf_counter()
+        tokens = []
+        with torch.no_grad():
+            for step in range(self.max_new_tokens):
+                next_ids = self._sample(out.logits[:, -1])
+                tokens.append(next_ids)
+                if step + 1 == self.max_new_tokens:
+                    break
+                mask = torch.cat([mask, torch.ones(batch, 1, dtype=torch.long)], dim=1)
+                out = self.model(input_ids=next_ids[:, None], past_key_values=out.past_key_values,
+                                 attention_mask=mask, use_cache=True)
+        end = time.perf_counter()
+        self.stats['prefill_s'] += prefill - start
+        self.stats['decode_s'] += end - prefill
+        self.stats['generated_tokens'] += batch * self.max_new_tokens
+        self.stats['batches'] += 1
+        return torch.stack(tokens, dim=1).tolist()
+
+
+def check_prefix_cache(model, tokenizer, suffixes, prefix=TASK_PROMPT, max_new_tokens=8):
+    # 同样的后缀: 复用前缀 KV cache 和每次从头算整个 prompt, 后缀位置的 logits 应该只差浮点误差,
+    # 贪心生成的 token 应该完全一样; 带 cache 的算两遍, 确认复制出来的 cache 没有改到存着的前缀
+    cached = PrefixCachedGenerator(model, tokenizer, prefix, max_new_tokens, temperature=0)
+    full = PrefixCachedGenerator(model, tokenizer, prefix, max_new_tokens, temperature=0, prefix_cache=False)
+    ref = full.prefill(suffixes)[0].logits
+    diff = max(float((cached.prefill(suffixes)[0].logits - ref).abs().max()) for _ in range(2))
+    same_tokens = cached.generate(suffixes) == full.generate(suffixes)
+    return {'max_logit_diff': diff, 'logit_scale': float(ref.abs().max()), 'same_greedy_tokens': same_tokens}
+
+
+def parse_rule(text, ids):
+    # 认得出规则名就用它, 否则 (随机初始化的模型基本都是这样) 按生成的 token 选
+    text = text.lower()
+    for i, keys in enumerate((('add',), ('mul', 'two'), ('sq',))):
+        if any(k in text for k in keys):
+            return i
+    return sum(ids) % len(RULES)
+
+
+def state_line(x, rule, rpe):
+    # 定长: 字节 tokenizer 下每行 token 数一样
+    rpe = min(max(rpe, -99.99), 99.99)
+    return f"x={x:02d} last={RULE_CODES[rule]} rpe={rpe:+06.2f} -> next:"
+
+
+def apply_rules(rules, x):
+    return np.choose(rules, [x + 1, x * 2, x * x])
+
+
+def run_hybrid(episodes=64, trials=20, groups=2, workers=None, prefix_cache=True, max_new_tokens=8,
+               seed=0, model=None, threads=None, verbose=True):
+    tokenizer = ByteTokenizer()
+    model = model if model is not None else build_tiny_model(seed, threads)
+    gen = PrefixCachedGenerator(model, tokenizer, TASK_PROMPT, max_new_tokens, prefix_cache=prefix_cache,
+                                seed=seed, **generation_defaults())
+    rng = np.random.default_rng(seed)
+    hidden = rng.integers(0, len(RULES), episodes)
+    rule = np.zeros(episodes, dtype=np.int64)
+    confidence = np.full(episodes, 0.8)
+    last_x = rng.integers(2, 11, episodes)
+    last_rpe = np.zeros(episodes)
+    correct = np.zeros((trials, episodes), dtype=bool)
+    rpe = np.zeros((trials, episodes))
+    slices = [s for s in np.array_split(np.arange(episodes), groups) if len(s)]
+    max_batch = max(len(s) for s in slices)
+    task = pool_task(partial(_serve_batch, max_batch=max_batch))
+
+    workers = workers or default_workers()
+    pool = worker_pool(partial(CellArray, 1, AGENT_PARAMS), workers)
+    # 先把 worker 启动好, 不算进循环的时间
+    list(pool.map(task, [([0.4], [False])] * workers))
+    pending = [None] * len(slices)
+    wait_s = 0.0
+
+    def collect(g):
+        nonlocal wait_s
+        t, idx, future = pending[g]
+        start = time.perf_counter()
+        values = np.array(future.result())
+        wait_s += time.perf_counter() - start
+        rpe[t, idx] = last_rpe[idx] = values
+        confidence[idx] = np.minimum(1.0, confidence[idx] + np.where(values > 0, 0.1, 0.05))
+        pending[g] = None
+
+    start = time.perf_counter()
+    try:
+        for t in range(trials):
+            for g, idx in enumerate(slices):
+                if pending[g] is not None:
+                    collect(g)
+                ids = gen.generate([state_line(last_x[i], rule[i], last_rpe[i]) for i in idx])
+                proposal = np.array([parse_rule(tokenizer.decode(r), r) for r in ids])
+                switched = proposal != rule[idx]
+                rule[idx] = proposal
+                confidence[idx] = np.where(switched, 0.4, confidence[idx])
+                x = rng.integers(2, 11, len(idx))
+                ok = apply_rules(rule[idx], x) == apply_rules(hidden[idx], x)
+                correct[t, idx] = ok
+                last_x[idx] = x
+                pending[g] = (t, idx, pool.submit(task, (confidence[idx].tolist(), ok.tolist())))
+        for g in range(len(slices)):
+            if pending[g] is not None:
+                collect(g)
+    finally:
+        pool.shutdown()
+    wall = time.perf_counter() - start
+
+    s = gen.stats
+    llm_s = s['prefill_s'] + s['decode_s']
+    result = {'episodes': episodes, 'trials': trials, 'wall_s': wall, 'llm_s': llm_s, 'rpe_wait_s': wait_s,
+              'trials_per_s': episodes * trials / wall,
+              'generated_tokens_per_s': s['generated_tokens'] / s['decode_s'] if s['decode_s'] else 0.0,
+              'prefill_tokens_per_s': s['prefill_tokens'] / s['prefill_s'] if s['prefill_s'] else 0.0,
+              'tokens_per_s': s['generated_tokens'] / wall,
+              'accuracy': correct.mean(axis=1), 'rpe_mean': rpe.mean(axis=1), 'generator': dict(s)}
+    if verbose:
+        print(f"{episodes} episodes x {trials} trials in {len(slices)} group(s), prefix cache {prefix_cache}: "
+              f"wall {wall:.2f} s, LLM {llm_s:.2f} s, waiting for RPE {wait_s:.2f} s")
+        print(f"{result['trials_per_s']:.1f} trials/s, {result['tokens_per_s']:.0f} generated tok/s end to end; "
+              f"decode {result['generated_tokens_per_s']:.0f} tok/s, "
+              f"prefill {result['prefill_tokens_per_s']:.0f} tok/s ({s['prefill_tokens']} prompt tokens computed)")
+        print(f"accuracy: first trial {result['accuracy'][0]:.2f}, last trial {result['accuracy'][-1]:.2f}")
+    return result
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--episodes', type=int, default=64)
+    parser.add_argument('--trials', type=int, default=20)
+    parser.add_argument('--groups', type=int, default=2, help='轮流生成的组数, 1: 不和 RPE 仿真重叠')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--max-new-tokens', type=int, default=8)
+    parser.add_argument('--no-prefix-cache', action='store_true')
+    parser.add_argument('--threads', type=int, default=None, help='torch 的线程数')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--plot', default=None, help='把每个 trial 的正确率 / 平均 RPE 画到这个文件')
+    args = parser.parse_args()
+
+    model = build_tiny_model(args.seed, args.threads)
+    # 前缀 KV cache 和从头算的结果一致
+    suffixes = [state_line(x, x % len(RULES), (x - 6) / 3) for x in range(2, 11)]
+    check = check_prefix_cache(model, ByteTokenizer(), suffixes, max_new_tokens=args.max_new_tokens)
+    print(f"prefix cache check: max |logit diff| {check['max_logit_diff']:.3g} (logits up to "
+          f"{check['logit_scale']:.3g}), greedy tokens identical: {check['same_greedy_tokens']}")
+    result = run_hybrid(args.episodes, args.trials, args.groups, args.workers, not args.no_prefix_cache,
+                        args.max_new_tokens, args.seed, model=model)
+    if args.plot:
+        from core.plotting import plt
+        steps = np.arange(1, args.trials + 1)
+        fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(10, 7), sharex=True)
+        ax1.plot(steps, result['accuracy'], 'o-', color='navy')
+        ax1.set_ylabel('Fraction Correct')
+        ax1.set_title(f"Hybrid LLM-Neuron Loop ({args.episodes} episodes)")
+        ax1.grid(True)
+        ax2.bar(steps, result['rpe_mean'], color='tab:green', alpha=0.8)
+        ax2.axhline(-1.0, color='red', linestyle=':', label='RPE Switching Threshold')
+        ax2.set_xlabel('Trial Number')
+        ax2.set_ylabel('Mean Peak RPE [mV]')
+        ax2.legend()
+        ax2.grid(True, axis='y')
+        plt.tight_layout()
+        plt.savefig(args.plot)
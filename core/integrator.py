@@ -0,0 +1,179 @@
+from contextlib import contextmanager
+import time
+import numpy as np
+from neuron import h
+
+# 积分器选择: 定步长 (默认, dt = 0.025) 或者 CVODE 变步长 (全局 / 每个细胞各自的 local step)
+#  - configure() / integrator() 设置全局的 h.CVode(), 之后的 h.run() / CellArray.run() / cached_run() 都照用
+#  - CVODE 下每一步的时间不固定, record() 按 dt 的固定间隔采样, 曲线下标和定步长时一样能用;
+#    local step 下没有全局的 t 可以记录, 时间轴用 sample_times() 补出来
+#  - CVODE 跑完后 h.dt 是最后一步的步长, 采样间隔记在 _sample_dt 里, 不从 h.dt 读
+#  - CVODE 的设置已经在 ResultCache 的 key 里 (core/cache.py), 不同积分器的结果不会混用
+# autotune: 以定步长的结果为参照, 找误差不超过给定范围的最松容差, 报告耗时
+
+METHODS = ['fixed', 'global', 'local']
+FIXED_DT = 0.025
+
+_sample_dt = FIXED_DT
+
+
+def configure(method='fixed', atol=1e-3, rtol=0.0, dt=FIXED_DT):
+    if method not in METHODS:
+        raise ValueError(f"unknown integrator {method!r}, expected one of {METHODS}")
+    cv = h.CVode()
+    cv.active(method != 'fixed')
+    cv.use_local_dt(method == 'local')
+    cv.atol(atol)
+    cv.rtol(rtol)
+    h.dt = dt
+    global _sample_dt
+    _sample_dt = dt
+
+
+def settings():
+    cv = h.CVode()
+    if not cv.active():
+        method = 'fixed'
+    else:
+        method = 'local' if cv.use_local_dt() else 'global'
+    return {'method': method, 'atol': cv.atol(), 'rtol': cv.rtol(), 'dt': sample_dt()}
+
+
+def sample_dt():
+    return _sample_dt if h.CVode().active() else h.dt
+
+
+@contextmanager
+def integrator(method='fixed', atol=1e-3, rtol=0.0, dt=FIXED_DT):
+    saved = settings()
+    configure(method, atol, rtol, dt)
+    try:
+        yield
+    finally:
+        configure(**saved)
+
+
+def record(ref, dt=None):
+    # CVODE 下按 dt 的间隔插值采样, 定步长时每步记一次; 不能用来记 t
+    if h.CVode().active():
+        return h.Vector().record(ref, dt or _sample_dt)
+    return h.Vector().record(ref)
+
+
+def sample_times(n, dt=None):
+    # CVODE 下 record() 的采样时间
+    return np.arange(n) * (dt or _sample_dt)
+
+
+def add_arguments(parser):
+    parser.add_argument('--integrator', choices=METHODS, default='fixed')
+    parser.add_argument('--atol', type=float, default=1e-3)
+    parser.add_argument('--rtol', type=float, default=0.0)
+
+
+def configure_from_args(args):
+    configure(args.integrator, args.atol, args.rtol)
+
+
+# ---- autotune ----
+
+def _direction_experiment(n):
+    # phase3 / search 的方向测试: n 个权重 x 两个方向, 每个点一个细胞
+    from core.cell_array import simulate_delay_line
+    w_range = np.linspace(0.0008, 0.0016, n)
+    ca_peak, spikes = simulate_delay_line(np.concatenate([w_range, w_range]),
+                                          ['preferred'] * n + ['null'] * n,
+                                          batch_size=2 * n, warm=False)
+    return {'ca_peak': ca_peak, 'spikes': spikes}
+
+
+def _rpe_experiment(n):
+    # learn.py 的 RPE 钳位: n 个置信度 x 对 / 错
+    from core.cell_array import simulate_rpe
+    conf = np.linspace(0, 1, n)
+    rpe_peak = simulate_rpe(np.concatenate([conf, conf]), [True] * n + [False] * n, batch_size=2 * n)
+    return {'rpe_peak': rpe_peak}
+
+
+EXPERIMENTS = {'direction': _direction_experiment, 'rpe': _rpe_experiment}
+
+
+def output_errors(out, ref):
+    # ca_peak: 最大相对误差; spikes: 发放数最多差几个; rpe_peak: 最大绝对误差 (mV)
+    errors = {}
+    if 'ca_peak' in ref:
+        errors['ca_peak'] = float(np.max(np.abs(out['ca_peak'] - ref['ca_peak']) / np.abs(ref['ca_peak'])))
+    if 'spikes' in ref:
+        errors['spikes'] = int(np.max(np.abs(out['spikes'] - ref['spikes'])))
+    if 'rpe_peak' in ref:
+        errors['rpe_peak'] = float(np.max(np.abs(out['rpe_peak'] - ref['rpe_peak'])))
+    return errors
+
+
+def _timed(experiment, n, method, atol=1e-3, rtol=0.0):
+    with integrator(method, atol, rtol):
+        start = time.perf_counter()
+        out = EXPERIMENTS[experiment](n)
+        return out, time.perf_counter() - start
+
+
+def autotune(experiment, bounds, methods=('global', 'local'), atols=(1e-1, 1e-2, 1e-3, 1e-4, 1e-5),
+             rtol=0.0, n=10, verbose=True):
+    # bounds: {'ca_peak': 相对误差, 'spikes': 个数, 'rpe_peak': mV}, 只检查实验有的输出
+    # 容差从松到紧试, 每种方法取第一个满足所有误差范围的; 一个都不满足时是 None
+    ref, ref_time = _timed(experiment, n, 'fixed')
+    keys = [k for k in ('ca_peak', 'spikes', 'rpe_peak') if k in ref]
+    if verbose:
+        print(f"{experiment}: fixed dt={FIXED_DT} reference {ref_time:.2f} s, bounds "
+              + ", ".join(f"{k} <= {bounds[k]:g}" for k in keys))
+        print(f"{'method':<8}{'atol':>8}{'wall (s)':>10}{'speedup':>9}" + "".join(f"{k:>12}" for k in keys))
+
+    chosen = {}
+    last = None
+    for method in methods:
+        chosen[method] = None
+        for atol in atols:
+            out, wall = _timed(experiment, n, method, atol, rtol)
+            errors = output_errors(out, ref)
+            ok = all(errors[k] <= bounds[k] for k in keys)
+            if verbose:
+                print(f"{method:<8}{atol:>8.0e}{wall:>10.2f}{ref_time / wall:>9.2f}"
+                      + "".join(f"{errors[k]:>12.3g}" for k in keys) + ("  ok" if ok else ""))
+            last = (f'{method} atol={atol:g}', out)
+            if ok:
+                chosen[method] = {'atol': atol, 'rtol': rtol, 'wall': wall,
+                                  'speedup': ref_time / wall, 'errors': errors}
+                break
+
+    if verbose:
+        for method, best in chosen.items():
+            if best is None:
+                print(f"{method}: no tolerance down to atol={atols[-1]:g} stays within the bounds")
+            else:
+                print(f"{method}: atol={best['atol']:g} rtol={rtol:g}, {best['speedup']:.2f}x vs fixed step")
+        if last is not None:
+            # 参照本身的离散误差: 最后 (最紧) 一次 CVODE 的结果和定步长差多少
+            print(f"fixed-step reference vs CVODE {last[0]}: "
+                  + ", ".join(f"{k} {v:.3g}" for k, v in output_errors(ref, last[1]).items()))
+    return {'reference_wall': ref_time, 'chosen': chosen}
+
+
+if __name__ == '__main__':
+    # 在仓库根目录下运行: python -m core.integrator --experiment direction --ca-rtol 0.05 --spike-tol 1
+    import argparse
+    from core.env import setup
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--experiment', choices=sorted(EXPERIMENTS), default='direction')
+    parser.add_argument('--ca-rtol', type=float, default=0.05)
+    parser.add_argument('--spike-tol', type=int, default=1)
+    parser.add_argument('--rpe-atol', type=float, default=0.5)
+    parser.add_argument('--methods', nargs='+', choices=METHODS[1:], default=['global', 'local'])
+    parser.add_argument('--atols', type=float, nargs='+', default=[1e-1, 1e-2, 1e-3, 1e-4, 1e-5])
+    parser.add_argument('--rtol', type=float, default=0.0)
+    parser.add_argument('--n', type=int, default=10, help='每个方向 / 每种对错的点数')
+    args = parser.parse_args()
+
+    setup()
+    autotune(args.experiment, {'ca_peak': args.ca_rtol, 'spikes': args.spike_tol, 'rpe_peak': args.rpe_atol},
+             methods=args.methods, atols=args.atols, rtol=args.rtol, n=args.n)
@@ -0,0 +1,175 @@
+from dataclasses import asdict, dataclass, fields, replace
+import math
+import weakref
+from neuron import h
+
+from core.env import setup
+from core.fingerprint import fingerprint
+
+# 所有脚本共用的 ball-and-stick 模型:
+#  - ModelSpec 是不可变、可哈希的模型描述 (几何 / nseg / 通道密度 / 远端 ca_hva 分布)
+#  - build_model(spec) 每个进程只建一套 soma / dend, 之后再调用时只把和当前不同的参数原地改掉, 不新建 section
+#  - 只改自己的 section, 不碰 h.allsec() 里别的细胞
+#  - spec.key() 是跨进程稳定的哈希, 可以当缓存 key / 分发任务时标识模型
+#  - section 的参数只通过 Cell.update 改时, 模型完全由各个 Cell 的 spec 决定 (cell_specs, warm_run 的 key 用它)
+#  - spec.with_d_lambda() 按 d_lambda 规则 (频率 freq 下的交流长度常数的 d_lambda 倍) 选树突的 nseg,
+#    python -m core.convergence 报告钙峰 / RPE 峰值随 nseg 的收敛情况
+
+
+@dataclass(frozen=True)
+class ModelSpec:
+    soma_L: float = 20
+    soma_diam: float = 20
+    dend_L: float = 500
+    dend_diam: float = 2
+    dend_nseg: int = 51
+    Ra: float = 150
+    cm: float = 1
+    soma_na: float = 0.3
+    soma_k: float = 0.036
+    soma_gl: float = 0.0003
+    soma_el: float = -54.3
+    dend_na: float = 0.052
+    dend_k: float = 0.005
+    dend_gl: float = 0.0003
+    dend_el: float = -54.3
+    # calcium=False 时不插 ca_hva / cad (phase1 的模型)
+    calcium: bool = True
+    # gbar_ca_hva = ca_bar 只在 x > ca_distal 的 segment 上, 其余为 0
+    ca_bar: float = 0.01
+    ca_distal: float = 0.5
+    tau_cad: float = 50
+
+    def replace(self, **changes):
+        return replace(self, **changes)
+
+    def diff(self, other):
+        # 和 other 不同的字段 {名字: self 的值}
+        return {f.name: getattr(self, f.name) for f in fields(self)
+                if getattr(self, f.name) != getattr(other, f.name)}
+
+    def with_d_lambda(self, d_lambda=0.1, freq=100):
+        return self.replace(dend_nseg=d_lambda_nseg(self.dend_L, self.dend_diam, self.Ra, self.cm, d_lambda, freq))
+
+    def key(self):
+        # numpy 标量先转成 python 的, 同一个模型的 key 不随参数的类型变
+        return fingerprint({k: v.item() if hasattr(v, 'item') else v for k, v in asdict(self).items()})
+
+
+# search.py / phase3_final.py / train.py / phase2_tuning.py
+DEFAULT_SPEC = ModelSpec()
+# learn.py / llama.py: 胞体和树突的 gkbar 都是 hh 默认值, 胞体 gnabar 也是
+AGENT_SPEC = ModelSpec(soma_na=0.12, dend_k=0.036)
+# phase1_test.py: 细树突, 没有钙通道
+PHASE1_SPEC = ModelSpec(dend_diam=1.0, soma_na=0.5, dend_na=0.05, dend_k=0.01, calcium=False)
+
+
+def lambda_f(diam, Ra, cm, freq=100):
+    # 频率 freq (Hz) 下的交流长度常数 (um), 和 NEURON 的 fixnseg.hoc 一样
+    return 1e5 * math.sqrt(diam / (4 * math.pi * freq * Ra * cm))
+
+
+def d_lambda_nseg(L, diam, Ra, cm, d_lambda=0.1, freq=100):
+    # 每个 segment 不超过 d_lambda 个长度常数, 取奇数 (保证 x=0.5 有节点)
+    return int((L / (d_lambda * lambda_f(diam, Ra, cm, freq)) + 0.9) / 2) * 2 + 1
+
+
+# CellArray / numpy 后端按细胞改的通道参数
+CHANNEL_PARAMS = ('soma_na', 'soma_k', 'dend_na', 'dend_k', 'ca_bar', 'tau_cad')
+
+# 进程里所有还活着的 Cell
+_cells = weakref.WeakSet()
+
+
+class Cell:
+
+    def __init__(self, spec=DEFAULT_SPEC, prefix=''):
+        # prefix: section 名字的前缀, 同一个进程里要多个细胞时用 (CellArray)
+        self.soma = h.Section(name=prefix + 'soma')
+        self.dend = h.Section(name=prefix + 'dend')
+        self.dend.connect(self.soma(1))
+        self.soma.insert('hh')
+        self.dend.insert('hh')
+        self.spec = None
+        self.update(spec)
+        _cells.add(self)
+
+    def update(self, spec=None, **changes):
+        # 原地改成 spec (或者当前 spec 加上 changes), 只动变了的参数; 返回改了哪些字段
+        spec = spec or self.spec
+        if changes:
+            spec = spec.replace(**changes)
+        if spec == self.spec:
+            return {}
+        changed = spec.diff(self.spec) if self.spec is not None else asdict(spec)
+        soma, dend = self.soma, self.dend
+        if 'soma_L' in changed: soma.L = spec.soma_L
+        if 'soma_diam' in changed: soma.diam = spec.soma_diam
+        if 'dend_L' in changed: dend.L = spec.dend_L
+        if 'dend_diam' in changed: dend.diam = spec.dend_diam
+        if 'dend_nseg' in changed:
+            # nseg 变了之后新 segment 上的参数要重新设
+            dend.nseg = spec.dend_nseg
+            changed = asdict(spec)
+        for sec in (soma, dend):
+            if 'Ra' in changed: sec.Ra = spec.Ra
+            if 'cm' in changed: sec.cm = spec.cm
+        if 'soma_na' in changed: soma.gnabar_hh = spec.soma_na
+        if 'soma_k' in changed: soma.gkbar_hh = spec.soma_k
+        if 'soma_gl' in changed: soma.gl_hh = spec.soma_gl
+        if 'soma_el' in changed: soma.el_hh = spec.soma_el
+        if 'dend_na' in changed: dend.gnabar_hh = spec.dend_na
+        if 'dend_k' in changed: dend.gkbar_hh = spec.dend_k
+        if 'dend_gl' in changed: dend.gl_hh = spec.dend_gl
+        if 'dend_el' in changed: dend.el_hh = spec.dend_el
+        if 'calcium' in changed:
+            if spec.calcium:
+                dend.insert('ca_hva')
+                dend.insert('cad')
+                changed = dict(changed, ca_bar=spec.ca_bar, tau_cad=spec.tau_cad)
+            elif self.spec is not None:
+                dend.uninsert('cad')
+                dend.uninsert('ca_hva')
+        if spec.calcium and ('ca_bar' in changed or 'ca_distal' in changed or 'tau_cad' in changed):
+            for seg in dend:
+                seg.tau_cad = spec.tau_cad
+                seg.gbar_ca_hva = spec.ca_bar if seg.x > spec.ca_distal else 0
+        self.spec = spec
+        return changed
+
+    def sections(self):
+        return [self.soma, self.dend]
+
+
+_cell = None
+
+
+def build_model(spec=DEFAULT_SPEC, **changes):
+    # 各脚本 build_model() 的共用版本, 返回 (soma, dend)
+    # 进程里已经有细胞时原地改成 spec, 不再新建 section
+    global _cell
+    setup()
+    spec = spec.replace(**changes) if changes else spec
+    if _cell is None:
+        _cell = Cell(spec)
+    else:
+        _cell.update(spec)
+    return _cell.soma, _cell.dend
+
+
+def current_cell():
+    return _cell
+
+
+def cell_specs(sections):
+    # sections 全都属于 Cell 时返回 ((section 名字, spec), ...), 有别的 section 时返回 None
+    owner = {}
+    for cell in list(_cells):
+        for sec in cell.sections():
+            owner[sec] = cell
+    specs = []
+    for sec in sections:
+        if sec not in owner:
+            return None
+        specs.append((sec.name(), owner[sec].spec))
+    return tuple(specs)
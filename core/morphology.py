@@ -0,0 +1,344 @@
+import hashlib
+import os
+import numpy as np
+from neuron import h
+
+from core.env import setup
+from core.fingerprint import CACHE_DIR, fingerprint
+from core.model import DEFAULT_SPEC, d_lambda_nseg
+
+# 多分支的形态 (ball-and-stick 之外):
+#  - BranchingCell: 合成的对称分叉树突, 胞体上长 children 根主干, 每一层每根再分 children 叉, 直径逐层乘 taper
+#  - load_morphology(path): 读 SWC / Neurolucida ASC (NEURON 的 Import3d), 按 d_lambda 定每个 section 的 nseg,
+#    结果 (每个 section 的类型 / 父节点 / 3D 点 / nseg) 存成 .sim_cache/morph_<key>.npz;
+#    之后 (包括进程池的 worker) 直接读 npz, 不再经过 Import3d, ReconstructedCell(m) 建细胞
+#  - 机制分布和 ball-and-stick 一样: 到处 hh, 胞体 / 轴突用 soma_* 的密度, 树突用 dend_*;
+#    ca_hva + cad 插在树突上, gbar 只给路径距离 > ca_distal * 最远树突末端距离的 segment
+#    (路径距离从树突和胞体的连接处算起, 所以 ball-and-stick 上就是原来的 seg.x > 0.5)
+#  - cell.path(tip): 从胞体到某个末端的路径, path(x) 和 ball-and-stick 的 dend(x) 一样 (x=0 在胞体, 1 在末端),
+#    SynapseRig(cell.path()) 把 delay line 的 5 个突触放在这条路径上
+
+SWC_TYPES = {1: 'soma', 2: 'axon', 3: 'dend', 4: 'apic'}
+SOMATIC_TYPES = (1, 2)
+# 改了 Morphology 的字段或 nseg 的算法时加一, 旧的缓存就不用了
+FORMAT_VERSION = 1
+
+
+class Path:
+
+    def __init__(self, sections):
+        # sections: 从胞体旁边的第一根到末端; 每根只算到下一根接上的位置
+        self.sections = sections
+        ends = [nxt.parentseg().x for nxt in sections[1:]] + [1.0]
+        self.ends = ends
+        self.lengths = np.cumsum([sec.L * x for sec, x in zip(sections, ends)])
+
+    @property
+    def L(self):
+        return self.lengths[-1]
+
+    def __call__(self, x):
+        d = x * self.L
+        i = min(int(np.searchsorted(self.lengths, d)), len(self.sections) - 1)
+        sec = self.sections[i]
+        start = self.lengths[i] - sec.L * self.ends[i]
+        return sec(min(max((d - start) / sec.L, 0.0), 1.0))
+
+
+class _Tree:
+    # BranchingCell / ReconstructedCell 共用: somatic 是胞体 (和轴突) 的 section, dends 是树突
+
+    def sections(self):
+        return self.somatic + self.dends
+
+    def compartments(self):
+        return sum(sec.nseg for sec in self.sections())
+
+    def _distances(self):
+        # 每根树突 0 端到胞体的路径距离
+        somatic = set(self.somatic)
+        dist0 = {}
+
+        def start(sec):
+            if sec not in dist0:
+                seg = sec.parentseg()
+                dist0[sec] = 0.0 if seg is None or seg.sec in somatic else start(seg.sec) + seg.x * seg.sec.L
+            return dist0[sec]
+
+        for sec in self.dends:
+            start(sec)
+        return dist0
+
+    def _insert_mechanisms(self, spec):
+        for sec in self.sections():
+            sec.Ra, sec.cm = spec.Ra, spec.cm
+            sec.insert('hh')
+        for sec in self.somatic:
+            sec.gnabar_hh, sec.gkbar_hh, sec.gl_hh, sec.el_hh = spec.soma_na, spec.soma_k, spec.soma_gl, spec.soma_el
+        for sec in self.dends:
+            sec.gnabar_hh, sec.gkbar_hh, sec.gl_hh, sec.el_hh = spec.dend_na, spec.dend_k, spec.dend_gl, spec.dend_el
+        self.dist0 = self._distances()
+        if not spec.calcium or not self.dends:
+            return
+        far = max(self.dist0[sec] + sec.L for sec in self.dends)
+        threshold = spec.ca_distal * far
+        for sec in self.dends:
+            sec.insert('ca_hva')
+            sec.insert('cad')
+            sec.tau_cad = spec.tau_cad
+            d0 = self.dist0[sec]
+            if d0 + sec.L * (1 - 0.5 / sec.nseg) <= threshold:
+                sec.gbar_ca_hva = 0
+            elif d0 + sec.L * 0.5 / sec.nseg > threshold:
+                sec.gbar_ca_hva = spec.ca_bar
+            else:
+                for seg in sec:
+                    seg.gbar_ca_hva = spec.ca_bar if d0 + seg.x * sec.L > threshold else 0
+
+    def tips(self):
+        parents = set(sec.parentseg().sec for sec in self.dends if sec.parentseg() is not None)
+        return [sec for sec in self.dends if sec not in parents]
+
+    def path(self, tip=None):
+        # 到 tip 的路径, 默认到最远的末端
+        if tip is None:
+            tip = max(self.tips(), key=lambda sec: self.dist0[sec] + sec.L)
+        somatic = set(self.somatic)
+        sections = [tip]
+        while sections[-1].parentseg() is not None and sections[-1].parentseg().sec not in somatic:
+            sections.append(sections[-1].parentseg().sec)
+        return Path(sections[::-1])
+
+
+class BranchingCell(_Tree):
+
+    def __init__(self, depth=6, children=2, branch_L=150, root_diam=3, taper=0.8, spec=DEFAULT_SPEC,
+                 d_lambda=0.1, prefix=''):
+        # 每根分支的 nseg 按 d_lambda 规则; 用来测多线程 (core/threads.py) 在大细胞上的效果
+        setup()
+        self.spec = spec
+        self.soma = h.Section(name=prefix + 'soma')
+        self.soma.L, self.soma.diam = spec.soma_L, spec.soma_diam
+        self.somatic = [self.soma]
+        self.dends = []
+        level = [self.soma]
+        for depth_i in range(depth):
+            diam = root_diam * taper ** depth_i
+            nseg = d_lambda_nseg(branch_L, diam, spec.Ra, spec.cm, d_lambda)
+            next_level = []
+            for parent in level:
+                for _ in range(children):
+                    sec = h.Section(name=f'{prefix}dend{len(self.dends)}')
+                    sec.connect(parent(1))
+                    sec.L, sec.diam, sec.nseg = branch_L, diam, nseg
+                    self.dends.append(sec)
+                    next_level.append(sec)
+            level = next_level
+        self._insert_mechanisms(spec)
+
+
+def _lambda_nseg(points, Ra, cm, d_lambda, freq):
+    # NEURON fixnseg.hoc 的 d_lambda 规则, 用 3D 点算交流长度常数 (直径沿路径变化)
+    xyz, diam = points[:, :3].astype(float), points[:, 3].astype(float)
+    arc = np.concatenate([[0.0], np.cumsum(np.linalg.norm(np.diff(xyz, axis=0), axis=1))])
+    L = arc[-1]
+    if len(points) < 2 or L == 0:
+        return 1
+    lam = np.sum(np.diff(arc) / np.sqrt(diam[:-1] + diam[1:]))
+    lam *= np.sqrt(2) * 1e-5 * np.sqrt(4 * np.pi * freq * Ra * cm)
+    return int((lam / d_lambda + 0.9) / 2) * 2 + 1
+
+
+class Morphology:
+    # 离散好的形态: 每个 section 一行; points 是所有 section 的 3D 点 (x, y z, diam) 接在一起, offsets 是分界
+
+    FIELDS = ('types', 'parent', 'parent_x', 'child_end', 'offsets', 'points', 'nseg')
+
+    def __init__(self, types, parent, parent_x, child_end, offsets, points, nseg, source=''):
+        self.types = types
+        self.parent = parent
+        self.parent_x = parent_x
+        self.child_end = child_end
+        self.offsets = offsets
+        self.points = points
+        self.nseg = nseg
+        self.source = source
+
+    def __len__(self):
+        return len(self.types)
+
+    def save(self, path):
+        tmp = path + '.tmp.npz'
+        np.savez(tmp, source=self.source, **{name: getattr(self, name) for name in self.FIELDS})
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(*[data[name] for name in cls.FIELDS], source=str(data['source']))
+
+
+def _import3d(path):
+    # Import3d 在顶层建 soma[] / dend[] ..., 读出来之后删掉
+    setup()
+    h.load_file('import3d.hoc')
+    ext = os.path.splitext(path)[1].lower()
+    if ext == '.swc':
+        reader = h.Import3d_SWC_read()
+    elif ext == '.asc':
+        reader = h.Import3d_Neurolucida3()
+    else:
+        raise ValueError(f"unsupported morphology format: {path}")
+    reader.input(path)
+    before = set(h.allsec())
+    h.Import3d_GUI(reader, False).instantiate(None)
+    secs = [sec for sec in h.allsec() if sec not in before]
+    index = {sec: i for i, sec in enumerate(secs)}
+    kinds = {name: t for t, name in SWC_TYPES.items()}
+    types, parent, parent_x, child_end, offsets, points = [], [], [], [], [0], []
+    for sec in secs:
+        types.append(kinds.get(sec.name().split('[')[0], 3))
+        seg = sec.parentseg()
+        parent.append(-1 if seg is None else index[seg.sec])
+        parent_x.append(0.0 if seg is None else seg.x)
+        child_end.append(sec.orientation())
+        points.extend((sec.x3d(i), sec.y3d(i), sec.z3d(i), sec.diam3d(i)) for i in range(sec.n3d()))
+        offsets.append(len(points))
+    for sec in secs:
+        h.delete_section(sec=sec)
+    return (np.array(types, dtype=np.int8), np.array(parent, dtype=np.int32), np.array(parent_x),
+            np.array(child_end, dtype=np.int8), np.array(offsets, dtype=np.int32),
+            np.array(points, dtype=np.float32))
+
+
+def morphology_key(path, spec=DEFAULT_SPEC, d_lambda=0.1, freq=100):
+    with open(path, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    return fingerprint({'file': digest, 'Ra': spec.Ra, 'cm': spec.cm, 'd_lambda': d_lambda, 'freq': freq,
+                        'version': FORMAT_VERSION})
+
+
+def load_morphology(path, spec=DEFAULT_SPEC, d_lambda=0.1, freq=100, cache_dir=CACHE_DIR):
+    # nseg 只和 Ra / cm 有关, 通道密度变了缓存照样能用; cache_dir=None 时不读写缓存
+    cache = None
+    if cache_dir is not None:
+        cache = os.path.join(cache_dir, f'morph_{morphology_key(path, spec, d_lambda, freq)}.npz')
+        if os.path.exists(cache):
+            return Morphology.load(cache)
+    types, parent, parent_x, child_end, offsets, points = _import3d(path)
+    nseg = np.array([_lambda_nseg(points[offsets[i]:offsets[i + 1]], spec.Ra, spec.cm, d_lambda, freq)
+                     for i in range(len(types))], dtype=np.int32)
+    morphology = Morphology(types, parent, parent_x, child_end, offsets, points, nseg, source=path)
+    if cache is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        morphology.save(cache)
+    return morphology
+
+
+def write_synthetic_swc(path, depth=8, points_per_branch=8, step=20, root_radius=1.5, taper=0.85, seed=0):
+    # 仓库里没有重建的形态, 测试 / 基准用: 三点胞体加一棵随机弯曲的二叉树突, 每层半径乘 taper
+    rng = np.random.default_rng(seed)
+    rows = [(1, 1, 0, 0, 0, 10, -1), (2, 1, 0, -10, 0, 10, 1), (3, 1, 0, 10, 0, 10, 1)]
+    stack = [(1, np.zeros(3), np.pi / 2, root_radius, 0)]
+    while stack:
+        pid, pos, angle, radius, level = stack.pop()
+        for side in (-0.5, 0.5):
+            a = angle + side * 0.8 + rng.normal(0, 0.1)
+            prev, p = pid, pos
+            for _ in range(points_per_branch):
+                p = p + np.array([np.cos(a), np.sin(a), rng.normal(0, 0.2)]) * step
+                rows.append((len(rows) + 1, 3, *p.round(2), round(radius, 3), prev))
+                prev = len(rows)
+            if level + 1 < depth:
+                stack.append((prev, p, a, radius * taper, level + 1))
+    with open(path, 'w') as f:
+        f.write(''.join(' '.join(str(v) for v in row) + '\n' for row in rows))
+    return path
+
+
+class ReconstructedCell(_Tree):
+
+    def __init__(self, morphology, spec=DEFAULT_SPEC, prefix=''):
+        # morphology: load_morphology() 的结果; 几何和 nseg 来自 morphology, 通道来自 spec (dend_L 等几何字段不用)
+        setup()
+        m = morphology
+        self.spec = spec
+        counts = {}
+        secs = []
+        for t in m.types.tolist():
+            kind = SWC_TYPES.get(t, 'dend')
+            secs.append(h.Section(name=f'{prefix}{kind}{counts.get(kind, 0)}'))
+            counts[kind] = counts.get(kind, 0) + 1
+        offsets = m.offsets.tolist()
+        points = m.points.tolist()
+        for i, sec in enumerate(secs):
+            for p in points[offsets[i]:offsets[i + 1]]:
+                sec.pt3dadd(*p)
+        for sec, p, x, end in zip(secs, m.parent.tolist(), m.parent_x.tolist(), m.child_end.tolist()):
+            if p >= 0:
+                sec.connect(secs[p](x), end)
+        for sec, n in zip(secs, m.nseg.tolist()):
+            sec.nseg = n
+        self.all = secs
+        self.somatic = [sec for sec, t in zip(secs, m.types.tolist()) if t in SOMATIC_TYPES]
+        self.dends = [sec for sec, t in zip(secs, m.types.tolist()) if t not in SOMATIC_TYPES]
+        self.soma = next(sec for sec, t in zip(secs, m.types.tolist()) if t == 1)
+        self._insert_mechanisms(spec)
+
+
+def _instantiate(path, spec, d_lambda):
+    # 进程池 worker 里: 读缓存 + 建细胞 + delay line 两个方向的远端钙峰
+    import time
+    from core.recording import Tracker
+    from core.rig import SynapseRig
+    setup()
+    start = time.perf_counter()
+    m = load_morphology(path, spec, d_lambda)
+    loaded = time.perf_counter()
+    cell = ReconstructedCell(m, spec)
+    built = time.perf_counter()
+    path = cell.path()
+    rig = SynapseRig(path)
+    tracker = Tracker(path(1.0), 'cai')
+    h.celsius, h.dt, h.tstop, h.v_init = 30, 0.025, 100, -70
+    peaks = {}
+    for direction in ('preferred', 'null'):
+        rig.set_weights(0.0012)
+        rig.set_direction(direction, 3)
+        h.run()
+        peaks[direction] = tracker.max
+    return {'load': loaded - start, 'build': built - loaded, 'sections': len(cell.all),
+            'compartments': cell.compartments(), 'path': [sec.name() for sec in path.sections],
+            'path_L': path.L, 'peaks': peaks}
+
+
+if __name__ == '__main__':
+    # 读形态 (第一次经过 Import3d, 之后读缓存), 在新的 worker 进程里建细胞, 最远路径上跑 delay line
+    # 在仓库根目录下运行: python -m core.morphology cell.swc  或  python -m core.morphology --synthetic-depth 9
+    import argparse
+    import multiprocessing
+    import time
+    from concurrent.futures import ProcessPoolExecutor
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path', nargs='?', help='.swc / .asc; 不给时生成合成的 SWC')
+    parser.add_argument('--synthetic-depth', type=int, default=9)
+    parser.add_argument('--d-lambda', type=float, default=0.1)
+    args = parser.parse_args()
+
+    path = args.path
+    if path is None:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        path = write_synthetic_swc(os.path.join(CACHE_DIR, f'synthetic_{args.synthetic_depth}.swc'),
+                                   depth=args.synthetic_depth)
+    start = time.perf_counter()
+    load_morphology(path, DEFAULT_SPEC, args.d_lambda, cache_dir=None)
+    parse = time.perf_counter() - start
+    load_morphology(path, DEFAULT_SPEC, args.d_lambda)
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as ex:
+        r = ex.submit(_instantiate, path, DEFAULT_SPEC, args.d_lambda).result()
+    print(f"{path}: {r['sections']} sections, {r['compartments']} compartments (d_lambda={args.d_lambda:g})")
+    print(f"Import3d parse + nseg {parse * 1e3:.1f} ms; in a fresh worker: cache load {r['load'] * 1e3:.1f} ms, "
+          f"instantiate {r['build'] * 1e3:.1f} ms")
+    print(f"delay line on {' -> '.join(r['path'])} ({r['path_L']:.0f} um): tip Ca peak "
+          f"preferred {r['peaks']['preferred']:.4g} mM, null {r['peaks']['null']:.4g} mM")
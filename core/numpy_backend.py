@@ -0,0 +1,331 @@
+from functools import partial
+import numpy as np
+
+from core.cell_array import DEFAULT_PARAMS, _batch_size, _batches, _per_cell, _per_cell_weights
+from core.rig import LATENCIES, LOCS, delay_line_onsets
+from core.sweep import run_sweep
+
+# 不经过 NEURON, 用 numpy 直接积分 build_model() 的 ball-and-stick, 一次推进一整批细胞
+# 数组是 (节点, batch): 节点 0 是 soma(0.5), 1..51 是 dend 的 51 个 segment, 52 是 dend(1) 端点
+# 每一步的顺序照搬 NEURON 的固定步长 (secondorder=0):
+#  1. 送达 t + dt/2 之前的突触事件 (Exp2Syn 的 A, B 加上 weight * factor)
+#  2. 用当前的 v 和门控变量算电流, 隐式欧拉解三对角方程得到新的 v
+#  3. 用新的 v 按 cnexp 更新 hh / ca_hva / cad / Exp2Syn 的状态, APCount 数上穿 0 mV
+# hh 和 NEURON 一样用查表 (-100..100 mV, 201 个点, 线性插值); eca 每步按 Nernst 从 cai 算
+# soma(1) 这个零面积节点上没有电容和电流, 消元之后就是 soma 和 dend(0) 之间串联的两段电阻;
+# dend(1) 上有 x=1.0 的突触, 要留着: 和 NEURON 一样面积记作 100 um2, 没有电容和通道
+# 只支持 simulate_delay_line 的无噪声部分: 没有 IClamp / SEClamp / 泊松抑制
+
+FARADAY = 96485.33212331001
+R_GAS = 8.31446261815324
+ENA = 50.0
+EK = -77.0
+CAO = 2.0
+
+SOMA_L, SOMA_DIAM = 20.0, 20.0
+DEND_L, DEND_DIAM, DEND_NSEG = 500.0, 2.0, 51
+RA, CM = 150.0, 1.0
+GL, EL = 0.0003, -54.3
+CAD_DEPTH, CAI0 = 0.1, 1e-4
+AP_THRESH = 0.0
+
+TABLE_VMIN, TABLE_VMAX, TABLE_N = -100.0, 100.0, 200
+
+
+def _vtrap(x, y):
+    small = np.abs(x / y) < 1e-6
+    safe = np.where(small, 1.0, x)
+    return np.where(small, y * (1 - x / y / 2), safe / (np.exp(safe / y) - 1))
+
+
+def hh_rates(v, celsius):
+    # hh.mod 的 rates(), 返回 minf, mtau, hinf, htau, ninf, ntau
+    q10 = 3 ** ((celsius - 6.3) / 10)
+    alpha = .1 * _vtrap(-(v + 40), 10)
+    beta = 4 * np.exp(-(v + 65) / 18)
+    s = alpha + beta
+    mtau, minf = 1 / (q10 * s), alpha / s
+    alpha = .07 * np.exp(-(v + 65) / 20)
+    beta = 1 / (np.exp(-(v + 35) / 10) + 1)
+    s = alpha + beta
+    htau, hinf = 1 / (q10 * s), alpha / s
+    alpha = .01 * _vtrap(-(v + 55), 10)
+    beta = .125 * np.exp(-(v + 65) / 80)
+    s = alpha + beta
+    ntau, ninf = 1 / (q10 * s), alpha / s
+    return minf, mtau, hinf, htau, ninf, ntau
+
+
+def ca_hva_rates(v):
+    alpha = 0.055 * (-27 - v) / (np.exp((-27 - v) / 3.8) - 1)
+    beta = 0.94 * np.exp((-75 - v) / 17)
+    mtau = 1 / (alpha + beta)
+    minf = alpha * mtau
+    alpha = 0.000457 * np.exp((-13 - v) / 50)
+    beta = 0.0065 / (np.exp((-15 - v) / 28) + 1)
+    htau = 1 / (alpha + beta)
+    hinf = alpha * htau
+    return minf, mtau, hinf, htau
+
+
+class HHTable:
+    # NEURON 的 TABLE ... FROM -100 TO 100 WITH 200, 超出范围取端点
+    # 直接存 cnexp 要用的 inf 和 1 - exp(-dt/tau) 不行: NEURON 是先插值 tau 再取 exp
+
+    def __init__(self, celsius):
+        grid = np.linspace(TABLE_VMIN, TABLE_VMAX, TABLE_N + 1)
+        # 每个量一张一维表加上相邻两点的差, np.take 比二维的花式索引快很多
+        self.tables = [np.ascontiguousarray(t) for t in hh_rates(grid, celsius)]
+        self.slopes = [np.diff(t) for t in self.tables]
+        self.fac = TABLE_N / (TABLE_VMAX - TABLE_VMIN)
+
+    def lookup(self, v, out=None):
+        xi = np.clip(self.fac * (v - TABLE_VMIN), 0, TABLE_N)
+        i = np.minimum(xi.astype(np.intp), TABLE_N - 1)
+        theta = xi - i
+        if out is None:
+            out = [np.empty_like(v) for _ in self.tables]
+        for res, t, s in zip(out, self.tables, self.slopes):
+            np.take(s, i, out=res, mode='clip')
+            res *= theta
+            res += np.take(t, i, mode='clip')
+        return out
+
+
+def exp2syn_factor(tau1, tau2):
+    tp = (tau1 * tau2) / (tau2 - tau1) * np.log(tau2 / tau1)
+    return 1 / (-np.exp(-tp / tau1) + np.exp(-tp / tau2))
+
+
+class BallStickBatch:
+
+    def __init__(self, celsius=30, dt=0.025, tau2=30):
+        self.celsius = celsius
+        self.dt = dt
+        self.tau1, self.tau2 = 1.0, tau2
+        self.table = HHTable(celsius)
+
+        n = DEND_NSEG
+        dx = DEND_L / n
+        self.x = (np.arange(n) + 0.5) / n
+        self.area = np.concatenate([[np.pi * SOMA_L * SOMA_DIAM],
+                                    np.full(n, np.pi * dx * DEND_DIAM), [100.0]])
+        self.cm = np.concatenate([np.full(n + 1, CM), [0.0]])
+        # 半段的轴向电阻 (MOhm)
+        r_soma = 1e-2 * RA * (SOMA_L / 2) / (np.pi * SOMA_DIAM ** 2 / 4)
+        r_dend = 1e-2 * RA * (dx / 2) / (np.pi * DEND_DIAM ** 2 / 4)
+        r = np.concatenate([[r_soma + r_dend], np.full(n - 1, 2 * r_dend), [r_dend]])
+        # 节点 i 和 i-1 之间的耦合 (mA/cm2/mV), 分别按两边的面积换算
+        self.g_down = 1e2 / (r * self.area[1:])
+        self.g_up = 1e2 / (r * self.area[:-1])
+        # 突触所在的节点: x=1.0 在端点上, 其余落在 int(x * nseg) 那一段
+        self.syn_nodes = np.array([n + 1 if loc == 1 else 1 + int(loc * n) for loc in LOCS])
+        # dend(1.0).cai 读的是最后一段
+        self.ca_node = n
+
+    def _node_params(self, params, size):
+        n = DEND_NSEG
+        p = {k: np.asarray(_per_cell(v, size), dtype=float) for k, v in params.items()}
+        none = np.zeros((1, size))
+        gna = np.vstack([p['soma_na'][None, :], np.repeat(p['dend_na'][None, :], n, axis=0), none])
+        gk = np.vstack([p['soma_k'][None, :], np.repeat(p['dend_k'][None, :], n, axis=0), none])
+        gl = np.concatenate([np.full(n + 1, GL), [0.0]])[:, None]
+        ca_mask = np.concatenate([[False], self.x > 0.5, [False]])
+        gca = np.where(ca_mask[:, None], p['ca_bar'][None, :], 0.0)
+        return gna, gk, gl, gca, p['tau_cad']
+
+    def run(self, onsets, weights, params=None, tstop=100, v_init=-70, record_ca=False):
+        # onsets, weights: (B, 5), 第 i 个 NetStim 的时间和 NetCon 权重
+        onsets = np.asarray(onsets, dtype=float)
+        weights = np.asarray(weights, dtype=float)
+        size = len(onsets)
+        dt = self.dt
+        gna, gk, gl, gca, tau_cad = self._node_params(dict(DEFAULT_PARAMS, **(params or {})), size)
+        n_nodes = len(self.area)
+
+        # 只有 gbar > 0 的 segment 的 ca_hva / cad 会影响结果, 其余的不算
+        ca_rows = np.flatnonzero(np.any(gca != 0, axis=1))
+        if self.ca_node not in ca_rows:
+            ca_rows = np.append(ca_rows, self.ca_node)
+        gca = gca[ca_rows]
+        ca_out = int(np.flatnonzero(ca_rows == self.ca_node)[0])
+
+        # 突触事件: 在 t_n + dt/2 >= onset + latency 的那一步之前送达
+        steps = int(round(tstop / dt))
+        arrival = onsets + np.asarray(LATENCIES, dtype=float)[None, :]
+        deliver = np.ceil(arrival / dt - 0.5 - 1e-9).astype(int)
+        factor = exp2syn_factor(self.tau1, self.tau2)
+        events = {}
+        for k in range(5):
+            for step in np.unique(deliver[:, k]):
+                if 0 <= step < steps:
+                    cells = np.flatnonzero(deliver[:, k] == step)
+                    events.setdefault(step, []).append((k, cells))
+
+        # finitialize
+        v = np.full((n_nodes, size), float(v_init))
+        m, h, n = (np.repeat(s[:, None], size, axis=1) for s in
+                   self.table.lookup(np.full(n_nodes, float(v_init)))[0::2])
+        ca_m, _, ca_h, _ = ca_hva_rates(np.full((len(ca_rows), size), float(v_init)))
+        cai = np.full((len(ca_rows), size), CAI0)
+        syn_a = np.zeros((5, size))
+        syn_b = np.zeros((5, size))
+        syn_area = self.area[self.syn_nodes][:, None]
+
+        ca_peak = cai[ca_out].copy()
+        ca_trace = [cai[ca_out].copy()] if record_ca else None
+        firing = v[0] >= AP_THRESH
+        spikes = np.zeros(size, dtype=int)
+
+        cfac = (1e-3 * self.cm / dt)[:, None]
+        # 对角线上不随时间变的部分: 电容加上和两边的耦合
+        diag = cfac.copy()
+        diag[1:] += self.g_down[:, None]
+        diag[:-1] += self.g_up[:, None]
+        g_up, g_down = self.g_up, self.g_down
+        gna_e, gk_e, gl_e = gna * ENA, gk * EK, gl * EL
+        nernst = 1e3 * R_GAS * (273.15 + self.celsius) / (2 * FARADAY)
+        decay1, decay2 = np.exp(-dt / self.tau1), np.exp(-dt / self.tau2)
+        cad_decay = 1 - np.exp(-dt / tau_cad)
+        cad_scale = 1e4 / (2 * FARADAY * CAD_DEPTH)
+
+        g, g_e, tmp, d, rhs = (np.empty_like(v) for _ in range(5))
+        rates = [np.empty_like(v) for _ in range(6)]
+
+        for step in range(steps):
+            for k, cells in events.get(step, ()):
+                syn_a[k, cells] += weights[cells, k] * factor
+                syn_b[k, cells] += weights[cells, k] * factor
+
+            # 所有电流对 v 都是线性的, i = g * (v - e): 这里只要 g 和 sum(g * e)
+            np.multiply(m, m, out=tmp); tmp *= m; tmp *= h
+            np.multiply(gna, tmp, out=g)
+            np.multiply(gna_e, tmp, out=g_e)
+            np.multiply(n, n, out=tmp); tmp *= tmp
+            g += gk * tmp
+            g_e += gk_e * tmp
+            g += gl
+            g_e += gl_e
+            eca = nernst * np.log(CAO / cai)
+            gca_t = gca * ca_m * ca_m * ca_h
+            ica = gca_t * (v[ca_rows] - eca)
+            g[ca_rows] += gca_t
+            g_e[ca_rows] += gca_t * eca
+            # Exp2Syn 的 e = 0, 只有电导
+            g[self.syn_nodes] += (syn_b - syn_a) * 1e2 / syn_area
+
+            # 隐式欧拉直接解新的 v: d_i v_i - g_down v_{i-1} - g_up v_{i+1} = cfac v_i + sum(g * e)
+            # 和 NEURON 解 dv 的写法只差舍入
+            np.multiply(cfac, v, out=rhs)
+            rhs += g_e
+            np.add(g, diag, out=d)
+            for i in range(1, n_nodes):
+                f = g_down[i - 1] / d[i - 1]
+                d[i] -= f * g_up[i - 1]
+                rhs[i] += f * rhs[i - 1]
+            np.divide(rhs[-1], d[-1], out=v[-1])
+            for i in range(n_nodes - 2, -1, -1):
+                np.multiply(v[i + 1], g_up[i], out=v[i])
+                v[i] += rhs[i]
+                v[i] /= d[i]
+
+            # cnexp: x = inf + (x - inf) * exp(-dt / tau)
+            minf, mtau, hinf, htau, ninf, ntau = self.table.lookup(v, out=rates)
+            for x, inf, tau in ((m, minf, mtau), (h, hinf, htau), (n, ninf, ntau)):
+                np.divide(-dt, tau, out=tau)
+                np.exp(tau, out=tau)
+                x -= inf; x *= tau; x += inf
+            cminf, cmtau, chinf, chtau = ca_hva_rates(v[ca_rows])
+            ca_m += (1 - np.exp(-dt / cmtau)) * (cminf - ca_m)
+            ca_h += (1 - np.exp(-dt / chtau)) * (chinf - ca_h)
+            cai += cad_decay * (CAI0 - tau_cad * cad_scale * ica - cai)
+            syn_a *= decay1
+            syn_b *= decay2
+
+            above = v[0] >= AP_THRESH
+            spikes += above & ~firing
+            firing = above
+            np.maximum(ca_peak, cai[ca_out], out=ca_peak)
+            if record_ca:
+                ca_trace.append(cai[ca_out].copy())
+
+        results = {'ca_peak': ca_peak, 'spikes': spikes}
+        if record_ca:
+            results['ca'] = np.array(ca_trace).T
+        return results
+
+
+def _numpy_batch(model, batch, tstop=100):
+    onsets, w, params = batch
+    res = model.run(onsets, w, params, tstop=tstop)
+    return res['ca_peak'], res['spikes']
+
+
+def simulate_delay_line(weights, directions, dt_stim=3, batch_size=2000, params=None,
+                        tstop=100, celsius=30, dt=0.025, onsets=None, workers=1):
+    # core.cell_array.simulate_delay_line 的 numpy 版本, 返回一样的 ca_peak / spikes
+    # onsets: (N, 5) 的 NetStim 时间, 给了就不用 directions / dt_stim (比如加了抖动)
+    # workers > 1 时各批分给进程池 (core/sweep.py)
+    w = np.asarray(weights, dtype=float)
+    n_points = len(w)
+    w = _per_cell_weights(w, n_points)
+    if onsets is None:
+        directions = _per_cell(directions, n_points)
+        dts = _per_cell(dt_stim, n_points)
+        onsets = [delay_line_onsets(d, s) for d, s in zip(directions, dts)]
+    onsets = np.asarray(onsets, dtype=float)
+    params = {k: np.asarray(_per_cell(v, n_points), dtype=float) for k, v in (params or {}).items()}
+
+    size = _batch_size(n_points, batch_size, workers)
+    batches = [(onsets[start:stop], w[start:stop], {k: v[start:stop] for k, v in params.items()})
+               for start, stop in _batches(n_points, size)]
+    results = list(run_sweep(partial(_numpy_batch, tstop=tstop), batches,
+                             build=partial(BallStickBatch, celsius, dt), workers=workers))
+    ca_peak = np.concatenate([r[0] for r in results])
+    spikes = np.concatenate([r[1] for r in results]).astype(int)
+    return ca_peak, spikes
+
+
+if __name__ == '__main__':
+    # 和 NEURON 对拍: 随机的权重 / 方向 / 间隔 / 通道密度, 比较钙峰和胞体发放数, 顺便比速度
+    # 在仓库根目录下运行: python -m core.numpy_backend
+    import argparse
+    import time
+    from core.cell_array import simulate_delay_line as simulate_neuron
+    from core.env import setup
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--points', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=2000)
+    parser.add_argument('--rtol', type=float, default=1e-6)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    setup()
+    rng = np.random.default_rng(args.seed)
+    n = args.points
+    weights = rng.uniform(0.0005, 0.002, n)
+    directions = list(rng.choice(['preferred', 'null'], n))
+    dts = rng.choice([1, 2, 3, 4, 5], n)
+    params = {
+        'ca_bar': rng.uniform(0.005, 0.015, n),
+        'dend_na': rng.uniform(0.03, 0.07, n),
+        'tau_cad': rng.uniform(30, 70, n),
+    }
+
+    start = time.perf_counter()
+    ca_nrn, spikes_nrn = simulate_neuron(weights, directions, dt_stim=dts, params=params,
+                                         batch_size=100, warm=False)
+    nrn_time = time.perf_counter() - start
+    start = time.perf_counter()
+    ca_np, spikes_np = simulate_delay_line(weights, directions, dt_stim=dts, params=params,
+                                           batch_size=args.batch_size)
+    np_time = time.perf_counter() - start
+
+    rel_err = np.abs(ca_np - ca_nrn) / np.abs(ca_nrn)
+    mismatched = int(np.count_nonzero(spikes_np != spikes_nrn))
+    print(f"ca_peak max rel err {rel_err.max():.2e}, spike count mismatches {mismatched}/{n}")
+    print(f"NEURON {nrn_time / n * 1e3:.1f} ms/point, numpy {np_time / n * 1e3:.1f} ms/point "
+          f"({nrn_time / np_time:.1f}x)")
+    if rel_err.max() > args.rtol or mismatched:
+        raise RuntimeError(f"numpy backend differs from NEURON beyond rtol={args.rtol}")
@@ -0,0 +1,25 @@
+import importlib
+import os
+
+# import matplotlib.pyplot 要 0.3 s 以上, 进程池的 worker 和只查表的 agent 循环都用不到
+# 脚本里 from core.plotting import plt, 第一次真正画图时才 import;
+# 没有 DISPLAY 也没指定 MPLBACKEND 时用 Agg, 只存图不弹窗
+
+
+class _LazyPyplot:
+
+    _module = None
+
+    def _load(self):
+        if _LazyPyplot._module is None:
+            if not os.environ.get('DISPLAY') and 'MPLBACKEND' not in os.environ:
+                import matplotlib
+                matplotlib.use('Agg')
+            _LazyPyplot._module = importlib.import_module('matplotlib.pyplot')
+        return _LazyPyplot._module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+
+plt = _LazyPyplot()
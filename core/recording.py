@@ -0,0 +1,211 @@
+from neuron import h
+import numpy as np
+
+from core.integrator import record, sample_dt
+
+# 不存整条曲线的记录方式:
+#  - Tracker: 挂在 segment 上的 NMODL 点过程 (tracker.mod, 由 prepare_mod.py 生成),
+#    仿真过程中直接算 max / argmax / min / 积分 / 上穿阈值次数, 每个 trial 只占几个标量
+#  - WindowRecording: 只记 [t0, t1) 窗口里每隔 Dt 的样本, 和把整条曲线按 round(t/dt) 切片的结果一样
+#  - Recorder: 一个实验建一次的一组 Vector, 缓冲区预先分配好, 每个 trial 复用;
+#    view() 是 as_numpy() 的视图不复制, 需要留下每个 trial 的曲线时 store() 写进预先分配的 (trials, samples) 数组
+# 都在循环外建一次, 之后每个 trial 只读结果
+
+
+class Tracker:
+
+    def __init__(self, seg, var, window=None, thresh=0):
+        # var: segment 上的变量名, 例如 'cai' / 'v'
+        self.var = var
+        self.pp = h.Tracker(seg)
+        self.attach()
+        self.pp.thresh = thresh
+        self.set_window(window)
+
+    def attach(self):
+        # 指向点过程当前所在 segment 的 var; section 的 nseg 改了之后旧指针指到已经释放的内存, 要重新调用
+        h.setpointer(getattr(self.pp.get_segment(), '_ref_' + self.var), 'x', self.pp)
+
+    def set_window(self, window=None):
+        # None: 整个仿真
+        self.pp.tbegin, self.pp.tend = window if window is not None else (0, 1e9)
+
+    def reset(self):
+        # 和 INITIAL 一样清零, 不用 finitialize; 连续仿真里每个窗口开始前调用 (core/streaming.py)
+        pp = self.pp
+        pp.xmax, pp.tmax, pp.xmin, pp.tmin = -1e300, -1, 1e300, -1
+        pp.integral, pp.ncross, pp.nsamples = 0, 0, 0
+
+    @property
+    def max(self):
+        return self.pp.xmax
+
+    @property
+    def t_max(self):
+        return self.pp.tmax
+
+    @property
+    def min(self):
+        return self.pp.xmin
+
+    @property
+    def t_min(self):
+        return self.pp.tmin
+
+    @property
+    def integral(self):
+        # 梯形积分, 单位是 变量单位 * ms
+        return self.pp.integral
+
+    @property
+    def crossings(self):
+        return int(self.pp.ncross)
+
+    @property
+    def samples(self):
+        return int(self.pp.nsamples)
+
+    def result(self):
+        return {'max': self.max, 't_max': self.t_max, 'min': self.min, 't_min': self.t_min,
+                'integral': self.integral, 'crossings': self.crossings}
+
+
+class WindowRecording:
+
+    def __init__(self, ref, window=None, Dt=None):
+        # window: (t0, t1) ms, 默认整个仿真; Dt: 采样间隔, 默认每步
+        self.ref = ref
+        self.vec = h.Vector()
+        self.tvec = None
+        self.set_window(window, Dt)
+
+    def set_window(self, window=None, Dt=None):
+        if window is None:
+            # 不限窗口: 定步长下按 Dt 抽样, CVODE 下和 core.integrator.record 一样
+            self.tvec = None
+            if Dt is None:
+                self.vec = record(self.ref)
+            else:
+                self.vec = h.Vector().record(self.ref, Dt)
+            return
+        t0, t1 = window
+        Dt = Dt or h.dt
+        # 要一直留着 tvec, NEURON 只引用它
+        self.tvec = h.Vector(t0 + np.arange(int(round((t1 - t0) / Dt))) * Dt)
+        self.vec = h.Vector().record(self.ref, self.tvec)
+
+    def times(self):
+        return self.tvec.as_numpy() if self.tvec is not None else None
+
+    def values(self):
+        return self.vec.as_numpy()
+
+    def samples(self, tstop=None, Dt=None):
+        # 一次完整仿真记录的点数, 用来预先分配缓冲区
+        if self.tvec is not None:
+            return len(self.tvec)
+        tstop = h.tstop if tstop is None else tstop
+        return int(round(tstop / (Dt or sample_dt()))) + 1
+
+
+class Recorder:
+
+    def __init__(self, tstop=None, trials=None):
+        # tstop: 用来算缓冲区大小, 默认 h.tstop; trials: 给了就为每条曲线分配 (trials, samples) 的数组
+        self.tstop = tstop
+        self.trials = trials
+        self.recordings = {}
+        self.out = {}
+
+    def add(self, name, ref, window=None, Dt=None):
+        rec = WindowRecording(ref, window, Dt)
+        n = rec.samples(self.tstop, Dt)
+        # 预留容量, 之后每次仿真 record 都写在同一块内存里
+        rec.vec.buffer_size(n)
+        self.recordings[name] = rec
+        if self.trials is not None:
+            self.out[name] = np.full((self.trials, n), np.nan)
+        return rec
+
+    def view(self, name):
+        # 不复制; 只在下一次仿真之前有效, 要留下来就 store() 或者自己 copy
+        return self.recordings[name].vec.as_numpy()
+
+    def __getitem__(self, name):
+        return self.view(name)
+
+    def times(self, name):
+        return self.recordings[name].times()
+
+    def store(self, trial):
+        # 把这个 trial 的曲线写进 out[name][trial]; 比缓冲区短的 (例如 warm_run) 剩下的保持 NaN
+        for name, out in self.out.items():
+            v = self.view(name)
+            n = min(len(v), out.shape[1])
+            out[trial, :n] = v[:n]
+            out[trial, n:] = np.nan
+
+    def capacity(self):
+        return {name: int(rec.vec.buffer_size()) for name, rec in self.recordings.items()}
+
+
+if __name__ == '__main__':
+    # 检查: 每个 trial 新建 Vector + np.array 复制 和 Recorder 复用缓冲区 的分配量 / 耗时, 两者曲线一致
+    # 在仓库根目录下运行: python -m core.recording --trials 200
+    import argparse
+    import time
+    import tracemalloc
+    from search import build_model
+    from core.rig import SynapseRig
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--trials', type=int, default=200)
+    parser.add_argument('--tstop', type=float, default=100)
+    args = parser.parse_args()
+
+    soma, dend = build_model()
+    h.celsius = 30; h.v_init = -70; h.dt = 0.025; h.tstop = args.tstop
+    rig = SynapseRig(dend)
+    weights = np.linspace(0.0008, 0.0016, args.trials)
+    targets = {'v_soma': soma(0.5)._ref_v, 'cai': dend(1.0)._ref_cai}
+
+    def copy_loop():
+        out = {name: [] for name in targets}
+        for w in weights:
+            rig.set_weights(w)
+            vecs = {name: h.Vector().record(ref) for name, ref in targets.items()}
+            h.run()
+            for name, vec in vecs.items():
+                out[name].append(np.array(vec))
+        return {name: np.array(traces) for name, traces in out.items()}
+
+    def recorder_loop():
+        recorder = Recorder(trials=args.trials)
+        for name, ref in targets.items():
+            recorder.add(name, ref)
+        buffers = set()
+        for trial, w in enumerate(weights):
+            rig.set_weights(w)
+            h.run()
+            recorder.store(trial)
+            buffers.add(recorder.view('cai').__array_interface__['data'][0])
+        return recorder.out, len(buffers)
+
+    results = {}
+    for name, loop in [('np.array copy', copy_loop), ('Recorder', recorder_loop)]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        results[name] = loop()
+        wall = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        out = results[name][0] if name == 'Recorder' else results[name]
+        size = sum(a.nbytes for a in out.values())
+        print(f"{name}: {wall / args.trials * 1e3:.2f} ms/trial, peak traced {peak / 1024 ** 2:.1f} MB "
+              f"for {size / 1024 ** 2:.1f} MB of (trials, samples) output")
+
+    out, n_buffers = results['Recorder']
+    copied = results['np.array copy']
+    print(f"Recorder: {n_buffers} distinct buffer address(es) over {args.trials} trials")
+    for name in targets:
+        print(f"{name}: max abs diff {np.max(np.abs(out[name] - copied[name])):.3g}")
@@ -0,0 +1,123 @@
+from neuron import h
+import numpy as np
+
+from core.fingerprint import point_process_types
+
+# setup_synapses_weighted 每个 trial 都新建 5 组 Exp2Syn/NetStim/NetCon,
+# 这里只建一次, 之后每个 trial 原地改权重 / 时间 / 方向
+
+LOCS = [1.0, 0.8, 0.6, 0.4, 0.2]
+LATENCIES = [12, 9, 6, 3, 0]
+START_TIME = 20
+
+
+def delay_line_onsets(direction, dt_stim, start_time=START_TIME):
+    if direction == 'preferred':
+        # A->B->C->D->E
+        return [start_time + i * dt_stim for i in range(5)]
+    # E->D->C->B->A
+    return [start_time + (4 - i) * dt_stim for i in range(5)]
+
+
+def point_process_counts():
+    # 每种点过程 (Exp2Syn, NetStim, APCount ...) 当前活着的个数, 加上 NetCon
+    counts = {}
+    for name in point_process_types():
+        n = int(h.List(name).count())
+        if n:
+            counts[name] = n
+    counts['NetCon'] = int(h.List('NetCon').count())
+    return counts
+
+
+class SynapseRig:
+
+    def __init__(self, dend, weights=0.0, tau2=30):
+        self.syns = []
+        self.netstims = []
+        self.ncs = []
+        for i, loc in enumerate(LOCS):
+            syn = h.Exp2Syn(dend(loc))
+            syn.tau1 = 1; syn.tau2 = tau2; syn.e = 0
+            ns = h.NetStim()
+            ns.number = 1; ns.noise = 0
+            nc = h.NetCon(ns, syn)
+            nc.delay = LATENCIES[i]
+            self.syns.append(syn)
+            self.netstims.append(ns)
+            self.ncs.append(nc)
+        self.set_weights(weights)
+        self.set_direction('preferred', 3)
+
+    def set_weights(self, weights):
+        # 标量或者 5 个值
+        if np.ndim(weights) == 0:
+            weights = [weights] * 5
+        for nc, w in zip(self.ncs, weights):
+            nc.weight[0] = w
+
+    def set_onsets(self, onsets):
+        for ns, t in zip(self.netstims, onsets):
+            ns.start = t
+
+    def set_direction(self, direction, dt_stim):
+        self.set_onsets(delay_line_onsets(direction, dt_stim))
+
+    def jitter(self, sigma, rng=np.random):
+        # 和 run_jitter_test 一样, 在当前时间上逐个加高斯噪声
+        for ns in self.netstims:
+            ns.start += rng.normal(0, sigma)
+
+    def set(self, direction, dt_stim, weights):
+        # setup_synapses_weighted 的原地版本
+        self.set_direction(direction, dt_stim)
+        self.set_weights(weights)
+
+    def onsets(self):
+        return [ns.start for ns in self.netstims]
+
+    def weights(self):
+        return [nc.weight[0] for nc in self.ncs]
+
+
+if __name__ == '__main__':
+    # 检查: 几千个 trial 下来活着的点过程个数不变, 顺便和每次新建的写法比一下速度
+    # 在仓库根目录下运行: python -m core.rig
+    import argparse
+    import time
+    from search import build_model, setup_synapses_weighted
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--trials', type=int, default=2000)
+    parser.add_argument('--tstop', type=float, default=5)
+    args = parser.parse_args()
+
+    soma, dend = build_model()
+    h.celsius = 30; h.v_init = -70; h.tstop = args.tstop
+    rng = np.random.default_rng(0)
+
+    rig = SynapseRig(dend)
+    before = point_process_counts()
+    start = time.perf_counter()
+    for trial in range(args.trials):
+        rig.set(rng.choice(['preferred', 'null']), 3, rng.uniform(0.0008, 0.0016))
+        rig.jitter(1.0, rng)
+        h.run()
+        if trial % 500 == 0 and point_process_counts() != before:
+            raise RuntimeError(f"point process count changed at trial {trial}: "
+                               f"{point_process_counts()} != {before}")
+    rig_time = time.perf_counter() - start
+    after = point_process_counts()
+    if after != before:
+        raise RuntimeError(f"point process count changed: {after} != {before}")
+    print(f"SynapseRig: {args.trials} trials, counts flat {after}, {rig_time / args.trials * 1e3:.2f} ms/trial")
+
+    del rig
+    start = time.perf_counter()
+    for trial in range(args.trials):
+        syns, nss, ncs = setup_synapses_weighted(dend, rng.choice(['preferred', 'null']), 3,
+                                                 [rng.uniform(0.0008, 0.0016)] * 5)
+        h.run()
+        del syns, nss, ncs
+    rebuild_time = time.perf_counter() - start
+    print(f"setup_synapses_weighted: {rebuild_time / args.trials * 1e3:.2f} ms/trial")
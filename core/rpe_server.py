@@ -0,0 +1,294 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from functools import partial
+
+import numpy as np
+
+from core.cell_array import AGENT_PARAMS, CellArray, _rpe_batch
+from core.sweep import default_workers, pool_task, worker_pool
+
+# 本地 RPE 服务: 别的进程 (任务环境 / 语言模型策略) 不用自己嵌 NEURON, 通过 socket 问 calculate_rpe_signal 的结果
+#  - 协议: 每行一个 JSON, 请求 {"id": ..., "confidence": 0.8, "is_correct": true},
+#    回复 {"id": ..., "rpe": -0.78, "cached": false}, 出错时 {"id": ..., "error": "..."}; 同一个连接上可以连着发, 回复按完成顺序
+#  - confidence 按 quantum (1e-3, 和 RPETable 一样) 量化; 前面是 LRU 结果缓存, 已经在排队 / 在算的同一个 key 只算一次
+#  - 没命中的请求排队, 等 batch_window 或攒够 max_batch 个, 且有空闲 worker 时一起交给进程池: 一批一个 CellArray,
+#    一次 h.run() (core/cell_array.py 的 _rpe_batch); worker 都忙时队列里的请求继续攒, 负载越高批越大
+#  - CellArray 的细胞数取不小于这批请求数的 2 的幂, 不够的补空细胞; 细胞数变了才 resize
+# 在仓库根目录下运行:
+#   python -m core.rpe_server serve --port 8765            (或 --unix /tmp/rpe.sock)
+#   python -m core.rpe_server bench --clients 64 --requests 20   (起一个服务 + 负载生成器, 报告 p50 / p99 延迟和吞吐)
+
+QUANTUM = 1e-3
+
+
+def _bucket(n, max_batch):
+    size = 1
+    while size < n:
+        size *= 2
+    return min(size, max(max_batch, n))
+
+
+def _serve_batch(cells, batch, max_batch=64, celsius=6.3):
+    # 在 worker 里: cells 是 worker 启动时建的 CellArray
+    size = _bucket(len(batch[0]), max_batch)
+    if cells.n != size:
+        cells.resize(size)
+    return _rpe_batch(cells, batch, celsius=celsius).tolist()
+
+
+class RPEServer:
+
+    def __init__(self, workers=None, batch_window=0.002, max_batch=64, cache_size=100000, quantum=QUANTUM,
+                 celsius=6.3, params=None):
+        # batch_window: 第一个请求到了之后等多久再发这一批 (s); cache_size=0 时不缓存
+        self.workers = workers or default_workers()
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.cache_size = cache_size
+        self.quantum = quantum
+        self.celsius = celsius
+        self.params = dict(AGENT_PARAMS, **(params or {}))
+        self.cache = OrderedDict()
+        self.pending = {}
+        self.queue = []
+        self.batch_sizes = []
+        self.stats = {'requests': 0, 'hit': 0, 'coalesced': 0, 'simulated': 0, 'batches': 0, 'errors': 0}
+        self.pool = None
+        self._ready = None
+        self._slots = None
+        self._dispatcher = None
+
+    async def start(self):
+        self.pool = worker_pool(partial(CellArray, 1, self.params), self.workers)
+        self._ready = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.workers)
+        self._dispatcher = asyncio.create_task(self._dispatch())
+        # 先让每个 worker 启动好 (import + 建模型), 不算进第一个请求的延迟
+        await asyncio.gather(*[self._simulate([0.4], [False]) for _ in range(self.workers)])
+
+    async def close(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def _key(self, confidence, is_correct):
+        return int(round(float(confidence) / self.quantum)), bool(is_correct)
+
+    async def rpe(self, confidence, is_correct):
+        # 返回 (rpe, 是否命中缓存)
+        self.stats['requests'] += 1
+        key = self._key(confidence, is_correct)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            self.stats['hit'] += 1
+            return self.cache[key], True
+        future = self.pending.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.pending[key] = future
+            self.queue.append(key)
+            self._ready.set()
+        else:
+            self.stats['coalesced'] += 1
+        return await asyncio.shield(future), False
+
+    async def _simulate(self, conf, correct):
+        loop = asyncio.get_running_loop()
+        task = pool_task(partial(_serve_batch, max_batch=self.max_batch, celsius=self.celsius))
+        return await loop.run_in_executor(self.pool, task, (conf, correct))
+
+    async def _dispatch(self):
+        while True:
+            await self._ready.wait()
+            if len(self.queue) < self.max_batch:
+                await asyncio.sleep(self.batch_window)
+            await self._slots.acquire()
+            keys, self.queue = self.queue[:self.max_batch], self.queue[self.max_batch:]
+            if not self.queue:
+                self._ready.clear()
+            asyncio.create_task(self._run_batch(keys))
+
+    async def _run_batch(self, keys):
+        try:
+            values = await self._simulate([k * self.quantum for k, _ in keys], [ok for _, ok in keys])
+        except Exception as e:
+            self.stats['errors'] += len(keys)
+            for key in keys:
+                self.pending.pop(key).set_exception(e)
+            return
+        finally:
+            self._slots.release()
+        self.stats['batches'] += 1
+        self.stats['simulated'] += len(keys)
+        self.batch_sizes.append(len(keys))
+        for key, value in zip(keys, values):
+            if self.cache_size:
+                self.cache[key] = value
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            self.pending.pop(key).set_result(value)
+
+    async def _handle(self, request, writer):
+        try:
+            value, cached = await self.rpe(request['confidence'], request['is_correct'])
+            reply = {'id': request.get('id'), 'rpe': value, 'cached': cached}
+        except Exception as e:
+            reply = {'id': request.get('id'), 'error': f'{type(e).__name__}: {e}'}
+        writer.write((json.dumps(reply) + '\n').encode())
+
+    async def _connection(self, reader, writer):
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                except ValueError as e:
+                    writer.write((json.dumps({'id': None, 'error': f'bad request: {e}'}) + '\n').encode())
+                    continue
+                task = asyncio.create_task(self._handle(request, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def listen(self, host='127.0.0.1', port=8765, unix=None):
+        # 返回 asyncio 的 Server; port=0 时系统挑一个空闲端口
+        if unix is not None:
+            return await asyncio.start_unix_server(self._connection, path=unix)
+        return await asyncio.start_server(self._connection, host, port)
+
+
+class RPEClient:
+    # asyncio 客户端: 一个连接, 请求可以并发, 按 id 对回复
+
+    def __init__(self, reader, writer):
+        self.reader, self.writer = reader, writer
+        self.futures = {}
+        self._ids = iter(range(10**12))
+        self._reader_task = asyncio.create_task(self._read())
+
+    @classmethod
+    async def connect(cls, host='127.0.0.1', port=8765, unix=None):
+        if unix is not None:
+            reader, writer = await asyncio.open_unix_connection(unix)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def _read(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                break
+            reply = json.loads(line)
+            future = self.futures.pop(reply['id'])
+            if 'error' in reply:
+                future.set_exception(RuntimeError(reply['error']))
+            else:
+                future.set_result(reply)
+
+    async def rpe(self, confidence, is_correct):
+        # 返回回复的 dict: {'id', 'rpe', 'cached'}
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self.futures[request_id] = future
+        self.writer.write((json.dumps({'id': request_id, 'confidence': float(confidence),
+                                       'is_correct': bool(is_correct)}) + '\n').encode())
+        return await future
+
+    async def close(self):
+        self.writer.close()
+        self._reader_task.cancel()
+
+
+async def load_test(server, clients=64, requests=20, distinct=0, seed=0, host='127.0.0.1'):
+    # clients 个连接, 每个连接顺序发 requests 个请求 (上一个回来再发下一个);
+    # distinct > 0 时 confidence 只从 distinct 个值里挑 (可以命中缓存), 否则是 [0.4, 1.0] 里的连续值
+    listener = await server.listen(host, 0)
+    port = listener.sockets[0].getsockname()[1]
+    values = np.linspace(0.4, 1.0, distinct) if distinct else None
+    latencies = []
+
+    async def client(i):
+        c = await RPEClient.connect(host, port)
+        r = np.random.default_rng([seed, i])
+        for _ in range(requests):
+            conf = r.choice(values) if values is not None else r.uniform(0.4, 1.0)
+            start = time.perf_counter()
+            await c.rpe(conf, r.random() < 0.5)
+            latencies.append(time.perf_counter() - start)
+        await c.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client(i) for i in range(clients)])
+    wall = time.perf_counter() - start
+    listener.close()
+    await listener.wait_closed()
+    lat = np.array(latencies) * 1e3
+    return {'requests': len(lat), 'wall_s': wall, 'throughput': len(lat) / wall,
+            'p50_ms': float(np.percentile(lat, 50)), 'p99_ms': float(np.percentile(lat, 99)),
+            'mean_batch': float(np.mean(server.batch_sizes)) if server.batch_sizes else 0.0,
+            'stats': dict(server.stats)}
+
+
+async def _serve(args):
+    server = RPEServer(args.workers, args.batch_window_ms / 1e3, args.max_batch, args.cache_size)
+    await server.start()
+    listener = await server.listen(port=args.port, unix=args.unix)
+    print(f"RPE server on {args.unix or f'127.0.0.1:{args.port}'}, {server.workers} worker(s)")
+    try:
+        async with listener:
+            await listener.serve_forever()
+    finally:
+        await server.close()
+
+
+async def _bench(args):
+    server = RPEServer(args.workers, args.batch_window_ms / 1e3, args.max_batch, args.cache_size)
+    await server.start()
+    # start() 里预热 worker 的那几批不算
+    server.batch_sizes.clear()
+    server.stats = dict.fromkeys(server.stats, 0)
+    try:
+        r = await load_test(server, args.clients, args.requests, args.distinct, args.seed)
+    finally:
+        await server.close()
+    s = r['stats']
+    print(f"{args.clients} clients x {args.requests} requests, {server.workers} worker(s), "
+          f"batch window {args.batch_window_ms:g} ms, max batch {args.max_batch}, cache {args.cache_size}")
+    print(f"throughput {r['throughput']:.1f} req/s, latency p50 {r['p50_ms']:.1f} ms, p99 {r['p99_ms']:.1f} ms, "
+          f"wall {r['wall_s']:.2f} s")
+    print(f"cache hits {s['hit']}, coalesced {s['coalesced']}, simulated {s['simulated']} in {s['batches']} batches "
+          f"(mean {r['mean_batch']:.1f} per batch), errors {s['errors']}")
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='command', required=True)
+    for name in ('serve', 'bench'):
+        p = sub.add_parser(name)
+        p.add_argument('--workers', type=int, default=None)
+        p.add_argument('--batch-window-ms', type=float, default=2)
+        p.add_argument('--max-batch', type=int, default=64)
+        p.add_argument('--cache-size', type=int, default=100000, help='0: 不缓存')
+    serve = sub.choices['serve']
+    serve.add_argument('--port', type=int, default=8765)
+    serve.add_argument('--unix', default=None)
+    bench = sub.choices['bench']
+    bench.add_argument('--clients', type=int, default=64)
+    bench.add_argument('--requests', type=int, default=20)
+    bench.add_argument('--distinct', type=int, default=0, help='confidence 只取这么多个值, 0: 连续值')
+    bench.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    asyncio.run(_serve(args) if args.command == 'serve' else _bench(args))
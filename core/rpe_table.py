@@ -0,0 +1,133 @@
+import json
+import os
+import numpy as np
+from neuron import h
+
+from core.fingerprint import CACHE_DIR, fingerprint, model_fingerprint
+
+# calculate_rpe_signal 是确定性的, 结果只取决于模型 + (confidence, is_correct)
+# 这里按 confidence 网格预先算好存盘, agent 循环里直接查表
+
+DEFAULT_GRID = np.round(np.arange(0.4, 1.0 + 1e-9, 0.05), 2)
+
+# learn.py / llama.py 里 calculate_rpe_signal 的协议, 改了协议就要改这里
+RPE_PROTOCOL = {'clamp': 'SEClamp soma(0.5) -70+25*conf', 'reward': 'Exp2Syn dend(0.8) t=40 w=0.005',
+                'dt': 0.025, 'tstop': 100, 'window': [41, 50]}
+
+# 相邻网格点间距不超过 MAX_GAP 时线性插值; 0.05 网格上插值误差 < 0.03 mV
+# (is_correct=False 时 < 0.001 mV), 远小于 agent 的 -1.0 mV 切换阈值
+MAX_GAP = 0.05
+
+
+class RPETable:
+
+    def __init__(self, soma, dend, simulate, grid=DEFAULT_GRID, max_gap=MAX_GAP,
+                 quantum=1e-3, cache_dir=CACHE_DIR, spec=None):
+        # simulate(confidence, is_correct) -> peak_rpe, 只在查不到时调用
+        # spec: 模型的 ModelSpec (core/model.py), 给了就用 spec.key() 当模型的指纹, 不用逐个 segment 读参数
+        self.simulate = simulate
+        self.max_gap = max_gap
+        self.quantum = quantum
+        if spec is not None:
+            self.fingerprint = fingerprint({'spec': spec.key(), 'protocol': RPE_PROTOCOL, 'celsius': h.celsius})
+        else:
+            self.fingerprint = model_fingerprint([soma, dend], protocol=RPE_PROTOCOL, celsius=h.celsius)
+        self.path = None
+        if cache_dir is not None:
+            self.path = os.path.join(cache_dir, f'rpe_table_{self.fingerprint}.json')
+        self.entries = {True: {}, False: {}}
+        self.stats = {'hit': 0, 'interpolated': 0, 'simulated': 0}
+        self.load()
+        self.populate(grid)
+
+    def _key(self, confidence):
+        # 0.8 + 0.1 这种浮点误差量化掉
+        return int(round(confidence / self.quantum))
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            data = json.load(f)
+        if data.get('fingerprint') != self.fingerprint:
+            return
+        for name, ok in [('correct', True), ('wrong', False)]:
+            self.entries[ok] = {int(k): v for k, v in data[name].items()}
+
+    def save(self):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        data = {
+            'fingerprint': self.fingerprint,
+            'quantum': self.quantum,
+            'correct': {str(k): v for k, v in sorted(self.entries[True].items())},
+            'wrong': {str(k): v for k, v in sorted(self.entries[False].items())},
+        }
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp, self.path)
+
+    def populate(self, grid):
+        missing = [(c, ok) for c in grid for ok in (True, False) if self._key(c) not in self.entries[ok]]
+        for c, ok in missing:
+            self.entries[ok][self._key(c)] = float(self.simulate(c, ok))
+            self.stats['simulated'] += 1
+        if missing:
+            self.save()
+
+    def lookup(self, confidence, is_correct):
+        ok = bool(is_correct)
+        table = self.entries[ok]
+        k = self._key(confidence)
+        if k in table:
+            self.stats['hit'] += 1
+            return table[k]
+
+        lo = max((x for x in table if x < k), default=None)
+        hi = min((x for x in table if x > k), default=None)
+        if lo is not None and hi is not None and (hi - lo) * self.quantum <= self.max_gap + 1e-9:
+            self.stats['interpolated'] += 1
+            frac = (k - lo) / (hi - lo)
+            return table[lo] + frac * (table[hi] - table[lo])
+
+        # 网格外或者间隔太大, 老老实实仿真一次并存起来
+        value = float(self.simulate(k * self.quantum, ok))
+        table[k] = value
+        self.stats['simulated'] += 1
+        self.save()
+        return value
+
+    def _covered(self, ok, ks):
+        # ks (整数 key) 里哪些能直接查到或者插值
+        keys = np.array(sorted(self.entries[ok]), dtype=np.int64)
+        if not len(keys):
+            return np.zeros(len(ks), dtype=bool)
+        pos = np.searchsorted(keys, ks)
+        hi = keys[np.minimum(pos, len(keys) - 1)]
+        lo = keys[np.maximum(pos - 1, 0)]
+        exact = hi == ks
+        inside = (pos > 0) & (pos < len(keys)) & ((hi - lo) * self.quantum <= self.max_gap + 1e-9)
+        return exact | inside
+
+    def lookup_many(self, confidence, is_correct):
+        # lookup 的 numpy 版, confidence / is_correct 是数组; 结果和逐个 lookup 一样
+        # 查不到又不能插值的 confidence 先逐个 lookup (仿真一次存进表), 剩下的全用 np.interp
+        k = np.rint(np.asarray(confidence, dtype=float) / self.quantum).astype(np.int64)
+        is_correct = np.broadcast_to(np.asarray(is_correct, dtype=bool), k.shape)
+        out = np.empty(k.shape)
+        for ok in (True, False):
+            mask = is_correct == ok
+            if not mask.any():
+                continue
+            ks = np.unique(k[mask])
+            for missing in ks[~self._covered(ok, ks)].tolist():
+                self.lookup(missing * self.quantum, ok)
+            keys = np.array(sorted(self.entries[ok]), dtype=np.int64)
+            values = np.array([self.entries[ok][key] for key in keys.tolist()])
+            out[mask] = np.interp(k[mask], keys, values)
+            hit = int(np.isin(k[mask], keys).sum())
+            self.stats['hit'] += hit
+            self.stats['interpolated'] += int(mask.sum()) - hit
+        return out
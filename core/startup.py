@@ -0,0 +1,72 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from core.env import ROOT
+
+# 启动时间: 每个模块在新的解释器里 import 一次要多久, 顺带看有没有把 matplotlib / IPython 拉进来;
+# 再量一下进程池从提交到拿回第一个结果要多久
+# 在仓库根目录下运行: python -m core.startup
+
+MODULES = ['core.env', 'core.cell_array', 'phase2_tuning', 'search', 'train.train', 'phase3_final',
+           'learn', 'llama']
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+{stmt}
+print(json.dumps({{'import_ms': (time.perf_counter() - start) * 1e3,
+                  'matplotlib': 'matplotlib' in sys.modules, 'IPython': 'IPython' in sys.modules}}))
+"""
+
+
+def import_time(stmt, repeat=3, env=None):
+    # 取几次里最快的一次, 减少磁盘缓存的影响; 另外记整个进程 (含解释器启动) 的时间
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = subprocess.run([sys.executable, '-c', _PROBE.format(stmt=stmt)], cwd=ROOT, capture_output=True,
+                             text=True, env=dict(os.environ, PYTHONPATH=ROOT, **(env or {})), check=True)
+        wall = (time.perf_counter() - start) * 1e3
+        res = json.loads(out.stdout.strip().splitlines()[-1])
+        res['process_ms'] = wall
+        if best is None or res['import_ms'] < best['import_ms']:
+            best = res
+    return best
+
+
+def _noop(model, point):
+    return point
+
+
+def pool_latency(workers):
+    # spawn 的 worker: 启动解释器 + import core + setup(), 到第一个结果回来
+    from core.sweep import run_sweep
+    start = time.perf_counter()
+    results = run_sweep(_noop, range(workers), workers=workers)
+    next(results)
+    first = time.perf_counter() - start
+    list(results)
+    return first * 1e3, (time.perf_counter() - start) * 1e3
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=2)
+    args = parser.parse_args()
+
+    # 参照: 原来的 from neuron import h, gui (带 GUI, 会 import IPython)
+    ref = import_time('from neuron import h, gui', args.repeat, env={'NEURON_MODULE_OPTIONS': ''})
+    print(f"{'module':<36}{'import (ms)':>12}{'process (ms)':>14}  extra imports")
+    rows = [('from neuron import h, gui', ref)]
+    rows += [(name, import_time(f'import {name}', args.repeat)) for name in MODULES]
+    for name, res in rows:
+        extra = ', '.join(m for m in ('matplotlib', 'IPython') if res[m]) or '-'
+        print(f"{name:<36}{res['import_ms']:>12.0f}{res['process_ms']:>14.0f}  {extra}")
+
+    first, total = pool_latency(args.workers)
+    print(f"process pool ({args.workers} workers): first result {first:.0f} ms, all {total:.0f} ms")
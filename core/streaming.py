@@ -0,0 +1,114 @@
+from neuron import h
+
+from core.recording import Tracker
+
+# 连续仿真的 RPE: 模型只 finitialize 一次, 之后每个 trial 是接着往下算的一段时间 [t0, t0 + period)
+#  - 钳位 (SEClamp) / 奖励突触 (Exp2Syn + 没有源的 NetCon) / Tracker 都只建一次;
+#    trial 开始时直接改钳位电压和 NetCon 权重, 奖励用 nc.event(t0 + reward_time) 投递
+#  - RPE 峰值由 Tracker 在 [t0 + 41, t0 + 50) 里算, 每个 trial 只 reset 几个标量, 内存不随 trial 数增长
+#  - 默认 period = 50: 读完窗口就开始下一个 trial, 下一个 trial 的钳位在奖励前有 40 ms 稳定, 和 calculate_rpe_signal 的协议一样
+#  - carry_over=False 时每个 trial 开始把树突的 cai 设回 cai0 (上一个 trial 的钙不带过来), 电压和门控变量总是接着上一个 trial;
+#    carry_over=True 时钙也接着算
+# 和每个 trial 都 finitialize 的 calculate_rpe_signal 比, 前一个 trial 的 EPSP / 钙还没完全衰减, 结果会差一点,
+# python -m core.streaming 报告差多少
+
+REWARD_WEIGHT = 0.005
+SOMA_REST = -70
+
+
+class StreamingRPE:
+
+    def __init__(self, soma, dend, period=50, reward_time=40, window=(41, 50), reward_pos=0.8,
+                 carry_over=False, v_init=-70, dt=0.025):
+        self.soma, self.dend = soma, dend
+        self.period = period
+        self.reward_time = reward_time
+        self.window = window
+        self.carry_over = carry_over
+        self.clamp = h.SEClamp(soma(0.5))
+        self.clamp.dur1, self.clamp.rs = 1e9, 1e-3
+        self.clamp.amp1 = v_init
+        self.syn = h.Exp2Syn(dend(reward_pos))
+        self.syn.tau1, self.syn.tau2 = 1, 20
+        self.nc = h.NetCon(None, self.syn)
+        self.nc.delay = 0
+        self.tracker = Tracker(dend(0.01), 'v')
+        # 有 cad 的 segment, 不带钙时每个 trial 开始把 cai 设回去
+        self.ca_segments = [seg for sec in (soma, dend) for seg in sec if hasattr(seg, 'cad')]
+        self.trials = 0
+        h.dt = dt
+        h.finitialize(v_init)
+
+    def _reset_calcium(self):
+        for seg in self.ca_segments:
+            seg.cai = seg.cai0_cad
+
+    def trial(self, confidence, is_correct):
+        # 和 calculate_rpe_signal(soma, dend, confidence, is_correct) 一样的协议, 返回 RPE 峰值 (mV)
+        t0 = h.t
+        soma_voltage = SOMA_REST + 25 * confidence
+        if not self.carry_over:
+            self._reset_calcium()
+        self.clamp.amp1 = soma_voltage
+        if is_correct:
+            self.nc.weight[0] = REWARD_WEIGHT
+            self.nc.event(t0 + self.reward_time)
+        self.tracker.reset()
+        self.tracker.set_window((t0 + self.window[0], t0 + self.window[1]))
+        h.continuerun(t0 + self.period)
+        self.trials += 1
+        return self.tracker.max - soma_voltage
+
+    def close(self):
+        # 删掉钳位 / 突触 / Tracker, 模型回到没有 stream 的样子
+        self.clamp = self.syn = self.nc = self.tracker = None
+
+
+if __name__ == '__main__':
+    # 连续跑很多个 trial: 每一段的 trials/s 和 RSS 应该都不变; 和 RPE 表 (每个 trial 都 finitialize) 的差别
+    # 在仓库根目录下运行: python -m core.streaming --trials 20000 --chunk 2000 [--carry-over]
+    import argparse
+    import resource
+    import time
+    import numpy as np
+    from core.model import AGENT_SPEC, build_model
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--trials', type=int, default=5000)
+    parser.add_argument('--chunk', type=int, default=500)
+    parser.add_argument('--carry-over', action='store_true')
+    parser.add_argument('--d-lambda', type=float, default=None, help='按 d_lambda 选树突 nseg, 默认 51')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    spec = AGENT_SPEC if args.d_lambda is None else AGENT_SPEC.with_d_lambda(args.d_lambda)
+    soma, dend = build_model(spec)
+    stream = StreamingRPE(soma, dend, carry_over=args.carry_over)
+    rng = np.random.default_rng(args.seed)
+    grid = np.round(np.arange(0.4, 1.0 + 1e-9, 0.05), 2)
+    confidence = rng.choice(grid, args.trials)
+    is_correct = rng.random(args.trials) < 0.5
+    rpe = np.empty(args.trials)
+    print(f"dend nseg {spec.dend_nseg}, period {stream.period:g} ms, carry-over {args.carry_over}")
+    print(f"{'trials':>9}{'trials/s':>10}{'sim ms/s':>10}{'RSS MB':>8}")
+    for start in range(0, args.trials, args.chunk):
+        t = time.perf_counter()
+        for i in range(start, min(start + args.chunk, args.trials)):
+            rpe[i] = stream.trial(confidence[i], is_correct[i])
+        n = min(args.chunk, args.trials - start)
+        wall = time.perf_counter() - t
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"{start + n:>9}{n / wall:>10.1f}{n * stream.period / wall:>10.0f}{rss:>8.1f}")
+
+    # 参照: 同样的 (confidence, 对错) 每个 trial 都从 finitialize 开始 (learn.py 的 calculate_rpe_signal)
+    from learn import calculate_rpe_signal
+    stream.close()
+    ref = {}
+    for c in grid:
+        for ok in (True, False):
+            ref[c, ok] = calculate_rpe_signal(soma, dend, c, ok, warm=False)
+    diff = np.array([rpe[i] - ref[confidence[i], is_correct[i]] for i in range(args.trials)])
+    for ok in (True, False):
+        d = np.abs(diff[is_correct == ok])
+        print(f"{'correct' if ok else 'wrong'} trials: |streaming - re-initialized| mean {d.mean():.3g} mV, "
+              f"max {d.max():.3g} mV")
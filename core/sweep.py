@@ -0,0 +1,75 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+from core import integrator
+from core.env import setup
+
+# 参数点之间互相独立, 分给进程池去算:
+#  - 每个 worker 启动时加载一次机制, 调一次 build() 建模型, 之后所有参数点复用
+#  - 结果按提交顺序一个个 yield 回来, 不用等整个 sweep 结束
+#  - 每个参数点都从 finitialize 重新开始, 结果和 worker 数无关
+# 用 spawn 而不是 fork: fork 出来的 worker 会带着主进程里已经建好的 section 一起积分
+# threads > 1: 每个 worker 建好模型之后开这么多线程 (core/threads.py), 核比参数点多时用, 见 threads.plan()
+# spawn 的 worker 是新的解释器, 主进程的积分器设置 (CVODE / 容差, core/integrator.py) 要带过去再 configure 一次
+
+_model = None
+
+
+def _build(build, threads, settings=None):
+    setup()
+    model = build() if build is not None else None
+    if settings is not None:
+        # 模型建好之后再设: 没有 section 时 NEURON 不理 use_local_dt(1)
+        integrator.configure(**settings)
+    if threads > 1:
+        from core.threads import use_threads
+        use_threads(threads)
+    return model
+
+
+def _init_worker(build, threads=1, settings=None):
+    global _model
+    _model = _build(build, threads, settings)
+
+
+def _call(task, point):
+    return task(_model, point)
+
+
+def default_workers():
+    return os.cpu_count() or 1
+
+
+def worker_pool(build=None, workers=None, threads=1):
+    # 和 run_sweep 一样的 worker (启动时 build() 一次), 给要自己提交任务的调用方 (core/rpe_server.py);
+    # pool.submit(pool_task(task), point) 在 worker 里调用 task(model, point)
+    ctx = multiprocessing.get_context('spawn')
+    return ProcessPoolExecutor(workers or default_workers(), mp_context=ctx, initializer=_init_worker,
+                               initargs=(build, threads, integrator.settings()))
+
+
+def pool_task(task):
+    return partial(_call, task)
+
+
+def run_sweep(task, points, build=None, workers=None, chunksize=1, threads=1):
+    # task(model, point) -> result, model 是 build() 的返回值
+    # task / build 要能 pickle: 模块级函数或者 functools.partial
+    # workers <= 1 时在当前进程里按顺序算 (threads > 1 时当前进程的线程数之后就不能再改了)
+    points = list(points)
+    if workers is None:
+        workers = default_workers()
+    workers = min(workers, len(points))
+    if workers <= 1:
+        # 和 worker 一样先确认机制和 stdrun 已加载
+        model = _build(build, threads)
+        for point in points:
+            yield task(model, point)
+        return
+
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(workers, mp_context=ctx, initializer=_init_worker,
+                             initargs=(build, threads, integrator.settings())) as ex:
+        yield from ex.map(partial(_call, task), points, chunksize=chunksize)
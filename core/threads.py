@@ -0,0 +1,244 @@
+from neuron import h
+
+from core.sweep import default_workers
+
+# 一个进程里多线程积分 (ParallelContext.nthread):
+#  - 每个线程积分一部分树 (根 section 由 pc.partition 指定), 很多小细胞时整棵树按 compartment 数用
+#    LPT (最大的先放, 放进当前最空的线程) 分, 和 NEURON loadbal.hoc 的 thread_partition 一样
+#  - 只有一个大细胞时用 multisplit 在分叉点把树切开, 切下来的块各自是一棵树, 在切点上用同一个 sid 连回去
+#    最多两个切点 (NEURON 的限制); 在子树最大的那些分叉点里挑一个或一对, 让最大的一块最小
+#  - 在 NEURON 9.0 上试出来只有两种排法和不切的结果一致, 别的排法 (一个线程放多块、根那块不在 0 号线程)
+#    能跑但结果是错的, 所以只用这两种:
+#      每块一个线程, 根那块在 0 号线程 (线程可以有空的)
+#      只有一个切点, 块数 = 线程数 + 1, 0 号线程放根那块和最小的一块
+#  - 多线程时 NEURON 要求所有 NetCon 的延迟都大于 dt (同一个线程里的也一样); delay line 的 NetStim -> Exp2Syn
+#    有 0 延迟的, 所以 CellArray 的 sweep 还是只用进程池, 线程给用 IClamp / 有延迟的输入驱动的大细胞
+#  - nthread / multisplit 设了之后这个进程里不能再改, 要比较不同线程数时每种开一个新进程 (见 __main__)
+# 参数点之间互相独立的 sweep 用进程池 (core/sweep.py) 几乎线性加速; plan() 先分进程, 核比参数点多时剩下的给线程
+
+# 每个线程每步至少这么多 compartment 才值得开线程: 每步线程之间要同步一次 (几 us 到十几 us),
+# hh 的 compartment 每步大约 0.2 us
+MIN_COMPARTMENTS_PER_THREAD = 200
+# 挑切点时只看子树最大的这么多个分叉点 (两两组合)
+SPLIT_CANDIDATES = 16
+
+
+def plan(n_points, compartments, cores=None, min_per_thread=MIN_COMPARTMENTS_PER_THREAD):
+    # 返回 (workers, threads): n_points 个互相独立的仿真, 每个 compartments 个 compartment
+    cores = cores or default_workers()
+    workers = max(1, min(cores, n_points))
+    threads = max(1, min(cores // workers, compartments // min_per_thread))
+    return workers, threads
+
+
+def _children(sections):
+    # {(section, x): [接在这个节点上的子 section]}
+    out = {}
+    for sec in sections:
+        seg = sec.parentseg()
+        if seg is not None:
+            out.setdefault((seg.sec, seg.x), []).append(sec)
+    return out
+
+
+def _root(sec):
+    while sec.parentseg() is not None:
+        sec = sec.parentseg().sec
+    return sec
+
+
+def pieces(sections, splits=()):
+    # 在 splits [(section, x)] 这些节点处切开之后的块: [(块的根 section, compartment 数)]
+    cut = set(splits)
+    root_of = {}
+
+    def root(sec):
+        if sec not in root_of:
+            seg = sec.parentseg()
+            root_of[sec] = sec if seg is None or (seg.sec, seg.x) in cut else root(seg.sec)
+        return root_of[sec]
+
+    sizes = {}
+    for sec in sections:
+        r = root(sec)
+        sizes[r] = sizes.get(r, 0) + sec.nseg
+    return list(sizes.items())
+
+
+def lpt(sizes, n):
+    # 返回每一块分到的线程号, 和每个线程的总量
+    load = [0] * n
+    assign = [0] * len(sizes)
+    for i in sorted(range(len(sizes)), key=lambda i: -sizes[i]):
+        j = load.index(min(load))
+        assign[i] = j
+        load[j] += sizes[i]
+    return assign, load
+
+
+def _layout(parts, splits, nthread):
+    # parts[0] 是根那块; 返回每块的线程号, 不是上面两种排法时 None
+    if len(parts) <= nthread:
+        return list(range(len(parts)))
+    if len(splits) == 1 and len(parts) == nthread + 1:
+        smallest = min(range(1, len(parts)), key=lambda i: parts[i][1])
+        others = iter(range(1, nthread))
+        return [0 if i in (0, smallest) else next(others) for i in range(len(parts))]
+    return None
+
+
+def _load(parts, assign, nthread):
+    load = [0] * nthread
+    for (_, n), j in zip(parts, assign):
+        load[j] += n
+    return load
+
+
+def best_split(sections, nthread):
+    # 一棵树 (sections 是整棵树, 第一个是根) 的切点, 最多两个; 返回 (切点, 块, 每块的线程号)
+    children = _children(sections)
+    kids_of = {}
+    for (sec, _), kids in children.items():
+        kids_of.setdefault(sec, []).extend(kids)
+    subtree = {}
+
+    def size(sec):
+        if sec not in subtree:
+            subtree[sec] = sec.nseg + sum(size(c) for c in kids_of.get(sec, []))
+        return subtree[sec]
+
+    weight = {node: sum(size(c) for c in kids) for node, kids in children.items()}
+    nodes = sorted(weight, key=lambda node: -weight[node])[:SPLIT_CANDIDATES]
+    best = None
+    for splits in [[]] + [[a] for a in nodes] + [[a, b] for i, a in enumerate(nodes) for b in nodes[i + 1:]]:
+        parts = pieces(sections, splits)
+        assign = _layout(parts, splits, nthread)
+        if assign is None:
+            continue
+        score = (max(_load(parts, assign, nthread)), len(splits))
+        if best is None or score < best[0]:
+            best = (score, splits, parts, assign)
+    return best[1:]
+
+
+class Threading:
+
+    def __init__(self, nthread, splits, pieces, assign, load):
+        self.nthread = nthread
+        self.splits = splits
+        self.pieces = pieces
+        self.assign = assign
+        self.load = load
+
+    def balance(self):
+        # 最大线程负载 / 平均负载, 1 是完全均衡
+        mean = sum(self.load) / len(self.load)
+        return max(self.load) / mean if mean else 1.0
+
+    def ctime(self):
+        # 上次仿真每个线程的计算时间 (s)
+        pc = h.ParallelContext()
+        return [pc.thread_ctime(i) for i in range(self.nthread)]
+
+
+def use_threads(nthread, multisplit=None, sections=None):
+    # 建好模型之后、finitialize / 记录 / Tracker 之前调用, 每个进程只调一次
+    # multisplit: 把唯一的一棵树按 best_split 切开; None 时只有一棵树才切, 很多细胞时按整棵树分
+    sections = list(h.allsec() if sections is None else sections)
+    if nthread > 1:
+        short = [nc for nc in h.List('NetCon') if nc.delay <= h.dt]
+        if short:
+            raise ValueError(f"{len(short)} NetCon(s) with delay <= dt ({h.dt} ms); NEURON threads need longer delays")
+    pc = h.ParallelContext()
+    pc.nthread(nthread)
+    h.CVode().cache_efficient(1)
+    splits = []
+    roots = set(_root(sec) for sec in sections)
+    if multisplit is None:
+        multisplit = len(roots) == 1
+    if multisplit and nthread > 1:
+        if len(roots) != 1:
+            raise ValueError(f"multisplit is for a single cell, got {len(roots)} trees")
+        root = roots.pop()
+        sections = [root] + [sec for sec in sections if sec is not root]
+        splits, parts, assign = best_split(sections, nthread)
+    else:
+        parts = pieces(sections)
+        assign, _ = lpt([n for _, n in parts], nthread)
+    if splits:
+        # 切开: 子 section 断开, 和切点用同一个 sid
+        children = _children(sections)
+        for sid, (sec, x) in enumerate(splits):
+            pc.multisplit(sec(x), sid)
+            for child in children[(sec, x)]:
+                end = child.orientation()
+                h.disconnect(sec=child)
+                pc.multisplit(child(end), sid)
+        pc.multisplit()
+    if nthread > 1:
+        lists = [h.SectionList() for _ in range(nthread)]
+        for (root, _), j in zip(parts, assign):
+            lists[j].append(sec=root)
+        for j, sl in enumerate(lists):
+            pc.partition(j, sl)
+    return Threading(nthread, splits, parts, assign, _load(parts, assign, nthread))
+
+
+def _bench(depth, nthread, multisplit, tstop):
+    import time
+    import numpy as np
+    from core.env import setup
+    from core.morphology import BranchingCell
+    setup()
+    cell = BranchingCell(depth=depth)
+    stims = []
+    for sec in [cell.soma] + cell.tips():
+        stim = h.IClamp(sec(0.5))
+        stim.delay, stim.dur, stim.amp = 1, tstop, 0.5 if sec is cell.soma else 0.02
+        stims.append(stim)
+    threading = use_threads(nthread, multisplit)
+    v = h.Vector().record(cell.soma(0.5)._ref_v)
+    h.dt = 0.025
+    h.finitialize(-65)
+    start = time.perf_counter()
+    h.continuerun(tstop)
+    wall = time.perf_counter() - start
+    return {'compartments': cell.compartments(), 'wall': wall, 'load': threading.load,
+            'balance': threading.balance(), 'splits': [f'{sec.name()}({x:g})' for sec, x in threading.splits],
+            'ctime': threading.ctime(), 'v': np.array(v)}
+
+
+if __name__ == '__main__':
+    # 合成分叉树突上 1..N 个线程的加速比; 每种线程数开一个新进程 (nthread 设了就不能改)
+    # 在仓库根目录下运行: python -m core.threads --depth 7 --threads 1 2 4 8
+    import argparse
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    import numpy as np
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--depth', type=int, default=7)
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--no-multisplit', action='store_true')
+    parser.add_argument('--tstop', type=float, default=50)
+    parser.add_argument('--cores', type=int, default=None, help='plan() 按多少个核算, 默认本机')
+    args = parser.parse_args()
+
+    ctx = multiprocessing.get_context('spawn')
+    rows = []
+    for n in args.threads:
+        with ProcessPoolExecutor(1, mp_context=ctx) as ex:
+            rows.append((n, ex.submit(_bench, args.depth, n, None if not args.no_multisplit else False,
+                                      args.tstop).result()))
+    base = rows[0][1]
+    print(f"depth {args.depth}: {base['compartments']} compartments, tstop {args.tstop:g} ms, "
+          f"{default_workers()} core(s)")
+    print(f"{'threads':>8}{'wall s':>9}{'speedup':>9}{'balance':>9}{'max |dV|':>10}  split / per-thread load")
+    for n, r in rows:
+        dv = np.max(np.abs(r['v'] - base['v']))
+        print(f"{n:>8}{r['wall']:>9.3f}{base['wall'] / r['wall']:>9.2f}{r['balance']:>9.2f}{dv:>10.2g}  "
+              f"{' '.join(r['splits']) or '-'} / {r['load']}")
+    for points in (1, 4, 100):
+        workers, threads = plan(points, base['compartments'], cores=args.cores)
+        print(f"plan for {points} independent run(s) of this cell on {args.cores or default_workers()} core(s): "
+              f"{workers} process(es) x {threads} thread(s)")
@@ -0,0 +1,190 @@
+import glob
+import json
+import os
+import shutil
+import uuid
+import numpy as np
+
+# 大 sweep 的曲线存盘: 每个 trial 的每条曲线都留下来, 又不全放在内存里
+#  store/meta.json                  通道 (采样点数 / 间隔 / dtype / 记录位置), 参数列和标量列的名字, attrs
+#  store/chunks/<writer>-<seq>/     一块 = 若干行: 每个通道一个 (rows, samples) 的 .npy, 加 index.json
+# index.json 里是这一块每一行的参数和标量 (例如 w0 / direction / ca_peak), 写完数据之后最后 os.replace 进去,
+# 读的一方只看有 index.json 的块, 所以多个进程可以同时往同一个 store 追加, 不用加锁
+# 读曲线时 np.load(mmap_mode='r'), 只读用到的行
+
+META = 'meta.json'
+INDEX = 'index.json'
+
+
+class TraceStore:
+
+    def __init__(self, path):
+        # 打开已经存在的 store; 新建用 TraceStore.create
+        self.path = path
+        with open(os.path.join(path, META)) as f:
+            meta = json.load(f)
+        self.channels = meta['channels']
+        self.params = meta['params']
+        self.scalars = meta['scalars']
+        self.attrs = meta['attrs']
+        self._index = None
+        self._chunks = []
+        self._maps = {}
+
+    @classmethod
+    def create(cls, path, channels, params, scalars=(), attrs=None, overwrite=False):
+        # channels: {名字: {'samples': n, 'dt': ms, 't0': ms, 'dtype': 'float32', 'location': 'dend(1.0).cai'}}
+        # params / scalars: 每一行的参数名 / 标量名; attrs: 整个 sweep 的设置, 只要能存成 json
+        if os.path.exists(os.path.join(path, META)):
+            if not overwrite:
+                raise FileExistsError(f"trace store already exists: {path}")
+            shutil.rmtree(path)
+        os.makedirs(os.path.join(path, 'chunks'), exist_ok=True)
+        channels = {name: dict({'t0': 0.0, 'dtype': 'float32'}, **spec) for name, spec in channels.items()}
+        meta = {'channels': channels, 'params': list(params), 'scalars': list(scalars), 'attrs': attrs or {}}
+        tmp = os.path.join(path, META + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(meta, f, indent=1)
+        os.replace(tmp, os.path.join(path, META))
+        return cls(path)
+
+    def writer(self, chunk_size=256):
+        return TraceWriter(self, chunk_size)
+
+    # ---- 读 ----
+
+    def refresh(self):
+        # 重新扫描已经写完的块; 别的进程还在追加时可以反复调用
+        chunks = sorted(os.path.dirname(p) for p in glob.glob(os.path.join(self.path, 'chunks', '*', INDEX))
+                        if not p.endswith('.tmp' + os.sep + INDEX))
+        columns = {name: [] for name in self.params + self.scalars}
+        self._chunks = []
+        for chunk in chunks:
+            with open(os.path.join(chunk, INDEX)) as f:
+                entry = json.load(f)
+            for name in columns:
+                columns[name].extend(entry['columns'][name])
+            self._chunks.append((chunk, entry['rows']))
+        index = {name: np.array(values) for name, values in columns.items()}
+        index['_chunk'] = np.repeat(np.arange(len(self._chunks)), [n for _, n in self._chunks]).astype(int)
+        index['_row'] = np.concatenate([np.arange(n) for _, n in self._chunks] or [np.zeros(0)]).astype(int)
+        self._index = index
+        return self
+
+    def index(self):
+        # {列名: array}, 每一行一个 trial; _chunk / _row 是曲线在哪一块的哪一行
+        if self._index is None:
+            self.refresh()
+        return self._index
+
+    def __len__(self):
+        return len(self.index()['_chunk'])
+
+    def select(self, **conditions):
+        # 参数等于给定值的行号, 例如 select(direction='null', w0=0.0012)
+        index = self.index()
+        mask = np.ones(len(self), dtype=bool)
+        for name, value in conditions.items():
+            column = index[name]
+            if column.dtype.kind == 'f':
+                mask &= np.isclose(column, value, rtol=1e-12, atol=0)
+            else:
+                mask &= column == value
+        return np.flatnonzero(mask)
+
+    def times(self, channel):
+        spec = self.channels[channel]
+        return spec['t0'] + np.arange(spec['samples']) * spec['dt']
+
+    def _map(self, chunk, channel):
+        # 按块的路径缓存, refresh() 之后块的编号会变
+        key = (self._chunks[chunk][0], channel)
+        if key not in self._maps:
+            self._maps[key] = np.load(os.path.join(key[0], f'{channel}.npy'), mmap_mode='r')
+        return self._maps[key]
+
+    def traces(self, channel, rows=None, samples=slice(None)):
+        # rows: 行号 (index() 的下标), 默认全部; samples: 每条曲线取哪一段
+        index = self.index()
+        rows = np.arange(len(self)) if rows is None else np.atleast_1d(rows)
+        spec = self.channels[channel]
+        out = np.empty((len(rows), len(range(spec['samples'])[samples])), dtype=spec['dtype'])
+        chunks, local = index['_chunk'][rows], index['_row'][rows]
+        for chunk in np.unique(chunks):
+            sel = chunks == chunk
+            out[sel] = self._map(chunk, channel)[local[sel]][:, samples]
+        return out
+
+    def reduce(self, channel, func, rows=None):
+        # 逐块算每条曲线的一个值 (例如 np.max), 内存里同时只有一块
+        index = self.index()
+        rows = np.arange(len(self)) if rows is None else np.atleast_1d(rows)
+        out = np.empty(len(rows))
+        chunks, local = index['_chunk'][rows], index['_row'][rows]
+        for chunk in np.unique(chunks):
+            sel = chunks == chunk
+            out[sel] = func(self._map(chunk, channel)[local[sel]], axis=1)
+        return out
+
+
+class TraceWriter:
+
+    def __init__(self, store, chunk_size=256):
+        self.store = store
+        self.chunk_size = chunk_size
+        self.name = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self.seq = 0
+        self.chunk = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _open_chunk(self):
+        # 数据先写到 .tmp 目录, 整块写完再改名发布
+        self.dir = os.path.join(self.store.path, 'chunks', f'{self.name}-{self.seq:06d}.tmp')
+        os.makedirs(self.dir)
+        self.chunk = {name: np.lib.format.open_memmap(os.path.join(self.dir, f'{name}.npy'), mode='w+',
+                                                      dtype=spec['dtype'],
+                                                      shape=(self.chunk_size, spec['samples']))
+                      for name, spec in self.store.channels.items()}
+        self.columns = {name: [] for name in self.store.params + self.store.scalars}
+        self.rows = 0
+
+    def append(self, params, scalars, traces):
+        # 一行: params / scalars 是 {名字: 值}, traces 是 {通道: 一维曲线}, 直接写进 memmap, 短的补 NaN
+        if self.chunk is None:
+            self._open_chunk()
+        for name, value in dict(params, **scalars).items():
+            self.columns[name].append(value.item() if hasattr(value, 'item') else value)
+        for name, out in self.chunk.items():
+            trace = traces[name]
+            n = min(len(trace), out.shape[1])
+            out[self.rows, :n] = trace[:n]
+            out[self.rows, n:] = np.nan
+        self.rows += 1
+        if self.rows == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.chunk is None:
+            return
+        rows = self.rows
+        for name in list(self.chunk):
+            self.chunk.pop(name).flush()
+        self.chunk = None
+        if rows < self.chunk_size:
+            # 没写满的块截短, 读的时候形状就是真实行数
+            for name in self.store.channels:
+                path = os.path.join(self.dir, f'{name}.npy')
+                data = np.load(path, mmap_mode='r')[:rows].copy()
+                np.save(path, data)
+        with open(os.path.join(self.dir, INDEX), 'w') as f:
+            json.dump({'rows': rows, 'columns': self.columns}, f)
+        os.replace(self.dir, self.dir[:-len('.tmp')])
+        self.seq += 1
+
+    def close(self):
+        self.flush()
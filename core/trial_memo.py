@@ -0,0 +1,55 @@
+import numpy as np
+
+# 确定性 trial 的结果按 (权重状态, 方向) 记下来, 同一个状态再出现时不再仿真
+#  - 权重向量按 quantum 量化成整数 tuple 当 key: 0.0012 + 0.00005 - 0.00005 这种浮点误差量化掉,
+#    quantum 取得比学习率大时就是把权重归到格点上 (近似)
+#  - run_plasticity_experiment (train/train.py) 里 5 个权重一起 +- 学习率, 再夹在 [min, max] 之间,
+#    能到的状态只有 (max - min) / 学习率 + 1 个, 跑多少 trial / 多少个 seed 都只仿真这么多次 (x 2 个方向)
+#  - 结果里不能有随机性 (NetStim noise=0), 而且 key 外的设置 (阈值 / dt / celsius ...) 在一个 memo 的生命周期里不变
+
+QUANTUM = 1e-9
+
+
+class TrialMemo:
+
+    def __init__(self, run_trial, quantum=QUANTUM):
+        # run_trial(weights, direction) -> 结果, 只在没见过的 (状态, 方向) 上调用
+        self.run_trial = run_trial
+        self.quantum = quantum
+        self.outcomes = {}
+        self.stats = {'hit': 0, 'simulated': 0}
+
+    def key(self, weights, direction):
+        return tuple(np.rint(np.asarray(weights, dtype=float) / self.quantum).astype(np.int64).tolist()), direction
+
+    def __call__(self, weights, direction):
+        key = self.key(weights, direction)
+        if key in self.outcomes:
+            self.stats['hit'] += 1
+            return self.outcomes[key]
+        value = self.run_trial(weights, direction)
+        self.outcomes[key] = value
+        self.stats['simulated'] += 1
+        return value
+
+    def states(self):
+        # 见过的不同权重状态 (不分方向)
+        return {state for state, _ in self.outcomes}
+
+    def lattice(self):
+        # 见过的状态都是 "所有权重相等" 时返回排好序的那些权重值 (一维格点), 否则 None
+        states = self.states()
+        if not all(len(set(s)) == 1 for s in states):
+            return None
+        return np.array(sorted(s[0] for s in states)) * self.quantum
+
+    def hit_rate(self):
+        total = self.stats['hit'] + self.stats['simulated']
+        return self.stats['hit'] / total if total else 0.0
+
+    def summary(self):
+        s = self.stats
+        lattice = self.lattice()
+        shape = f"1-D lattice of {len(lattice)} weight levels" if lattice is not None else "general weight vectors"
+        return (f"{s['hit'] + s['simulated']} trials, {s['simulated']} simulated, {s['hit']} memo hits "
+                f"(hit rate {self.hit_rate():.2%}), {len(self.states())} distinct states ({shape})")
@@ -0,0 +1,155 @@
+from collections import OrderedDict
+import os
+from neuron import h
+
+from core.fingerprint import fingerprint, mechanism_params, model_description, point_process_types
+from core.model import cell_specs
+
+# 所有实验都从 v_init=-70 开始, 第一个事件之前 (20 ms / 40 ms) 什么都没发生,
+# 但这段时间的状态每个 trial 都一样. 这里每种模型配置只算一次, 用 SaveState 存下来,
+# 之后每个 trial 直接从第一个事件的时间开始算
+
+# 这些点过程的参数会影响事件之前的状态, 要进 key
+CLAMP_TYPES = ['IClamp', 'SEClamp', 'VClamp']
+
+# 每个快照是一份完整的模型状态, 只留最近用过的几个 (扫参数 / 换模型时 key 一直在变)
+MAX_SNAPSHOTS = 8
+_snapshots = OrderedDict()
+# 模型都由 core.model 的 Cell 组成时, 模型部分的哈希按 (section, spec) 记下来, 不用每个 trial 重新遍历 segment;
+# 绕开 Cell.update 直接改 section 参数之后调用 warm_run 的话, 要先 _model_keys.clear()
+MAX_MODEL_KEYS = 64
+_model_keys = OrderedDict()
+
+
+def _remember(cache, key, value, size):
+    cache[key] = value
+    if len(cache) > size:
+        cache.popitem(last=False)
+
+
+def _clamp_description():
+    desc = []
+    for name in CLAMP_TYPES:
+        params = mechanism_params(name)
+        for pp in h.List(name):
+            seg = pp.get_segment()
+            desc.append([name, seg.sec.name(), seg.x] + [getattr(pp, p) for p in params])
+    return desc
+
+
+def _point_process_params():
+    # restore 会把点过程的 PARAMETER (NetStim.start, Exp2Syn.tau2 ...) 也恢复成快照里的值,
+    # 记下这个 trial 设置的值, restore 之后再写回去
+    values = []
+    for name in point_process_types():
+        params = mechanism_params(name)
+        for pp in h.List(name):
+            values.append((pp, [(p, getattr(pp, p)) for p in params]))
+    return values
+
+
+def _check_no_early_events(t_start):
+    for ns in h.List('NetStim'):
+        if ns.number > 0 and ns.start < t_start:
+            raise ValueError(f"NetStim starts at {ns.start} ms, before warm start time {t_start} ms")
+
+
+def _model_key():
+    specs = cell_specs(h.allsec())
+    if specs is None:
+        return fingerprint(model_description(h.allsec()))
+    if specs in _model_keys:
+        _model_keys.move_to_end(specs)
+    else:
+        _remember(_model_keys, specs, fingerprint(model_description(h.allsec())), MAX_MODEL_KEYS)
+    return _model_keys[specs]
+
+
+def snapshot_key(t_start, v_init):
+    return fingerprint({
+        'model': _model_key(),
+        'clamps': _clamp_description(),
+        't_start': t_start, 'v_init': v_init, 'celsius': h.celsius, 'dt': h.dt,
+    })
+
+
+class WarmStart:
+
+    def __init__(self, key, t_start, v_init=-70, cache_dir=None):
+        self.key = key
+        self.t_start = t_start
+        self.v_init = v_init
+        self.path = None
+        if cache_dir is not None:
+            self.path = os.path.join(cache_dir, f'warm_{key}.dat')
+        self.state = None
+
+    def prepare(self):
+        # 预跑期间把所有 NetCon 权重清零, 保证快照里没有任何突触输入
+        saved = [(nc, nc.weight[0]) for nc in h.List('NetCon')]
+        for nc, _ in saved:
+            nc.weight[0] = 0
+        # 停在第一个事件前一步: 落在 t_start 上的那一步结束时会投递 t_start 的事件,
+        # NetStim 会被记成已经发放过
+        h.finitialize(self.v_init)
+        h.continuerun(self.t_start - h.dt)
+        self.state = h.SaveState()
+        self.state.save()
+        for nc, w in saved:
+            nc.weight[0] = w
+
+        if self.path is not None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            f = h.File()
+            f.wopen(self.path)
+            self.state.fwrite(f)
+            f.close()
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return False
+        f = h.File()
+        f.ropen(self.path)
+        state = h.SaveState()
+        state.fread(f)
+        f.close()
+        self.state = state
+        return True
+
+    def run(self, tstop):
+        if self.state is None and not self.load():
+            self.prepare()
+        # finitialize 按这次 trial 的 NetStim 时间排好事件队列,
+        # restore(1) 只恢复状态和 t, 保留这个队列
+        before = _point_process_params()
+        h.finitialize(self.v_init)
+        # APCount.n 这类会被 INITIAL 改掉的其实是状态, 交给 restore; 只写回没变的
+        params = [(pp, [pv for pv, pv0 in zip(values, values0) if pv == pv0])
+                  for (pp, values), (_, values0) in zip(_point_process_params(), before)]
+        try:
+            self.state.restore(1)
+        except RuntimeError:
+            # 模型结构变了 (点过程数目不同), 重新算快照
+            self.prepare()
+            h.finitialize(self.v_init)
+            self.state.restore(1)
+        for pp, values in params:
+            for p, v in values:
+                setattr(pp, p, v)
+        # Vector 重新从当前时间开始记录, 第 i 个点对应 t0 + i * dt
+        t0 = h.t
+        h.frecord_init()
+        h.continuerun(tstop)
+        return t0
+
+
+def warm_run(t_start, tstop, v_init=-70, cache_dir=None):
+    # 代替 h.run(): 调用前和 h.run() 一样设置好模型/刺激/h.dt/h.celsius
+    # 返回记录开始的时间 (t_start 前一步), Vector 需要在调用前就 record 好
+    _check_no_early_events(t_start)
+    key = snapshot_key(t_start, v_init)
+    if key in _snapshots:
+        _snapshots.move_to_end(key)
+    else:
+        _remember(_snapshots, key, WarmStart(key, t_start, v_init, cache_dir), MAX_SNAPSHOTS)
+    return _snapshots[key].run(tstop)
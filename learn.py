@@ -1,59 +1,16 @@
-import os
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 import numpy as np
 import random
-import sys 
-from neuron import h, gui
-
-def initialize_neuron_env():
-    h.load_file('stdrun.hoc')
-    lib_path = './x86_64/libnrnmech.so' 
-
-    if os.path.exists(lib_path):
-        try:
-            h.nrn_load_dll(lib_path) 
-        except RuntimeError as e:
-            if "The user defined name already exists" in str(e):
-                print("NEURON mechanisms already loaded (detected by RuntimeError: mechanism name already exists). Proceeding.")
-            else:
-                print(f"CRITICAL ERROR: Failed to load NEURON DLL due to unexpected RuntimeError: {e}")
-                sys.exit(1)
+from core import model
+from core.model import AGENT_SPEC
+from core.plotting import plt
+from core.rpe_table import RPETable
+from core.warmstart import warm_run
+from core.recording import Recorder
+from neuron import h
 
-    else:
-        print("Warning: Could not find NMODL mechanisms at expected path. Attempting to compile...")
-        if os.system('nrnivmodl') != 0:
-            print("CRITICAL ERROR: nrnivmodl compilation command failed. Exiting.")
-            sys.exit(1)
-        if os.path.exists(lib_path):
-            try:
-                h.nrn_load_dll(lib_path)
-                print("NEURON mechanisms compiled and loaded successfully.")
-            except RuntimeError as e:
-                if "The user defined name already exists" in str(e):
-                    print("NEURON mechanisms already loaded after compilation (detected by RuntimeError). Proceeding.")
-                else:
-                    print(f"CRITICAL ERROR: Failed to load NEURON DLL due to unexpected RuntimeError: {e}")
-                    sys.exit(1)
-        else:
-            print(f"CRITICAL ERROR: Compilation succeeded but could not find mechanisms at {lib_path}. Exiting.")
-            sys.exit(1)
 def build_model():
-    soma = h.Section(name='soma'); dend = h.Section(name='dend')
-    dend.connect(soma(1)); soma.L, soma.diam = 20, 20
-    dend.L, dend.diam, dend.nseg = 500, 2, 51
-    for sec in h.allsec(): 
-        sec.Ra, sec.cm = 150, 1
-        
-    soma.insert('hh'); dend.insert('hh')
-    dend.gnabar_hh = 0.052
-    dend.insert('ca_hva'); dend.insert('cad')
-
-    for seg in dend:
-        seg.tau_cad = 50
-        seg.gbar_ca_hva = 0.01 if seg.x > 0.5 else 0
-    return soma, dend
+    # 共用的模型工厂, 胞体 / 树突 gkbar 是 hh 默认值 (core/model.py 的 AGENT_SPEC)
+    return model.build_model(AGENT_SPEC)
 
 def setup_single_stim(dend, pos, time, weight):
     syn = h.Exp2Syn(dend(pos)); syn.tau1, syn.tau2 = 1, 20
@@ -61,7 +18,11 @@ def setup_single_stim(dend, pos, time, weight):
     nc = h.NetCon(ns, syn); nc.weight[0], nc.delay = weight, 0
     return syn, ns, nc
 
-def calculate_rpe_signal(soma, dend, confidence, is_correct):
+def rpe_recorder():
+    # RPE 窗口 (41-50 ms) 的 dend(0.01) 电压, 缓冲区只分配一次, 每次 calculate_rpe_signal 复用
+    return Recorder(tstop=100)
+
+def calculate_rpe_signal(soma, dend, confidence, is_correct, warm=True, recorder=None):
     soma_voltage = -70 + 25 * confidence
 
     dend_weight = 0.005 if is_correct else 0.0
@@ -69,18 +30,22 @@ def calculate_rpe_signal(soma, dend, confidence, is_correct):
     v_clamp.dur1, v_clamp.amp1, v_clamp.rs = 100, soma_voltage, 1e-3
 
     syn, ns, nc = setup_single_stim(dend, pos=0.8, time=40, weight=dend_weight)
-    rec_v_dend_prox = h.Vector().record(dend(0.01)._ref_v)
+    if recorder is None:
+        recorder = rpe_recorder()
+    if 'v_dend_prox' not in recorder.recordings:
+        recorder.add('v_dend_prox', dend(0.01)._ref_v, window=(41, 50))
 
     h.t, h.v_init, h.dt, h.tstop = 0, -70, 0.025, 100
-    h.run()
-    rpe_proxy = np.array(rec_v_dend_prox) - soma_voltage
-    time_points_for_check = int(50/h.dt)
-    if len(rpe_proxy) < time_points_for_check: 
+    if warm and not h.CVode().active():
+        # 40 ms 之前只有钳位, 直接从快照开始 (CVODE 打开时从头算); 窗口按绝对时间记录, 和 t0 无关
+        warm_run(40, h.tstop)
+    else:
+        h.run()
+    v_window = recorder.view('v_dend_prox')
+    if len(v_window) < len(recorder.times('v_dend_prox')):
         print("WARNING")
         return 0.0
-    start_idx = int(41/h.dt)
-    end_idx = int(50/h.dt)
-    peak_rpe = np.max(rpe_proxy[start_idx:end_idx])
+    peak_rpe = v_window.max() - soma_voltage
     del v_clamp, syn, ns, nc
     
     return peak_rpe
@@ -126,7 +91,9 @@ class Binary_Agent(BaseAgent):
         else:
             self.confidence = min(1.0, self.confidence + 0.1)
 
-def run_loop(agent_type, soma_sec, dend_sec):
+def run_loop(agent_type, soma_sec, dend_sec, rpe_table=None, stream=None):
+    # stream: core/streaming.py 的 StreamingRPE, 模型一直往下算, 每个 trial 是接着的一段时间
+    recorder = rpe_recorder()
     if agent_type == 'rpe':
         agent = RPE_Agent()
     elif agent_type == 'binary':
@@ -146,7 +113,12 @@ def run_loop(agent_type, soma_sec, dend_sec):
         correct_answer = world_rule(input_number)
         is_correct = (prediction == correct_answer)
 
-        rpe_signal = calculate_rpe_signal(soma_sec, dend_sec, confidence, is_correct)
+        if stream is not None:
+            rpe_signal = stream.trial(confidence, is_correct)
+        elif rpe_table is not None:
+            rpe_signal = rpe_table.lookup(confidence, is_correct)
+        else:
+            rpe_signal = calculate_rpe_signal(soma_sec, dend_sec, confidence, is_correct, recorder=recorder)
         rpe_history.append(rpe_signal)
         if agent_type == 'rpe':
             agent.learn(rpe_signal)
@@ -176,18 +148,143 @@ def run_loop(agent_type, soma_sec, dend_sec):
     output_filename = f"learning_curve_{agent_type}_agent.png"
     plt.savefig(output_filename)
 
+# 群体模式: n 个互相独立的 agent 一起跑, 规则 / confidence 都是数组, 每个 trial 对整个群体做一次 predict / learn
+# 规则和 RPE_Agent / Binary_Agent 逐个 agent 的一样; RPE 从共用的 RPETable 一次查整个数组 (lookup_many)
+# 所有 agent 共用一个 numpy Generator (seed), 每个 agent 用自己那一列随机数, 结果只取决于 (seed, n_agents)
+class AgentPopulation:
+    def __init__(self, n_agents, agent_type, seed=0):
+        if agent_type not in ('rpe', 'binary'):
+            raise ValueError("Unknown agent type. Choose 'rpe' or 'binary'.")
+        base = BaseAgent()
+        self.agent_type = agent_type
+        self.rng = np.random.default_rng(seed)
+        self.rule = np.full(n_agents, base.possible_rules.index(base.current_rule), dtype=np.int8)
+        self.confidence = np.full(n_agents, base.confidence)
+        self.switches = np.zeros(n_agents, dtype=np.int32)
+
+    def predict(self, input_number):
+        # 规则的顺序和 BaseAgent.possible_rules 一样
+        return np.choose(self.rule, [input_number + 1, input_number * 2, input_number * input_number])
+
+    def _switch(self, mask):
+        # 原来的 while 循环是在另外两个规则里均匀地选一个
+        n = int(mask.sum())
+        self.rule[mask] = (self.rule[mask] + self.rng.integers(1, 3, n)) % 3
+        self.confidence[mask] = 0.4
+        self.switches[mask] += 1
+
+    def learn(self, rpe_signal, is_correct):
+        if self.agent_type == 'rpe':
+            switch = rpe_signal < -1.0
+            up = np.where(rpe_signal > 0, 0.1, 0.05)
+        else:
+            switch = ~is_correct & (self.confidence > 0.7)
+            up = np.where(is_correct, 0.1, 0.0)
+        keep = ~switch
+        self.confidence[keep] = np.minimum(1.0, self.confidence[keep] + up[keep])
+        self._switch(switch)
+
+
+def run_population(agent_type, rpe_table, n_agents=100000, num_trials=70, seed=0):
+    # 返回每个 trial 每个 agent 的 (对不对, RPE, learn 之后的规则), 形状都是 (num_trials, n_agents)
+    agents = AgentPopulation(n_agents, agent_type, seed)
+    correct = np.zeros((num_trials, n_agents), dtype=bool)
+    rpe = np.zeros((num_trials, n_agents), dtype=np.float32)
+    rules = np.zeros((num_trials, n_agents), dtype=np.int8)
+    for i in range(num_trials):
+        input_number = agents.rng.integers(2, 11, n_agents)
+        is_correct = agents.predict(input_number) == input_number * 2
+        rpe_signal = rpe_table.lookup_many(agents.confidence, is_correct)
+        agents.learn(rpe_signal, is_correct)
+        correct[i], rpe[i], rules[i] = is_correct, rpe_signal, agents.rule
+    return {'correct': correct, 'rpe': rpe, 'rules': rules, 'switches': agents.switches}
+
+
+def population_curves(run, quantiles=(0.1, 0.5, 0.9)):
+    # 每个 trial: 正确率 (群体平均), 到这个 trial 为止的累计正确率和 RPE 的分位数;
+    # latency: 从第几个 trial 之后一直是正确的规则 (multiply_by_two), 最后也没定下来的是 nan
+    correct, rules = run['correct'], run['rules']
+    num_trials = len(correct)
+    cumulative = np.cumsum(correct, axis=0, dtype=np.float32) / np.arange(1, num_trials + 1, dtype=np.float32)[:, None]
+    settled = np.logical_and.accumulate((rules == 1)[::-1], axis=0)[::-1]
+    latency = np.where(settled[-1], np.argmax(settled, axis=0) + 1.0, np.nan)
+    return {
+        'quantiles': quantiles,
+        'accuracy': correct.mean(axis=1),
+        'cumulative_q': np.quantile(cumulative, quantiles, axis=1),
+        'rpe_mean': run['rpe'].mean(axis=1),
+        'rpe_q': np.quantile(run['rpe'], quantiles, axis=1),
+        'latency': latency,
+        'switches': run['switches'],
+    }
+
+
+def plot_population(curves, n_agents, filename='learning_curve_population.png'):
+    fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(12, 9), sharex=True)
+    colors = {'rpe': 'tab:green', 'binary': 'tab:red'}
+    for agent_type, c in curves.items():
+        steps = np.arange(1, len(c['accuracy']) + 1)
+        lo, hi = c['quantiles'][0], c['quantiles'][-1]
+        ax1.plot(steps, c['accuracy'], color=colors[agent_type], linewidth=2, label=f'{agent_type.upper()} accuracy (mean)')
+        ax1.fill_between(steps, c['cumulative_q'][0], c['cumulative_q'][-1], color=colors[agent_type], alpha=0.15,
+                         label=f'{agent_type.upper()} cumulative accuracy ({lo:.0%}-{hi:.0%})')
+        ax2.plot(steps, c['rpe_mean'], color=colors[agent_type], linewidth=2, label=f'{agent_type.upper()} RPE (mean)')
+        ax2.fill_between(steps, c['rpe_q'][0], c['rpe_q'][-1], color=colors[agent_type], alpha=0.15)
+    ax1.set_ylabel('Fraction Correct')
+    ax1.set_title(f'Population Learning Curves ({n_agents} agents per type)')
+    ax1.legend()
+    ax1.grid(True, linestyle='--', alpha=0.6)
+    ax2.axhline(-1.0, color='red', linestyle=':', linewidth=1, label='RPE Switching Threshold')
+    ax2.set_xlabel('Trial Number')
+    ax2.set_ylabel('Peak RPE Signal [mV]')
+    ax2.legend()
+    ax2.grid(True, linestyle='--', alpha=0.6)
+    plt.tight_layout()
+    plt.savefig(filename)
+
+
 if __name__ == '__main__':
-    if not os.path.exists('./x86_64'):
-        print("MOD files not compiled. Compiling now...")
-        os.system('nrnivmodl')
-    try:
-        initialize_neuron_env()
-    except Exception as e:
-        print(f"\nFATAL: NEURON initialization failed: {e}")
-        sys.exit(1)
+    import argparse
+    import time
+    parser = argparse.ArgumentParser()
+    # --population N: N 个 RPE agent 和 N 个 Binary agent 的群体模式, 输出平均 / 分位数学习曲线
+    parser.add_argument('--population', type=int, default=0)
+    parser.add_argument('--trials', type=int, default=70)
+    parser.add_argument('--seed', type=int, default=0)
+    # --stream: 不查表, 模型连续仿真, 每个 trial 接着上一个 (core/streaming.py); --carry-over 时钙也带到下一个 trial
+    parser.add_argument('--stream', action='store_true')
+    parser.add_argument('--carry-over', action='store_true')
+    args = parser.parse_args()
+
     neuron_soma, neuron_dend = build_model()
-    
+    # 第一次运行会把 confidence 网格算好存到 .sim_cache/, 之后直接查表
+    recorder = rpe_recorder()
+    rpe_table = RPETable(neuron_soma, neuron_dend,
+                         lambda c, ok: calculate_rpe_signal(neuron_soma, neuron_dend, c, ok, recorder=recorder),
+                         spec=AGENT_SPEC)
 
-    run_loop(agent_type='rpe', soma_sec=neuron_soma, dend_sec=neuron_dend)
-    run_loop(agent_type='binary', soma_sec=neuron_soma, dend_sec=neuron_dend)
+    if args.population:
+        curves = {}
+        for agent_type in ('rpe', 'binary'):
+            start = time.perf_counter()
+            run = run_population(agent_type, rpe_table, args.population, args.trials, args.seed)
+            curves[agent_type] = c = population_curves(run)
+            latency = c['latency']
+            done = ~np.isnan(latency)
+            q = np.quantile(latency[done], c['quantiles']) if done.any() else [np.nan] * len(c['quantiles'])
+            print(f"{agent_type}: {args.population} agents x {args.trials} trials in {time.perf_counter() - start:.2f} s; "
+                  f"final accuracy {c['accuracy'][-1]:.3f}, settled on the rule {done.mean():.1%}, "
+                  f"latency mean {np.nanmean(latency):.1f} / quantiles {' '.join(f'{v:.0f}' for v in q)} trials, "
+                  f"switches per agent {c['switches'].mean():.2f}")
+        plot_population(curves, args.population)
+    elif args.stream:
+        from core.streaming import StreamingRPE
+        for agent_type in ('rpe', 'binary'):
+            stream = StreamingRPE(neuron_soma, neuron_dend, carry_over=args.carry_over)
+            run_loop(agent_type=agent_type, soma_sec=neuron_soma, dend_sec=neuron_dend, stream=stream)
+            stream.close()
+    else:
+        run_loop(agent_type='rpe', soma_sec=neuron_soma, dend_sec=neuron_dend, rpe_table=rpe_table)
+        run_loop(agent_type='binary', soma_sec=neuron_soma, dend_sec=neuron_dend, rpe_table=rpe_table)
+    print(rpe_table.stats)
     
\ No newline at end of file
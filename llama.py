@@ -1,8 +1,13 @@
 import os
-import matplotlib.pyplot as plt
 import numpy as np
 import random
-from neuron import h, gui
+from core import model
+from core.model import AGENT_SPEC
+from core.plotting import plt
+from core.rpe_table import RPETable
+from core.warmstart import warm_run
+from core.recording import Recorder
+from neuron import h
 
 def initialize_neuron_env():
     h.load_file('stdrun.hoc')
@@ -12,17 +17,8 @@ def initialize_neuron_env():
         print("Warning")
 
 def build_model():
-    soma = h.Section(name='soma'); dend = h.Section(name='dend')
-    dend.connect(soma(1)); soma.L, soma.diam = 20, 20
-    dend.L, dend.diam, dend.nseg = 500, 2, 51
-    for sec in h.allsec(): sec.Ra, sec.cm = 150, 1
-    soma.insert('hh'); dend.insert('hh')
-    dend.gnabar_hh = 0.052
-    dend.insert('ca_hva'); dend.insert('cad')
-    for seg in dend:
-        seg.tau_cad = 50
-        seg.gbar_ca_hva = 0.01 if seg.x > 0.5 else 0
-    return soma, dend
+    # 共用的模型工厂, 胞体 / 树突 gkbar 是 hh 默认值 (core/model.py 的 AGENT_SPEC)
+    return model.build_model(AGENT_SPEC)
 
 def setup_single_stim(dend, pos, time, weight):
     syn = h.Exp2Syn(dend(pos)); syn.tau1, syn.tau2 = 1, 20
@@ -30,7 +26,7 @@ def setup_single_stim(dend, pos, time, weight):
     nc = h.NetCon(ns, syn); nc.weight[0], nc.delay = weight, 0
     return syn, ns, nc
 
-def calculate_rpe_signal(soma, dend, confidence, is_correct):
+def calculate_rpe_signal(soma, dend, confidence, is_correct, warm=True, recorder=None):
     soma_voltage = -70 + 25 * confidence
     dend_weight = 0.005 if is_correct else 0.0
     
@@ -38,13 +34,20 @@ def calculate_rpe_signal(soma, dend, confidence, is_correct):
     v_clamp.dur1, v_clamp.amp1, v_clamp.rs = 100, soma_voltage, 1e-3
     syn, ns, nc = setup_single_stim(dend, pos=0.8, time=40, weight=dend_weight)
     
-    rec_v_dend_prox = h.Vector().record(dend(0.01)._ref_v)
+    # 只记 41-50 ms 窗口, 传进来的 recorder 的缓冲区每次复用
+    if recorder is None: recorder = Recorder(tstop=100)
+    if 'v_dend_prox' not in recorder.recordings:
+        recorder.add('v_dend_prox', dend(0.01)._ref_v, window=(41, 50))
     h.t, h.v_init, h.dt, h.tstop = 0, -70, 0.025, 100
-    h.run()
+    # 40 ms 之前只有钳位, 直接从快照开始 (CVODE 打开时从头算)
+    if warm and not h.CVode().active():
+        warm_run(40, h.tstop)
+    else:
+        h.run()
     
-    rpe_proxy = np.array(rec_v_dend_prox) - soma_voltage
-    if len(rpe_proxy) < int(50/h.dt): return 0.0
-    peak_rpe = np.max(rpe_proxy[int(41/h.dt):int(50/h.dt)])
+    v_window = recorder.view('v_dend_prox')
+    if len(v_window) < len(recorder.times('v_dend_prox')): return 0.0
+    peak_rpe = v_window.max() - soma_voltage
     
     del v_clamp, syn, ns, nc
     return peak_rpe
@@ -76,10 +79,16 @@ class SimpleAgent:
         else:
             self.confidence = min(1.0, self.confidence + 0.05)
 
-def run_simple_agent_loop():
+def run_simple_agent_loop(use_table=True):
     initialize_neuron_env()
     neuron_soma, neuron_dend = build_model()
     agent = SimpleAgent()
+    rpe_table = None
+    recorder = Recorder(tstop=100)
+    if use_table:
+        rpe_table = RPETable(neuron_soma, neuron_dend,
+                             lambda c, ok: calculate_rpe_signal(neuron_soma, neuron_dend, c, ok, recorder=recorder),
+                             spec=AGENT_SPEC)
     
     world_rule = lambda x: x * 2
     num_trials = 70
@@ -95,7 +104,10 @@ def run_simple_agent_loop():
         correct_answer = world_rule(input_number)
         is_correct = (prediction == correct_answer)
 
-        rpe_signal = calculate_rpe_signal(neuron_soma, neuron_dend, confidence, is_correct)
+        if rpe_table is not None:
+            rpe_signal = rpe_table.lookup(confidence, is_correct)
+        else:
+            rpe_signal = calculate_rpe_signal(neuron_soma, neuron_dend, confidence, is_correct, recorder=recorder)
         rpe_history.append(rpe_signal)
         agent.learn(rpe_signal)
             
@@ -1,117 +1,142 @@
-from neuron import h
+from functools import partial
 
-# 加载机制
-h.load_file('stdrun.hoc')
-try:
-    h.nrn_load_dll('./x86_64/.libs/libnrnmech.so') 
-except:
-    pass
-
-# 构建模型过程与phase 1完全相同，验证过了可行性
-soma = h.Section(name='soma')
-dend = h.Section(name='dend')
-dend.connect(soma(1))
-soma.L = 20; soma.diam = 20
-dend.L = 500; dend.diam = 2; dend.nseg = 51 
-for sec in h.allsec():
-    sec.Ra = 150
-    sec.cm = 1
-soma.insert('hh')
-soma.gnabar_hh = 0.3
-soma.gkbar_hh = 0.036
-soma.gl_hh = 0.0003
-soma.el_hh = -54.3
-dend.insert('hh')
-dend.gkbar_hh = 0.005
-dend.gl_hh = 0.0003
-dend.el_hh = -54.3
-dend.insert('ca_hva')
-dend.insert('cad')
-
-stim_soma = h.IClamp(soma(0.5))
-stim_soma.dur = 5; stim_soma.delay = 15
-
-# 树突末端突触输入
-syn = h.Exp2Syn(dend(1.0)) 
-syn.tau1 = 1; syn.tau2 = 30; syn.e = 0
-
-netstim = h.NetStim()
-netstim.number = 1; netstim.start = 15; netstim.noise = 0
-
-nc = h.NetCon(netstim, syn)
+from core.cell_array import CellArray
+from core.model import DEFAULT_SPEC, build_model, current_cell
+from core.recording import Tracker
+from core.sweep import run_sweep
+from neuron import h
+import numpy as np
 
 # 更新钠通道密度和钙通道密度，直到找到最好的
 def update_params(dend_na, ca_bar):
-    dend.gnabar_hh = dend_na
-    for seg in dend:
-        seg.tau_cad = 50
-        if seg.x > 0.5:
-            seg.gbar_ca_hva = ca_bar
-        else:
-            seg.gbar_ca_hva = 0
-
-# 运行一次
-def run_trial(syn_weight, mode):
+    # 原地改, 不重建模型 (core/model.py)
+    current_cell().update(dend_na=dend_na, ca_bar=ca_bar)
+
+# 逐个 trial 用的刺激: 胞体 IClamp + 树突末端一个突触, 建一次之后每个 trial 只改幅度 / 权重
+def build_trial_rig(soma, dend):
+    stim_soma = h.IClamp(soma(0.5))
+    stim_soma.dur = 5; stim_soma.delay = 15
+
+    # 树突末端突触输入
+    syn = h.Exp2Syn(dend(1.0)) 
+    syn.tau1 = 1; syn.tau2 = 30; syn.e = 0
+
+    netstim = h.NetStim()
+    netstim.number = 1; netstim.start = 15; netstim.noise = 0
+
+    nc = h.NetCon(netstim, syn)
+
+    # run_trial 只要钙峰, 仿真时直接算, 不记录整条曲线
+    ca_tracker = Tracker(dend(1.0), 'cai')
+    return {'stim_soma': stim_soma, 'syn': syn, 'netstim': netstim, 'nc': nc, 'ca_tracker': ca_tracker}
+
+# 运行一次; rig 是 build_trial_rig 的返回值
+def run_trial(rig, syn_weight, mode):
     h.t = 0
     h.v_init = -70
     h.celsius = 30
     h.tstop = 60
     # 只开bap ： bap-only
     if mode in ['bAP_only', 'both']:
-        stim_soma.amp = 1.0
+        rig['stim_soma'].amp = 1.0
     else:
-        stim_soma.amp = 0
+        rig['stim_soma'].amp = 0
     # 只开syn：syn-only
     if mode in ['syn_only', 'both']:
-        nc.weight[0] = syn_weight
+        rig['nc'].weight[0] = syn_weight
     else:
-        nc.weight[0] = 0
+        rig['nc'].weight[0] = 0
         
-    cai_dend = h.Vector().record(dend(1.0)._ref_cai)
     h.run()
-    return cai_dend.max()
-
-# 写个flag
-aaa = False
-
-na_range = [0.052, 0.054, 0.055, 0.056, 0.058]
-
-weight_range = [0.0012, 0.0014, 0.0016, 0.0018]
-
-for test_na in na_range:
-    update_params(dend_na=test_na, ca_bar=0.01) 
-    
-    for test_weight in weight_range:
-        # ca_both = run_trial(test_weight)
-        ca_syn = run_trial(test_weight, 'syn_only')
-        ca_bap = run_trial(test_weight, 'bAP_only')
-        ca_both = run_trial(test_weight, 'both')
-        print(ca_syn)
-        print(ca_bap)
-        print(ca_both)
-
-        baseline = max(ca_syn, ca_bap)
-        if baseline < 1e-6: baseline = 1e-6
-        gain = ca_both / baseline
-
-        # 单独刺激不起效
-        single_safe = (ca_syn < 0.01 and ca_bap < 0.01)
-        # 结合后起效
-        both_spike = (ca_both > 0.02)
-        # 爆炸
-        has_gain = (gain > 2.0)
-        
-        if single_safe and both_spike and has_gain:
-            aaa = True
-
+    return rig['ca_tracker'].max
+
+# 批量版本: 每个 (na, weight, mode) 组合一个细胞, 一批一次 h.run()
+def run_trial_batch(cells, combos):
+    k = len(combos)
+    # 最后一批不满时补上什么都不刺激的细胞
+    combos = list(combos) + [(combos[0][0], 0, 'none')] * (cells.n - k)
+    cells.clear_extras()
+    cells.set_params(dend_na=[c[0] for c in combos])
+    cells.add_soma_iclamp(delay=15, dur=5,
+                          amp=[1.0 if mode in ['bAP_only', 'both'] else 0 for _, _, mode in combos])
+    # 上面的 nc 没设 delay, 是 NetCon 默认的 1 ms
+    cells.add_single_stim(pos=1.0, time=15, tau2=30, delay=1,
+                          weight=[w if mode in ['syn_only', 'both'] else 0 for _, w, mode in combos])
+    return cells.run(tstop=60, celsius=30)['ca_peak'][:k]
+
+# workers > 1 时各批分给进程池, 每个 worker 只建一次 CellArray
+def run_all_trials_batched(na_range, weight_range, workers=1):
+    modes = ['syn_only', 'bAP_only', 'both']
+    combos = [(na, w, mode) for na in na_range for w in weight_range for mode in modes]
+    size = -(-len(combos) // max(workers, 1))
+    chunks = [combos[i:i + size] for i in range(0, len(combos), size)]
+    ca_peak = np.concatenate(list(run_sweep(run_trial_batch, chunks,
+                                            build=partial(CellArray, size, ca_bar=0.01),
+                                            workers=workers)))
+    return dict(zip(combos, ca_peak))
+
+# 用进程池的时候 worker 会重新 import 这个文件, 建模型和搜索都要放在 main 里面
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=1)
+    args = parser.parse_args()
+
+    # 构建模型过程与phase 1完全相同，验证过了可行性 (core/model.py 的 DEFAULT_SPEC)
+    soma, dend = build_model(DEFAULT_SPEC)
+
+    rig = build_trial_rig(soma, dend)
+
+    # 写个flag
+    aaa = False
+    batched = True
+
+    na_range = [0.052, 0.054, 0.055, 0.056, 0.058]
+
+    weight_range = [0.0012, 0.0014, 0.0016, 0.0018]
+
+    if batched:
+        ca_table = run_all_trials_batched(na_range, weight_range, workers=args.workers)
+
+    for test_na in na_range:
+        update_params(dend_na=test_na, ca_bar=0.01) 
+
+        for test_weight in weight_range:
+            # ca_both = run_trial(rig, test_weight)
+            if batched:
+                ca_syn = ca_table[(test_na, test_weight, 'syn_only')]
+                ca_bap = ca_table[(test_na, test_weight, 'bAP_only')]
+                ca_both = ca_table[(test_na, test_weight, 'both')]
+            else:
+                ca_syn = run_trial(rig, test_weight, 'syn_only')
+                ca_bap = run_trial(rig, test_weight, 'bAP_only')
+                ca_both = run_trial(rig, test_weight, 'both')
+            print(ca_syn)
+            print(ca_bap)
+            print(ca_both)
+
+            baseline = max(ca_syn, ca_bap)
+            if baseline < 1e-6: baseline = 1e-6
+            gain = ca_both / baseline
+
+            # 单独刺激不起效
+            single_safe = (ca_syn < 0.01 and ca_bap < 0.01)
+            # 结合后起效
+            both_spike = (ca_both > 0.02)
+            # 爆炸
+            has_gain = (gain > 2.0)
+
+            if single_safe and both_spike and has_gain:
+                aaa = True
+
+            if aaa:
+                break
         if aaa:
             break
+
     if aaa:
-        break
-
-if aaa:
-    print("Finished")
-    print(f"Dend_Na:{test_na}")
-    print(f"Syn_W:{test_weight}")
-else:
-    print("调整一下范围，没找到")
\ No newline at end of file
+        print("Finished")
+        print(f"Dend_Na:{test_na}")
+        print(f"Syn_W:{test_weight}")
+    else:
+        print("调整一下范围，没找到")
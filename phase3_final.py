@@ -1,48 +1,14 @@
+from core.decision import DecisionRun, last_event_time
+from core.rig import SynapseRig
+from core.cache import cached_run, default_cache, spike_count
+from core import integrator
+from core.model import build_model
+from core.plotting import plt
 from neuron import h
-import matplotlib.pyplot as plt
 import numpy as np
 
-# 直接按phase 1 中验证的可行方式构建，并且把phase 2的参数导进去
-h.load_file('stdrun.hoc')
-try:
-    h.nrn_load_dll('./x86_64/.libs/libnrnmech.so') 
-except:
-    pass
-def build_model():
-    soma = h.Section(name='soma')
-    dend = h.Section(name='dend')
-    dend.connect(soma(1))
-
-    soma.L = 20; soma.diam = 20
-    dend.L = 500; dend.diam = 2; dend.nseg = 51 
-
-    for sec in h.allsec():
-        sec.Ra = 150
-        sec.cm = 1
-
-    soma.insert('hh')
-    soma.gnabar_hh = 0.3
-    soma.gkbar_hh = 0.036
-    soma.gl_hh = 0.0003
-    soma.el_hh = -54.3
-
-    dend.insert('hh')
-    dend.gnabar_hh = 0.052  
-    dend.gkbar_hh = 0.005
-    dend.gl_hh = 0.0003
-    dend.el_hh = -54.3
-
-    dend.insert('ca_hva')
-    dend.insert('cad')
-    
-    for seg in dend:
-        seg.tau_cad = 50
-        if seg.x > 0.5:
-            seg.gbar_ca_hva = 0.01 
-        else:
-            seg.gbar_ca_hva = 0
-            
-    return soma, dend
+# 直接按phase 1 中验证的可行方式构建，并且把phase 2的参数导进去 (core/model.py 的 DEFAULT_SPEC)
+# 所有 h.run() 都换成 cached_run (core/cache.py): 模型和刺激都没变时直接读 .sim_cache/results
 
 # build 突触
 def setup_synapses(dend, direction, dt_stim, syn_weight):
@@ -83,16 +49,15 @@ def run_speed_tuning(soma, dend):
     dt_list = [1, 2, 3, 4, 5, 6, 8, 10]
     spike_counts = []
     
+    rig = SynapseRig(dend, weights=0.0014)
     for dt in dt_list:
-        syns, nss, ncs = setup_synapses(dend, 'preferred', dt, syn_weight=0.0014)
-        print(syns,nss,ncs)
-        ap_count = h.APCount(soma(0.5))
-        ap_count.thresh = 0
+        rig.set_direction('preferred', dt)
         
         h.t = 0; h.v_init = -70; h.celsius = 30; h.tstop = 100
-        h.run()
+        res = cached_run({'v_soma': (soma(0.5), 'v')})
         
-        count = ap_count.n
+        # 原来是 soma(0.5) 上 thresh=0 的 APCount
+        count = spike_count(res['traces']['v_soma'])
         spike_counts.append(count)
         print(spike_counts)
         
@@ -111,30 +76,24 @@ def run_direction_test(soma, dend):
     optimal_dt = 3 
     # pre
     syns1, nss1, ncs1 = setup_synapses(dend, 'preferred', optimal_dt, syn_weight=0.0014)
-    
-    t_vec = h.Vector().record(h._ref_t)
-    v_soma_pref = h.Vector().record(soma(0.5)._ref_v)
-    ca_dend_pref = h.Vector().record(dend(1.0)._ref_cai)
+    records = {'t': 't', 'v_soma': (soma(0.5), 'v'), 'ca': (dend(1.0), 'cai')}
     
     h.t = 0; h.v_init = -70; h.celsius = 30; h.tstop = 100
-    h.run()
+    res = cached_run(records)
     
-    t = np.array(t_vec)
-    vs_p = np.array(v_soma_pref)
-    ca_p = np.array(ca_dend_pref)
+    t = res['traces']['t']
+    vs_p = res['traces']['v_soma']
+    ca_p = res['traces']['ca']
     print(ca_p.max())
     del syns1, nss1, ncs1 
     # null
     syns2, nss2, ncs2 = setup_synapses(dend, 'null', optimal_dt, syn_weight=0.0014)
     
-    v_soma_null = h.Vector().record(soma(0.5)._ref_v)
-    ca_dend_null = h.Vector().record(dend(1.0)._ref_cai)
-    
     h.t = 0; h.v_init = -70; h.celsius = 30; h.tstop = 100
-    h.run()
+    res = cached_run(records)
     
-    vs_n = np.array(v_soma_null)
-    ca_n = np.array(ca_dend_null)
+    vs_n = res['traces']['v_soma']
+    ca_n = res['traces']['ca']
     print(ca_n.max())
 
     denom = ca_p.max() + ca_n.max()
@@ -161,26 +120,23 @@ def run_direction_test(soma, dend):
 # experiment 3：依赖bap实验
 def run_mechanism_proof(soma, dend):
 
-    t_vec = h.Vector().record(h._ref_t)
-    cai_control = h.Vector().record(dend(1.0)._ref_cai) # normal
-    cai_ttx = h.Vector().record(dend(1.0)._ref_cai)     # ttx
-    v_soma_ttx = h.Vector().record(soma(0.5)._ref_v) 
+    records = {'t': 't', 'cai': (dend(1.0), 'cai'), 'v_soma': (soma(0.5), 'v')}
 
     # normal
     syns, nss, ncs = setup_synapses(dend, 'preferred', dt_stim=3, syn_weight=0.0014)
 
     h.t = 0; h.v_init = -70; h.celsius = 30; h.tstop = 100
-    h.run()
-    cai_control_data = np.array(cai_control)
+    cai_control_data = cached_run(records)['traces']['cai']
 
     # ttx
     saved_gnabar = soma.gnabar_hh
     soma.gnabar_hh = 0 
 
     h.t = 0; h.v_init = -70
-    h.run()
-    cai_ttx_data = np.array(cai_ttx)
-    v_soma_ttx_data = np.array(v_soma_ttx)
+    res = cached_run(records)
+    t_vec = res['traces']['t']
+    cai_ttx_data = res['traces']['cai']
+    v_soma_ttx_data = res['traces']['v_soma']
 
     soma.gnabar_hh = saved_gnabar
 
@@ -211,25 +167,22 @@ def run_jitter_test(soma, dend):
     sigma_list = [0, 1, 2, 3, 5]
     dsi_list = []
     
+    # 同一套突触: 以前每个 sigma 新建两套, null 那次 preferred 的突触也还在
+    rig = SynapseRig(dend, weights=0.0014)
+    records = {'ca': (dend(1.0), 'cai')}
     for sigma in sigma_list:
-        syns1, nss1, ncs1 = setup_synapses(dend, 'preferred', dt_stim=3, syn_weight=0.0014)
-        
-        for ns in nss1:
-            noise_val = np.random.normal(0, sigma)
-            ns.start += noise_val
+        rig.set_direction('preferred', 3)
+        rig.jitter(sigma)
             
-        h.t = 0; h.v_init = -70; h.run()
-        ca_p = h.Vector().record(dend(1.0)._ref_cai); h.run()
-        peak_p = np.array(ca_p).max()
+        h.t = 0; h.v_init = -70
+        peak_p = cached_run(records)['scalars']['ca_max']
         
         # null
-        syns2, nss2, ncs2 = setup_synapses(dend, 'null', dt_stim=3, syn_weight=0.0014)
-        for ns in nss2:
-            ns.start += np.random.normal(0, sigma)
+        rig.set_direction('null', 3)
+        rig.jitter(sigma)
             
-        h.t = 0; h.v_init = -70; h.run()
-        ca_n = h.Vector().record(dend(1.0)._ref_cai); h.run()
-        peak_n = np.array(ca_n).max()
+        h.t = 0; h.v_init = -70
+        peak_n = cached_run(records)['scalars']['ca_max']
         
         denom = peak_p + peak_n
         if denom < 1e-9: denom = 1e-9
@@ -260,11 +213,10 @@ def run_attention_test(soma, dend):
         
         # pref
         syns, nss, ncs = setup_synapses(dend, 'preferred', dt_stim=3, syn_weight=0.0014)
-        v_dend = h.Vector().record(dend(1.0)._ref_v)
-        t_vec = h.Vector().record(h._ref_t)
         
-        h.t = 0; h.v_init = -70; h.run()
-        results[name] = (np.array(t_vec), np.array(v_dend))
+        h.t = 0; h.v_init = -70
+        res = cached_run({'t': 't', 'v_dend': (dend(1.0), 'v')})
+        results[name] = (res['traces']['t'], res['traces']['v_dend'])
         
     # Plot
     plt.figure()
@@ -282,7 +234,7 @@ def run_attention_test(soma, dend):
 
 # experiment 6: moni 强化学习
 
-def run_secondary_conditioning(soma, dend):  
+def run_secondary_conditioning(soma, dend, decision=False):  
 
     def update_weight(w, coincident_detected):
         learning_rate = 0.0002
@@ -313,7 +265,7 @@ def run_secondary_conditioning(soma, dend):
         
         objects_phase1.extend([syn1, ns1, nc1, stim_us, ap_counter])
 
-        h.t = 0; h.v_init = -70; h.tstop = 100; h.run()
+        h.t = 0; h.v_init = -70; h.tstop = 100; cached_run({})
         
         w_CS1 = update_weight(w_CS1, True) 
         
@@ -325,6 +277,7 @@ def run_secondary_conditioning(soma, dend):
     # CS 2 --CS1
     
     objects_phase2 = []
+    decider = DecisionRun(dend(1.0), 0.1) if decision else None
 
     for trial in range(30):
         syn2, ns2, nc2 = setup_single_stim(dend, pos=1.0, time=30, weight=w_CS2) 
@@ -333,12 +286,15 @@ def run_secondary_conditioning(soma, dend):
         
         objects_phase2.extend([syn1, ns1, nc1, syn2, ns2, nc2])
         
-        ca_rec = h.Vector().record(dend(1.0)._ref_cai)
-        h.t = 0; h.v_init = -70; h.tstop = 100; h.run()
-
-        max_ca = np.array(ca_rec).max() if len(ca_rec) > 0 else 0
-        coincidence = (max_ca > 0.1)
-        print(max_ca)
+        if decision:
+            # 之前 trial 的刺激都还留在 objects_phase2 里, 所以扫描整个模型找最后一个输入
+            h.t = 0; h.v_init = -70
+            coincidence, _ = decider.run(last_event_time(), tstop=100)
+        else:
+            h.t = 0; h.v_init = -70; h.tstop = 100
+            max_ca = cached_run({'ca': (dend(1.0), 'cai')})['scalars'].get('ca_max', 0)
+            coincidence = (max_ca > 0.1)
+            print(max_ca)
         print(coincidence)
 
         w_CS2 = update_weight(w_CS2, coincidence)
@@ -349,6 +305,9 @@ def run_secondary_conditioning(soma, dend):
         history_w2.append(w_CS2)
         
     del objects_phase2
+    if decision:
+        print(f"decision mode: mean simulated time {decider.mean_time():.1f} / 100 ms")
+        decider.close()
 
     plt.figure(figsize=(10, 6))
     plt.plot(history_w1, label='CS1 Weight (Proximal)', color='blue', linewidth=2)
@@ -399,13 +358,11 @@ def run_morphological_rpe_experiment(soma, dend):
 
         syn, ns, nc = setup_single_stim(dend, pos=0.8, time=40, weight=scenario['r_weight'])
     
-        rec_v_soma = h.Vector().record(soma(0.5)._ref_v)
-        rec_v_dend_prox = h.Vector().record(dend(0.01)._ref_v) 
-        rec_t = h.Vector().record(h._ref_t)
-        
-        h.t = 0; h.v_init = -70; h.celsius = 30; h.run()
+        h.t = 0; h.v_init = -70; h.celsius = 30
+        res = cached_run({'t': 't', 'v_soma': (soma(0.5), 'v'), 'v_dend_prox': (dend(0.01), 'v')})
+        rec_t = res['traces']['t']
 
-        rpe_proxy = np.array(rec_v_dend_prox) - np.array(rec_v_soma)
+        rpe_proxy = res['traces']['v_dend_prox'] - res['traces']['v_soma']
         
         plt.plot(rec_t, rpe_proxy, label=f"{scenario['name']}")
         
@@ -423,7 +380,15 @@ def run_morphological_rpe_experiment(soma, dend):
     plt.savefig('exp7_morphological_rpe.png')
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    # --integrator global/local 用 CVODE 跑所有实验, 见 core/integrator.py
+    integrator.add_arguments(parser)
+    args = parser.parse_args()
+
     my_soma, my_dend = build_model()
+    # 模型建好之后再设积分器: 没有 section 时 NEURON 不理 use_local_dt(1)
+    integrator.configure_from_args(args)
     
     run_speed_tuning(my_soma, my_dend)
     run_direction_test(my_soma, my_dend)
@@ -431,4 +396,6 @@ if __name__ == '__main__':
     # run_jitter_test(my_soma, my_dend)
     # run_attention_test(my_soma, my_dend)
     run_secondary_conditioning(my_soma, my_dend)
-    # run_morphological_rpe_experiment(my_soma, my_dend)
\ No newline at end of file
+    # run_morphological_rpe_experiment(my_soma, my_dend)
+
+    print(f"result cache: {default_cache().stats}")
\ No newline at end of file
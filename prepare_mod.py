@@ -1,4 +1,9 @@
+import argparse
+import json
 import os
+import subprocess
+import sys
+import tempfile
 
 cad_code_clean = """
 TITLE Decay of internal calcium concentration
@@ -42,10 +47,6 @@ DERIVATIVE state {
 }
 """
 
-with open('cad.mod', 'w') as f:
-    f.write(cad_code_clean)
-print("Created clean cad.mod")
-
 ca_hva_code_clean = """
 TITLE High Voltage Activated Calcium channel
 
@@ -109,6 +110,272 @@ PROCEDURE rates(v (mV)) {
 }
 """
 
-with open('ca_hva.mod', 'w') as f:
-    f.write(ca_hva_code_clean)
-print("Created clean ca_hva.mod")
\ No newline at end of file
+# Tracker: 跟着一个变量 (POINTER x, 例如 dend(1.0) 的 cai) 在仿真过程中算 max / argmax / min / 积分 /
+# 上穿阈值次数, 不用记录整条曲线; 只统计 [tbegin, tend) 窗口里的采样点
+# 和 Vector.record 一样在 t=0 (INITIAL) 和每一步之后各取一次样; 用法见 core/recording.py
+tracker_code = """
+TITLE Online reducers over a pointed-to variable
+
+NEURON {
+    THREADSAFE
+    POINT_PROCESS Tracker
+    POINTER x
+    RANGE tbegin, tend, thresh
+    RANGE xmax, tmax, xmin, tmin, integral, ncross, nsamples
+}
+
+UNITS {
+    (mV) = (millivolt)
+}
+
+PARAMETER {
+    tbegin = 0 (ms)
+    tend = 1e9 (ms)
+    thresh = 0
+}
+
+ASSIGNED {
+    x
+    dt (ms)
+    xmax
+    tmax (ms)
+    xmin
+    tmin (ms)
+    integral
+    ncross
+    nsamples
+    above
+    xlast
+    tlast (ms)
+}
+
+INITIAL {
+    xmax = -1e300
+    tmax = -1
+    xmin = 1e300
+    tmin = -1
+    integral = 0
+    ncross = 0
+    nsamples = 0
+    above = 0
+    sample()
+}
+
+BREAKPOINT {
+    SOLVE sample METHOD after_cvode
+}
+
+PROCEDURE sample() {
+    : same half-open window as slicing a recorded trace by round(t/dt)
+    if (t >= tbegin - dt/2 && t < tend - dt/2) {
+        if (x > xmax) {
+            xmax = x
+            tmax = t
+        }
+        if (x < xmin) {
+            xmin = x
+            tmin = t
+        }
+        if (nsamples > 0) {
+            integral = integral + (x + xlast) * (t - tlast) / 2
+        }
+        : upward crossings, counted like APCount
+        if (x >= thresh) {
+            if (above == 0) {
+                ncross = ncross + 1
+            }
+            above = 1
+        } else {
+            above = 0
+        }
+        xlast = x
+        tlast = t
+        nsamples = nsamples + 1
+    }
+}
+"""
+
+# 查表版 ca_hva: rates() 前加 TABLE, NEURON 在 v 的网格上预先算好 minf/mtau/hinf/htau, 每步线性插值,
+# 省掉 4 次 exp; 运行时 h.usetable_ca_hva = 0 可以切回解析式
+# 网格默认 -100..100 mV, 2000 格 (0.1 mV): 钙峰在阈值附近很敏感, hh 那样的 1 mV 网格会让
+# 阈值附近的钙峰差 10% 以上 (python prepare_mod.py --benchmark)
+# v = -27 正好在网格上, m 的 alpha 要取 0/0 的极限
+ca_hva_rates_clean = """    : m - activation
+    alpha = 0.055 * (-27 - v) / (exp((-27 - v)/3.8) - 1)"""
+
+ca_hva_rates_table = """    TABLE minf, mtau, hinf, htau FROM {vmin} TO {vmax} WITH {size}
+
+    : m - activation
+    if (fabs(-27 - v) < 1e-6) {{
+        alpha = 0.055 * 3.8
+    }} else {{
+        alpha = 0.055 * (-27 - v) / (exp((-27 - v)/3.8) - 1)
+    }}"""
+
+# 快速版 cad: cnexp 每步都重新算 exp(-dt/tau), 这里在 INITIAL 里算一次衰减系数, 之后每步只做一次乘加
+# 结果和 cnexp 只差舍入; 只适用于固定步长, CVODE 下要用原来的 DERIVATIVE 版本
+cad_code_fast = """
+TITLE Decay of internal calcium concentration (fixed-step update)
+
+NEURON {
+    SUFFIX cad
+    USEION ca READ ica, cai WRITE cai
+    RANGE depth, tau, cai0, decay
+}
+
+UNITS {
+    (mM) = (milli/liter)
+    (mA) = (milliamp)
+    F = (faraday) (coulomb)
+}
+
+PARAMETER {
+    depth = 0.1 (um)      : depth of shell
+    tau = 50 (ms)         : decay time constant
+    cai0 = 1e-4 (mM)      : initial concentration
+}
+
+ASSIGNED {
+    ica (mA/cm2)
+    dt (ms)
+    decay (1)             : 1 - exp(-dt/tau)
+}
+
+STATE {
+    cai (mM)
+}
+
+INITIAL {
+    cai = cai0
+    decay = 1 - exp(-dt/tau)
+}
+
+BREAKPOINT {
+    SOLVE state
+}
+
+PROCEDURE state() {
+    : exact solution of the cnexp step: cai relaxes to its steady state by exp(-dt/tau)
+    cai = cai + decay * (cai0 - tau*(10000)*(ica)/(2*F*depth) - cai)
+}
+"""
+
+
+def ca_hva_code(table=None):
+    # table: (vmin, vmax, size) 生成查表版, None 是原来的解析版
+    if table is None:
+        return ca_hva_code_clean
+    vmin, vmax, size = table
+    return ca_hva_code_clean.replace(
+        ca_hva_rates_clean, ca_hva_rates_table.format(vmin=vmin, vmax=vmax, size=size))
+
+
+def cad_code(fast=False):
+    return cad_code_fast if fast else cad_code_clean
+
+
+def write_mod_files(directory='.', table=None, fast_cad=False, verbose=True):
+    for name, code in (('cad.mod', cad_code(fast_cad)), ('ca_hva.mod', ca_hva_code(table)),
+                       ('tracker.mod', tracker_code)):
+        with open(os.path.join(directory, name), 'w') as f:
+            f.write(code)
+        if verbose:
+            print(f"Created {name}")
+
+
+# ---- 基准: 解析版 vs 查表版, 钙峰误差和每个 trial 的耗时 ----
+# 每个版本在临时目录里单独 nrnivmodl, 在那个目录下起子进程跑 (import neuron 会自动加载 ./x86_64)
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+def _build_variant(directory, table, fast_cad):
+    write_mod_files(directory, table, fast_cad, verbose=False)
+    subprocess.run(['nrnivmodl'], cwd=directory, check=True, stdout=subprocess.DEVNULL)
+
+
+def _run_variant(directory, n_w, repeat, usetable=None):
+    cmd = [sys.executable, os.path.join(ROOT, 'prepare_mod.py'), '--bench-worker',
+           '--n-w', str(n_w), '--repeat', str(repeat)]
+    if usetable is not None:
+        cmd += ['--usetable', str(usetable)]
+    env = dict(os.environ, PYTHONPATH=ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    out = subprocess.run(cmd, cwd=directory, env=env, check=True, capture_output=True, text=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def _bench_worker(n_w, repeat=3, usetable=None):
+    # 在临时目录里被调用: 每个 (权重, 方向) 一个细胞, 记下钙峰 / 发放数 / 耗时 (取 repeat 次里最快的)
+    import time
+    import numpy as np
+    from neuron import h
+    from core.cell_array import simulate_delay_line
+    from core.env import setup
+
+    setup()
+    if usetable is not None:
+        h.usetable_ca_hva = usetable
+    w_range = np.linspace(0.0005, 0.002, n_w)
+    weights = np.concatenate([w_range, w_range])
+    directions = ['preferred'] * n_w + ['null'] * n_w
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        ca_peak, spikes = simulate_delay_line(weights, directions, batch_size=len(weights), warm=False)
+        elapsed.append(time.perf_counter() - start)
+    print(json.dumps({'ca_peak': ca_peak.tolist(), 'spikes': spikes.tolist(),
+                      'ms_per_trial': min(elapsed) / len(weights) * 1e3}))
+
+
+def benchmark(vmin, vmax, sizes, n_w=50, repeat=3):
+    # 同一组 (权重, 方向) 下: 解析版, 只换 cad, 以及每种表格分辨率的查表版 ca_hva + 快速 cad
+    import numpy as np
+
+    runs = {}
+    with tempfile.TemporaryDirectory() as directory:
+        _build_variant(directory, None, False)
+        runs['analytic'] = _run_variant(directory, n_w, repeat)
+    for i, size in enumerate(sizes):
+        with tempfile.TemporaryDirectory() as directory:
+            _build_variant(directory, (vmin, vmax, size), True)
+            if i == 0:
+                # usetable = 0 时 ca_hva 就是解析式
+                runs['fast cad'] = _run_variant(directory, n_w, repeat, usetable=0)
+            runs[f'table {size} + fast cad'] = _run_variant(directory, n_w, repeat, usetable=1)
+
+    ref = runs['analytic']
+    ref_peak = np.array(ref['ca_peak'])
+    print(f"ca_hva TABLE FROM {vmin} TO {vmax}, {2 * n_w} trials per variant (weights 0.0005-0.002, both directions)")
+    print(f"{'variant':<26}{'ms/trial':>10}{'speedup':>9}{'max |dCa| (mM)':>16}{'median rel':>12}"
+          f"{'max rel':>10}{'spike diff':>12}")
+    for name, run in runs.items():
+        peak = np.array(run['ca_peak'])
+        rel = np.abs(peak - ref_peak) / ref_peak
+        spike_diff = int(np.count_nonzero(np.array(run['spikes']) != np.array(ref['spikes'])))
+        print(f"{name:<26}{run['ms_per_trial']:>10.2f}{ref['ms_per_trial'] / run['ms_per_trial']:>9.2f}"
+              f"{np.abs(peak - ref_peak).max():>16.2e}{np.median(rel):>12.2e}{rel.max():>10.2e}"
+              f"{spike_diff:>12d}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--table', action='store_true', help='生成查表版 ca_hva')
+    parser.add_argument('--vmin', type=float, default=-100)
+    parser.add_argument('--vmax', type=float, default=100)
+    parser.add_argument('--table-size', type=int, default=2000)
+    parser.add_argument('--fast-cad', action='store_true', help='生成固定步长的快速 cad')
+    parser.add_argument('--benchmark', action='store_true', help='比较解析版和查表版, 不改当前目录的 .mod')
+    parser.add_argument('--bench-sizes', type=int, nargs='+', default=[200, 2000, 20000])
+    parser.add_argument('--n-w', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--bench-worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--usetable', type=int, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.bench_worker:
+        _bench_worker(args.n_w, args.repeat, args.usetable)
+    elif args.benchmark:
+        benchmark(args.vmin, args.vmax, args.bench_sizes, args.n_w, args.repeat)
+    else:
+        table = (args.vmin, args.vmax, args.table_size) if args.table else None
+        write_mod_files(table=table, fast_cad=args.fast_cad)
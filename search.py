@@ -1,51 +1,15 @@
-import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.colors import LinearSegmentedColormap
+# core 要在 neuron 之前 import (无 GUI 启动); 画图和加载机制都推迟到用的时候
+from core import integrator, numpy_backend
+from core.cell_array import create_delay_line_store, simulate_delay_line
+from core.decision import DecisionRun, last_event_time
+from core.model import DEFAULT_SPEC, build_model
+from core.plotting import plt
+from core.recording import Tracker
+from core.rig import SynapseRig
+from core.trace_store import TraceStore
 from neuron import h
-import matplotlib.pyplot as plt
 import numpy as np
-import random
-
-h.load_file('stdrun.hoc')
-try:
-    h.nrn_load_dll('./x86_64/.libs/libnrnmech.so') 
-except:
-    print("Warning")
-
-def build_model():
-    soma = h.Section(name='soma')
-    dend = h.Section(name='dend')
-    dend.connect(soma(1))
-
-    soma.L = 20; soma.diam = 20
-    dend.L = 500; dend.diam = 2; dend.nseg = 51 
-    for sec in h.allsec():
-        sec.Ra = 150   
-        sec.cm = 1     
-
-    soma.insert('hh')
-    soma.gnabar_hh = 0.3
-    soma.gkbar_hh = 0.036
-    soma.gl_hh = 0.0003
-    soma.el_hh = -54.3
-
-    dend.insert('hh')
-    dend.gnabar_hh = 0.052   
-    dend.gkbar_hh = 0.005
-    dend.gl_hh = 0.0003
-    dend.el_hh = -54.3
-
-    dend.insert('ca_hva')
-    dend.insert('cad') 
-    
-    for seg in dend:
-        seg.tau_cad = 50 
-        if seg.x > 0.5:
-            seg.gbar_ca_hva = 0.01 
-        else:
-            seg.gbar_ca_hva = 0
-            
-    return soma, dend
+
 
 def setup_synapses(dend, direction, dt_stim, syn_weight):
     weights = [syn_weight] * 5
@@ -298,42 +262,97 @@ def setup_synapses_weighted(dend, direction, dt_stim, weights):
     
 #     plt.savefig('exp5_risk_aversion.png')
 
-# grid search
-def run_grid_search_plasticity(soma, dend):
+# 每个 (th, w0) 格子的 test_trials 个方向, 0=preferred 1=null; 逐 trial 仿真和查峰值表两条路径抽的一样
+def draw_directions(n_th, n_w, test_trials, seed=0):
+    return np.random.default_rng(seed).integers(0, 2, size=(n_th, n_w, test_trials))
 
-    w_range = np.linspace(0.0008, 0.0016, 10) 
-    th_range = np.linspace(0.04, 0.16, 10)
+def run_grid_search_serial(dend, w_range, th_range, test_trials, decision=False, seed=0):
+    # decision: 钙峰过阈值或者确定不会过阈值时就停, 不跑满 100 ms
     heatmap_data = np.zeros((len(th_range), len(w_range)))
+    dir_idx = draw_directions(len(th_range), len(w_range), test_trials, seed)
+    rig = SynapseRig(dend)
+    decider = DecisionRun(dend(1.0), th_range[0]) if decision else None
+    ca_tracker = None if decision else Tracker(dend(1.0), 'cai')
 
-    test_trials = 20
-
-    total_steps = len(w_range) * len(th_range)
-    step = 0
-    
     for i, th in enumerate(th_range):
         for j, w0 in enumerate(w_range):
             
             ltp_count = 0
  
             for k in range(test_trials):
-                direction = random.choice(['preferred', 'null'])
-                current_weights = [w0] * 5
-                syns, nss, ncs = setup_synapses_weighted(dend, direction, dt_stim=3, weights=current_weights)
+                direction = ['preferred', 'null'][dir_idx[i, j, k]]
+                rig.set(direction, 3, w0)
 
-                ca_rec = h.Vector().record(dend(1.0)._ref_cai)
                 h.t = 0; h.v_init = -70; h.celsius = 30; h.tstop = 100
-                h.run()
-
-                max_ca = np.array(ca_rec).max()
-                if max_ca > th:
+                if decision:
+                    decider.threshold = th
+                    is_ltp, _ = decider.run(last_event_time(rig.netstims, rig.ncs))
+                else:
+                    h.run()
+                    is_ltp = ca_tracker.max > th
+
+                if is_ltp:
                     ltp_count += 1
-                del syns, nss, ncs
             
             ratio = ltp_count / test_trials
             heatmap_data[i, j] = ratio
-            
-            step += 1
 
+    if decision:
+        print(f"decision mode: mean simulated time {decider.mean_time():.1f} / {h.tstop:.0f} ms")
+        decider.close()
+    return heatmap_data
+
+# 噪声为 0 时钙峰只取决于 (w0, direction), 每个组合仿真一次
+# 返回 (2, len(w_range)): 第 0 行 preferred, 第 1 行 null
+# nseg: 树突的 nseg, 默认 DEFAULT_SPEC 的 51 (numpy 后端只支持 51)
+def compute_peak_table(w_range, dt_stim=3, batch_size=200, workers=1, backend='neuron', nseg=None):
+    n = len(w_range)
+    weights = np.concatenate([w_range, w_range])
+    directions = ['preferred'] * n + ['null'] * n
+    params = None if nseg is None else {'dend_nseg': nseg}
+    if backend == 'numpy':
+        if nseg not in (None, numpy_backend.DEND_NSEG):
+            raise ValueError(f"numpy backend is fixed at nseg={numpy_backend.DEND_NSEG}, got {nseg}")
+        # 不经过 NEURON 的批量积分 (core/numpy_backend.py), 适合很大的网格
+        ca_peak, _ = numpy_backend.simulate_delay_line(weights, directions, dt_stim=dt_stim, workers=workers)
+    else:
+        ca_peak, _ = simulate_delay_line(weights, directions, dt_stim=dt_stim, batch_size=batch_size,
+                                         params=params, workers=workers)
+    return ca_peak.reshape(2, n)
+
+# 和 compute_peak_table 一样, 另外把每个点的 soma V / dend(1.0) cai / dend(0.01) V 整条曲线写进 store 目录
+# store 里有 w_range / 树突 nseg 和每个点的钙峰, 之后 peak_table_from_store 就能重画热力图, 不用再仿真
+# 只支持 NEURON 后端 (numpy 后端不出曲线)
+def store_peak_table(store_path, w_range, dt_stim=3, batch_size=200, workers=1, nseg=None):
+    n = len(w_range)
+    params = None if nseg is None else {'dend_nseg': nseg}
+    create_delay_line_store(store_path, params=list(params or ()),
+                            attrs={'experiment': 'grid_search', 'w_range': list(map(float, w_range)),
+                                   'dt_stim': dt_stim, 'dend_nseg': nseg or DEFAULT_SPEC.dend_nseg},
+                            overwrite=True)
+    simulate_delay_line(np.concatenate([w_range, w_range]), ['preferred'] * n + ['null'] * n, dt_stim=dt_stim,
+                        batch_size=batch_size, params=params, workers=workers, store=store_path)
+    return peak_table_from_store(TraceStore(store_path))
+
+def peak_table_from_store(store):
+    # 返回 (w_range, peak_table); point 是 compute_peak_table 里的下标, 前一半 preferred 后一半 null
+    w_range = np.array(store.attrs['w_range'])
+    index = store.index()
+    if len(store) != 2 * len(w_range):
+        raise ValueError(f"trace store {store.path} has {len(store)} of {2 * len(w_range)} points")
+    peaks = np.empty(2 * len(w_range))
+    peaks[index['point']] = index['ca_peak']
+    return w_range, peaks.reshape(2, len(w_range))
+
+# 阈值只作用在钙峰上, 整张热力图直接由峰值表算出来, 不用再仿真
+def ltp_ratio_heatmap(peak_table, th_range, test_trials=20, seed=0):
+    n_w = peak_table.shape[1]
+    dir_idx = draw_directions(len(th_range), n_w, test_trials, seed)
+    peaks = peak_table[dir_idx, np.arange(n_w)[None, :, None]]
+    return (peaks > th_range[:, None, None]).mean(axis=2)
+
+def plot_heatmap(heatmap_data, w_range, th_range, filename='grid_search_plasticity.png'):
+    from matplotlib.colors import LinearSegmentedColormap
     plt.figure(figsize=(10, 8))
     cmap = LinearSegmentedColormap.from_list("Plasticity", ["#00008B", "#00BFFF", "#32CD32", "#FFD700", "#FF4500"])
     
@@ -347,10 +366,75 @@ def run_grid_search_plasticity(soma, dend):
     plt.plot(0.0012, 0.08, 'wx', markersize=10, markeredgewidth=2, label='Current Config (0.0012, 0.08)')
     plt.legend(loc='upper left')
     
-    plt.savefig('grid_search_plasticity.png')
+    plt.savefig(filename)
+
+# grid search
+def run_grid_search_plasticity(soma, dend, n_w=10, n_th=10, test_trials=20, seed=0, serial=False, decision=False,
+                               workers=1, backend='neuron', store=None, from_store=None, nseg=None):
+
+    w_range = np.linspace(0.0008, 0.0016, n_w) 
+    th_range = np.linspace(0.04, 0.16, n_th)
+
+    if from_store is not None:
+        # 已经存好的 sweep, 只重画
+        trace_store = TraceStore(from_store)
+        # 早期的 store 没记 nseg
+        print(f"{from_store}: dend nseg={trace_store.attrs.get('dend_nseg', 'unknown')}")
+        w_range, peak_table = peak_table_from_store(trace_store)
+        heatmap_data = ltp_ratio_heatmap(peak_table, th_range, test_trials, seed)
+    elif store is not None:
+        if backend != 'neuron':
+            raise ValueError("store needs the neuron backend")
+        _, peak_table = store_peak_table(store, w_range, workers=workers, nseg=nseg)
+        heatmap_data = ltp_ratio_heatmap(peak_table, th_range, test_trials, seed)
+    elif serial:
+        # 原来的逐 trial 仿真, n_th * n_w * test_trials 次 h.run(), 只留作对照
+        heatmap_data = run_grid_search_serial(dend, w_range, th_range, test_trials, decision=decision, seed=seed)
+    else:
+        # 2 * n_w 次仿真
+        peak_table = compute_peak_table(w_range, workers=workers, backend=backend, nseg=nseg)
+        heatmap_data = ltp_ratio_heatmap(peak_table, th_range, test_trials, seed)
+
+    plot_heatmap(heatmap_data, w_range, th_range)
+    return heatmap_data
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n-w', type=int, default=10)
+    parser.add_argument('--n-th', type=int, default=10)
+    parser.add_argument('--trials', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--serial', action='store_true')
+    # 只对 --serial 有效: 逐 trial 仿真时提前结束
+    parser.add_argument('--decision', action='store_true')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--backend', choices=['neuron', 'numpy'], default='neuron')
+    # 把每个点的曲线存进目录 / 从存好的目录重画热力图
+    parser.add_argument('--store', default=None)
+    parser.add_argument('--from-store', default=None)
+    # 按 d_lambda 规则选树突 nseg (例如 0.1), 默认用原来的 51; 各 nseg 的误差见 python -m core.convergence
+    parser.add_argument('--d-lambda', type=float, default=None)
+    integrator.add_arguments(parser)
+    args = parser.parse_args()
+    if args.backend == 'numpy' and args.integrator != 'fixed':
+        # numpy 后端是自己的定步长积分, 不用 NEURON 的积分器
+        parser.error('--integrator only applies to --backend neuron')
+    if args.backend == 'numpy' and args.store is not None:
+        parser.error('--store only applies to --backend neuron')
+    if args.decision and not args.serial:
+        parser.error('--decision only applies to --serial')
+
+    spec = DEFAULT_SPEC if args.d_lambda is None else DEFAULT_SPEC.with_d_lambda(args.d_lambda)
+    if args.d_lambda is not None:
+        print(f"d_lambda={args.d_lambda:g}: dend nseg={spec.dend_nseg}")
     if 'my_soma' not in locals():
-        my_soma, my_dend = build_model()
+        my_soma, my_dend = build_model(spec)
+    # 模型建好之后再设积分器: 没有 section 时 NEURON 不理 use_local_dt(1)
+    integrator.configure_from_args(args)
         
-    run_grid_search_plasticity(my_soma, my_dend)
\ No newline at end of file
+    run_grid_search_plasticity(my_soma, my_dend, n_w=args.n_w, n_th=args.n_th,
+                               test_trials=args.trials, seed=args.seed, serial=args.serial,
+                               decision=args.decision, workers=args.workers, backend=args.backend,
+                               store=args.store, from_store=args.from_store,
+                               nseg=None if args.d_lambda is None else spec.dend_nseg)
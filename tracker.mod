@@ -0,0 +1,80 @@
+
+TITLE Online reducers over a pointed-to variable
+
+NEURON {
+    THREADSAFE
+    POINT_PROCESS Tracker
+    POINTER x
+    RANGE tbegin, tend, thresh
+    RANGE xmax, tmax, xmin, tmin, integral, ncross, nsamples
+}
+
+UNITS {
+    (mV) = (millivolt)
+}
+
+PARAMETER {
+    tbegin = 0 (ms)
+    tend = 1e9 (ms)
+    thresh = 0
+}
+
+ASSIGNED {
+    x
+    dt (ms)
+    xmax
+    tmax (ms)
+    xmin
+    tmin (ms)
+    integral
+    ncross
+    nsamples
+    above
+    xlast
+    tlast (ms)
+}
+
+INITIAL {
+    xmax = -1e300
+    tmax = -1
+    xmin = 1e300
+    tmin = -1
+    integral = 0
+    ncross = 0
+    nsamples = 0
+    above = 0
+    sample()
+}
+
+BREAKPOINT {
+    SOLVE sample METHOD after_cvode
+}
+
+PROCEDURE sample() {
+    : same half-open window as slicing a recorded trace by round(t/dt)
+    if (t >= tbegin - dt/2 && t < tend - dt/2) {
+        if (x > xmax) {
+            xmax = x
+            tmax = t
+        }
+        if (x < xmin) {
+            xmin = x
+            tmin = t
+        }
+        if (nsamples > 0) {
+            integral = integral + (x + xlast) * (t - tlast) / 2
+        }
+        : upward crossings, counted like APCount
+        if (x >= thresh) {
+            if (above == 0) {
+                ncross = ncross + 1
+            }
+            above = 1
+        } else {
+            above = 0
+        }
+        xlast = x
+        tlast = t
+        nsamples = nsamples + 1
+    }
+}
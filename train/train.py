@@ -1,49 +1,19 @@
-from neuron import h
-import matplotlib.pyplot as plt
+import os
+import sys
 import numpy as np
 import random
 
-h.load_file('stdrun.hoc')
-try:
-    h.nrn_load_dll('./x86_64/.libs/libnrnmech.so') 
-except:
-    print("Warning")
-
-def build_model():
-    soma = h.Section(name='soma')
-    dend = h.Section(name='dend')
-    dend.connect(soma(1))
-
-    soma.L = 20; soma.diam = 20
-    dend.L = 500; dend.diam = 2; dend.nseg = 51 
-
-    for sec in h.allsec():
-        sec.Ra = 150   
-        sec.cm = 1     
-
-    soma.insert('hh')
-    soma.gnabar_hh = 0.3
-    soma.gkbar_hh = 0.036
-    soma.gl_hh = 0.0003
-    soma.el_hh = -54.3
-
-    dend.insert('hh')
-    dend.gnabar_hh = 0.052   
-    dend.gkbar_hh = 0.005
-    dend.gl_hh = 0.0003
-    dend.el_hh = -54.3
-
-    dend.insert('ca_hva')
-    dend.insert('cad')
-    
-    for seg in dend:
-        seg.tau_cad = 50
-        if seg.x > 0.5:
-            seg.gbar_ca_hva = 0.01
-        else:
-            seg.gbar_ca_hva = 0
-            
-    return soma, dend
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from core.cell_array import simulate_delay_line
+from core.warmstart import warm_run
+from core.decision import DecisionRun, last_event_time
+from core.model import build_model
+from core.plotting import plt
+from core.recording import Tracker
+from core.rig import SynapseRig
+from core.trial_memo import TrialMemo
+from neuron import h
+
 
 def setup_synapses(dend, direction, dt_stim, syn_weight):
 
@@ -88,20 +58,27 @@ def setup_synapses_weighted(dend, direction, dt_stim, weights):
     return syns, netstims, ncs
 
 # 1
-def run_speed_tuning(soma, dend):
+def run_speed_tuning(soma, dend, batched=True, workers=1):
     dt_list = [1, 2, 3, 4, 5, 6, 8, 10]
     spike_counts = []
     
-    for dt in dt_list:
-        syns, nss, ncs = setup_synapses(dend, 'preferred', dt, syn_weight=0.0014)
-        
+    if batched:
+        # 每个 dt 一个细胞, 一次 h.run(); workers > 1 时分给进程池
+        _, spikes = simulate_delay_line([0.0014] * len(dt_list), 'preferred', dt_stim=dt_list,
+                                        workers=workers)
+        spike_counts = list(spikes)
+    else:
+        # 一套突触 + 一个 APCount, 每个 dt 只改刺激时间
+        rig = SynapseRig(dend, weights=0.0014)
         ap_count = h.APCount(soma(0.5))
         ap_count.thresh = 0
-        
-        h.t = 0; h.v_init = -70; h.celsius = 30; h.tstop = 100
-        h.run()
-        
-        spike_counts.append(ap_count.n)
+        for dt in dt_list:
+            rig.set_direction('preferred', dt)
+            
+            h.t = 0; h.v_init = -70; h.celsius = 30; h.tstop = 100
+            h.run()
+            
+            spike_counts.append(ap_count.n)
         
     plt.figure(figsize=(8, 5))
     plt.plot(dt_list, spike_counts, 'o-', linewidth=2, color='navy')
@@ -181,48 +158,85 @@ def run_mechanism_proof(soma, dend):
     plt.tight_layout()
     plt.savefig('exp3_mechanism_proof.png')
 
-# 4  4 4
-def run_plasticity_experiment(soma, dend):
+# 4 的参数
+PLASTICITY = {'initial_w': 0.0012, 'ca_threshold': 0.107, 'max_weight': 0.00135, 'min_weight': 0.00110,
+              'learning_rate_ltp': 0.00005, 'learning_rate_ltd': 0.00005, 'num_trials': 120}
 
-    initial_w = 0.0012
-    ca_threshold = 0.107 
-    max_weight = 0.00135
-    min_weight = 0.00110
-    
-    # training
-    learning_rate_ltp = 0.00005
-    learning_rate_ltd = 0.00005
-    
-    num_trials = 120 
-    current_weights = [initial_w] * 5 
+def plasticity_trial_runner(dend, warm=True, decision=False, ca_threshold=PLASTICITY['ca_threshold']):
+    # 返回 run_trial(weights, direction) -> 有没有钙峰; 突触 / 判决 / Tracker 只建一次
+    rig = SynapseRig(dend)
+    decider = DecisionRun(dend(1.0), ca_threshold) if decision else None
+    ca_tracker = None if decision else Tracker(dend(1.0), 'cai')
+
+    def run_trial(weights, direction):
+        rig.set(direction, 3, weights)
+        h.t = 0; h.v_init = -70; h.celsius = 30; h.tstop = 100
+        # 第一个突触事件在 20 ms, 之前的状态每个 trial 都一样; CVODE 打开时不用快照
+        t_start = 20 if warm and not h.CVode().active() else None
+        if decision:
+            is_calcium_spike, _ = decider.run(last_event_time(rig.netstims, rig.ncs), t_start=t_start)
+            return bool(is_calcium_spike)
+        if t_start is not None:
+            warm_run(t_start, h.tstop)
+        else:
+            h.run()
+        return bool(ca_tracker.max > ca_threshold)
+
+    run_trial.decider = decider
+    return run_trial
+
+def decision_summary(decider, memo=None):
+    # 开了 memo 时 decider 只看到真正仿真了的 trial, 命中 memo 的 trial 不花仿真时间, 按所有 trial 再平均一次
+    line = f"decision mode: mean simulated time {decider.mean_time():.1f} / {h.tstop:.0f} ms"
+    if memo is not None:
+        s = memo.stats
+        total = s['hit'] + s['simulated']
+        line += (f" over {s['simulated']} simulated trials, "
+                 f"{decider.total_time / max(total, 1):.1f} ms per trial over all {total} ({s['hit']} memo hits)")
+    return line
+
+def plasticity_dynamics(run_trial, rng=random, p=PLASTICITY):
+    # 权重的学习过程; run_trial 可以是 TrialMemo (core/trial_memo.py)
+    current_weights = [p['initial_w']] * 5
     weight_history = {i: [] for i in range(5)}
-    
     ltp_c = 0
     ltd_c = 0
-
-    for trial in range(num_trials):
-        direction = random.choice(['preferred', 'null'])
-        
-        syns, nss, ncs = setup_synapses_weighted(dend, direction, dt_stim=3, weights=current_weights)
-        ca_rec = h.Vector().record(dend(1.0)._ref_cai)
-        h.t = 0; h.v_init = -70; h.celsius = 30; h.tstop = 100
-        h.run()
-        
-        max_ca = np.array(ca_rec).max()
-        is_calcium_spike = (max_ca > ca_threshold)
+    for trial in range(p['num_trials']):
+        direction = rng.choice(['preferred', 'null'])
+        is_calcium_spike = run_trial(current_weights, direction)
 
         if is_calcium_spike: ltp_c += 1
         else: ltd_c += 1
-        
+
         for i in range(5):
             if is_calcium_spike:
-                current_weights[i] += learning_rate_ltp
+                current_weights[i] += p['learning_rate_ltp']
             else:
-                current_weights[i] -= learning_rate_ltd
+                current_weights[i] -= p['learning_rate_ltd']
 
-            current_weights[i] = max(min_weight, min(current_weights[i], max_weight))
+            current_weights[i] = max(p['min_weight'], min(current_weights[i], p['max_weight']))
             weight_history[i].append(current_weights[i])
-        del syns, nss, ncs
+    return weight_history, ltp_c, ltd_c
+
+# 4  4 4
+# memo: 结果按 (权重状态, 方向) 缓存, 权重只在有限个格点上, 120 个 trial 只仿真见过的状态
+def run_plasticity_experiment(soma, dend, warm=True, decision=False, memo=False):
+
+    initial_w = PLASTICITY['initial_w']
+    max_weight = PLASTICITY['max_weight']
+    min_weight = PLASTICITY['min_weight']
+
+    run_trial = plasticity_trial_runner(dend, warm, decision)
+    decider = run_trial.decider
+    if memo:
+        run_trial = TrialMemo(run_trial)
+    weight_history, ltp_c, ltd_c = plasticity_dynamics(run_trial)
+    if memo:
+        print(f"memo: {run_trial.summary()}")
+
+    if decision:
+        print(decision_summary(decider, run_trial if memo else None))
+        decider.close()
 
     plt.figure(figsize=(10, 6))
     colors = ['r', 'g', 'b', 'orange', 'purple']
@@ -241,7 +255,29 @@ def run_plasticity_experiment(soma, dend):
     plt.tight_layout()
     plt.savefig('exp4_learning_evolution.png')
     
-def setup_inhibition(dend, pos=0.1, g_max=0.0):
+# 同样的学习过程跑很多个 seed (只看结果, 不画图); 所有 seed 共用一个 memo,
+# 仿真次数只取决于见过多少个 (权重状态, 方向), 和 seed 数无关
+def run_plasticity_seeds(dend, seeds=10000, warm=True, decision=False, memo=True):
+    run_trial = plasticity_trial_runner(dend, warm, decision)
+    decider = run_trial.decider
+    if memo:
+        run_trial = TrialMemo(run_trial)
+    final_w = np.empty(seeds)
+    ltp = np.empty(seeds, dtype=int)
+    for seed in range(seeds):
+        weight_history, ltp[seed], _ = plasticity_dynamics(run_trial, random.Random(seed))
+        final_w[seed] = weight_history[0][-1]
+    print(f"{seeds} seeds x {PLASTICITY['num_trials']} trials: LTP fraction {ltp.mean() / PLASTICITY['num_trials']:.3f}, "
+          f"final weight {final_w.mean():.6f} +- {final_w.std():.6f}")
+    if memo:
+        print(f"memo: {run_trial.summary()}")
+    if decision:
+        print(decision_summary(decider, run_trial if memo else None))
+        decider.close()
+    return final_w, ltp
+
+def setup_inhibition(dend, pos=0.1, g_max=0.0, seed=None):
+    # seed: Random123 流编号, 和 CellArray.add_inhibition 的一样; None 时用 NetStim 共用的默认随机流
 
     inh_syn = h.Exp2Syn(dend(pos))
     inh_syn.tau1 = 0.5
@@ -253,14 +289,35 @@ def setup_inhibition(dend, pos=0.1, g_max=0.0):
     stim.interval = 5
     stim.start = 0
     stim.noise = 1
+    if seed is not None:
+        stim.noiseFromRandom123(seed, 0, 0)
     
     nc = h.NetCon(stim, inh_syn)
     nc.weight[0] = g_max 
     
     return inh_syn, stim, nc
 
+# first_point: 第一个 reward 的点编号; 每个点的抑制用编号对应的 Random123 流, 和批量版本的结果一样
+def run_risk_level_serial(dend, risk_g, reward_levels, first_point=0):
+    ca_peaks = []
+    inh, stim, nc = setup_inhibition(dend, pos=0.1, g_max=risk_g, seed=first_point)
+    ca_tracker = Tracker(dend(1.0), 'cai')
+    
+    for j, w in enumerate(reward_levels):
+        stim.noiseFromRandom123(first_point + j, 0, 0)
+        syns, nss, ncs = setup_synapses_weighted(dend, 'preferred', dt_stim=3, weights=[w]*5)
+        
+        h.t = 0; h.v_init = -70; h.celsius = 30; h.tstop = 100
+        h.run()
+        
+        ca_peaks.append(ca_tracker.max)
+        del syns, nss, ncs
+
+    del inh, stim, nc
+    return ca_peaks
+
 # 5
-def run_risk_aversion_experiment(dend, soma):
+def run_risk_aversion_experiment(dend, soma, batched=True, workers=1):
 
     reward_levels = np.linspace(0.0005, 0.0030, 20) 
     risk_levels = [0, 0.002] 
@@ -271,26 +328,23 @@ def run_risk_aversion_experiment(dend, soma):
     colors = ['green', 'red']
     labels = ['Safe Context (Low Risk)', 'Dangerous Context (High Risk)']
 
+    if batched:
+        # risk x reward 每个点一个细胞, 各自的抑制输入用自己的随机流, 结果和 workers 无关
+        n_reward = len(reward_levels)
+        ca_peak, _ = simulate_delay_line(np.tile(reward_levels, len(risk_levels)), 'preferred',
+                                         inhibition=np.repeat(risk_levels, n_reward),
+                                         warm=False, workers=workers)
+        ca_all = ca_peak.reshape(len(risk_levels), n_reward)
+
     for i, risk_g in enumerate(risk_levels):
-        ca_peaks = []
-        inh, stim, nc = setup_inhibition(dend, pos=0.1, g_max=risk_g)
-        
-        for w in reward_levels:
-            syns, nss, ncs = setup_synapses_weighted(dend, 'preferred', dt_stim=3, weights=[w]*5)
-            
-            ca_rec = h.Vector().record(dend(1.0)._ref_cai)
-            
-            h.t = 0; h.v_init = -70; h.celsius = 30; h.tstop = 100
-            h.run()
-            
-            ca_peaks.append(np.array(ca_rec).max())
-            del syns, nss, ncs
+        if batched:
+            ca_peaks = list(ca_all[i])
+        else:
+            ca_peaks = run_risk_level_serial(dend, risk_g, reward_levels, first_point=i * len(reward_levels))
         
         results[labels[i]] = ca_peaks
         plt.plot(reward_levels, ca_peaks, 'o-', color=colors[i], label=labels[i], linewidth=2)
 
-        del inh, stim, nc
-
     plt.axhline(y=0.22, color='k', linestyle=':', label='Decision Threshold (Ca Spike)')
     
     plt.title('Neuronal Utility Function: Impact of Risk (Shunting Inhibition)')
@@ -304,12 +358,23 @@ def run_risk_aversion_experiment(dend, soma):
     plt.savefig('exp5_risk_aversion.png')
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    # 只跑实验 4 的多 seed 版本, 例如 --plasticity-seeds 10000
+    parser.add_argument('--plasticity-seeds', type=int, default=None)
+    parser.add_argument('--no-memo', action='store_true')
+    args = parser.parse_args()
+
     my_soma, my_dend = build_model()
 
+    if args.plasticity_seeds is not None:
+        run_plasticity_seeds(my_dend, args.plasticity_seeds, memo=not args.no_memo)
+        sys.exit()
+
     run_speed_tuning(my_soma, my_dend)
     run_direction_test(my_soma, my_dend)
     run_mechanism_proof(my_soma, my_dend)
-    run_plasticity_experiment(my_soma, my_dend) 
+    run_plasticity_experiment(my_soma, my_dend, memo=not args.no_memo)
     run_risk_aversion_experiment(my_dend, my_soma)
     
     print("Finished")
\ No newline at end of file
@@ -0,0 +1,543 @@
+/* Created by Language version: 7.7.0 */
+/* VECTORIZED */
+#define NRN_VECTORIZED 1
+#include <stdio.h>
+#include <stdlib.h>
+#include <math.h>
+#include "mech_api.h"
+#undef PI
+#define nil 0
+#define _pval pval
+// clang-format off
+#include "md1redef.h"
+#include "section_fwd.hpp"
+#include "nrniv_mf.h"
+#include "md2redef.h"
+#include "nrnconf.h"
+// clang-format on
+#include "neuron/cache/mechanism_range.hpp"
+static constexpr auto number_of_datum_variables = 3;
+static constexpr auto number_of_floating_point_variables = 15;
+namespace {
+template <typename T>
+using _nrn_mechanism_std_vector = std::vector<T>;
+using _nrn_model_sorted_token = neuron::model_sorted_token;
+using _nrn_mechanism_cache_range = neuron::cache::MechanismRange<number_of_floating_point_variables, number_of_datum_variables>;
+using _nrn_mechanism_cache_instance = neuron::cache::MechanismInstance<number_of_floating_point_variables, number_of_datum_variables>;
+using _nrn_non_owning_id_without_container = neuron::container::non_owning_identifier_without_container;
+template <typename T>
+using _nrn_mechanism_field = neuron::mechanism::field<T>;
+template <typename... Args>
+void _nrn_mechanism_register_data_fields(Args&&... args) {
+  neuron::mechanism::register_data_fields(std::forward<Args>(args)...);
+}
+}
+ 
+#if !NRNGPU
+#undef exp
+#define exp hoc_Exp
+#if NRN_ENABLE_ARCH_INDEP_EXP_POW
+#undef pow
+#define pow hoc_pow
+#endif
+#endif
+ 
+#define nrn_init _nrn_init__Tracker
+#define _nrn_initial _nrn_initial__Tracker
+#define nrn_cur _nrn_cur__Tracker
+#define _nrn_current _nrn_current__Tracker
+#define nrn_jacob _nrn_jacob__Tracker
+#define nrn_state _nrn_state__Tracker
+#define _net_receive _net_receive__Tracker 
+#define sample sample__Tracker 
+ 
+#define _threadargscomma_ _ml, _iml, _ppvar, _thread, _globals, _nt,
+#define _threadargsprotocomma_ Memb_list* _ml, size_t _iml, Datum* _ppvar, Datum* _thread, double* _globals, NrnThread* _nt,
+#define _internalthreadargsprotocomma_ _nrn_mechanism_cache_range* _ml, size_t _iml, Datum* _ppvar, Datum* _thread, double* _globals, NrnThread* _nt,
+#define _threadargs_ _ml, _iml, _ppvar, _thread, _globals, _nt
+#define _threadargsproto_ Memb_list* _ml, size_t _iml, Datum* _ppvar, Datum* _thread, double* _globals, NrnThread* _nt
+#define _internalthreadargsproto_ _nrn_mechanism_cache_range* _ml, size_t _iml, Datum* _ppvar, Datum* _thread, double* _globals, NrnThread* _nt
+ 	/*SUPPRESS 761*/
+	/*SUPPRESS 762*/
+	/*SUPPRESS 763*/
+	/*SUPPRESS 765*/
+	 extern double *hoc_getarg(int);
+ 
+#define t _nt->_t
+#define dt _nt->_dt
+#define tbegin _ml->template fpfield<0>(_iml)
+#define tbegin_columnindex 0
+#define tend _ml->template fpfield<1>(_iml)
+#define tend_columnindex 1
+#define thresh _ml->template fpfield<2>(_iml)
+#define thresh_columnindex 2
+#define xmax _ml->template fpfield<3>(_iml)
+#define xmax_columnindex 3
+#define tmax _ml->template fpfield<4>(_iml)
+#define tmax_columnindex 4
+#define xmin _ml->template fpfield<5>(_iml)
+#define xmin_columnindex 5
+#define tmin _ml->template fpfield<6>(_iml)
+#define tmin_columnindex 6
+#define integral _ml->template fpfield<7>(_iml)
+#define integral_columnindex 7
+#define ncross _ml->template fpfield<8>(_iml)
+#define ncross_columnindex 8
+#define nsamples _ml->template fpfield<9>(_iml)
+#define nsamples_columnindex 9
+#define above _ml->template fpfield<10>(_iml)
+#define above_columnindex 10
+#define xlast _ml->template fpfield<11>(_iml)
+#define xlast_columnindex 11
+#define tlast _ml->template fpfield<12>(_iml)
+#define tlast_columnindex 12
+#define v _ml->template fpfield<13>(_iml)
+#define v_columnindex 13
+#define _g _ml->template fpfield<14>(_iml)
+#define _g_columnindex 14
+#define _nd_area *_ml->dptr_field<0>(_iml)
+#define x	*_ppvar[2].get<double*>()
+#define _p_x _ppvar[2].literal_value<void*>()
+ /* Thread safe. No static _ml, _iml or _ppvar. */
+ static int hoc_nrnpointerindex =  2;
+ static _nrn_mechanism_std_vector<Datum> _extcall_thread;
+ /* external NEURON variables */
+ /* declaration of user functions */
+ static double _hoc_sample(void*);
+ static int _mechtype;
+extern void _nrn_cacheloop_reg(int, int);
+extern void hoc_register_limits(int, HocParmLimits*);
+extern void hoc_register_units(int, HocParmUnits*);
+extern void nrn_promote(Prop*, int, int);
+ 
+#define NMODL_TEXT 1
+#if NMODL_TEXT
+static void register_nmodl_text_and_filename(int mechtype);
+#endif
+ extern Prop* nrn_point_prop_;
+ static int _pointtype;
+ static void* _hoc_create_pnt(Object* _ho) { void* create_point_process(int, Object*);
+ return create_point_process(_pointtype, _ho);
+}
+ static void _hoc_destroy_pnt(void*);
+ static double _hoc_loc_pnt(void* _vptr) {double loc_point_process(int, void*);
+ return loc_point_process(_pointtype, _vptr);
+}
+ static double _hoc_has_loc(void* _vptr) {double has_loc_point(void*);
+ return has_loc_point(_vptr);
+}
+ static double _hoc_get_loc_pnt(void* _vptr) {
+ double get_loc_point_process(void*); return (get_loc_point_process(_vptr));
+}
+ static void _hoc_setdata(void*);
+ /* connect user functions to hoc names */
+ static VoidFunc hoc_intfunc[] = {
+ {0, 0}
+};
+ static Member_func _member_func[] = {
+ {"loc", _hoc_loc_pnt},
+ {"has_loc", _hoc_has_loc},
+ {"get_loc", _hoc_get_loc_pnt},
+ {"sample", _hoc_sample},
+ {0, 0}
+};
+ /* declare global and static user variables */
+ #define gind 0
+ #define _gth 0
+ /* some parameters have upper and lower limits */
+ static HocParmLimits _hoc_parm_limits[] = {
+ {0, 0, 0}
+};
+ static HocParmUnits _hoc_parm_units[] = {
+ {"tbegin", "ms"},
+ {"tend", "ms"},
+ {"tmax", "ms"},
+ {"tmin", "ms"},
+ {0, 0}
+};
+ static double delta_t = 0.01;
+ /* connect global user variables to hoc */
+ static DoubScal hoc_scdoub[] = {
+ {0, 0}
+};
+ static DoubVec hoc_vdoub[] = {
+ {0, 0, 0}
+};
+ static double _sav_indep;
+ extern void _nrn_setdata_reg(int, void(*)(Prop*));
+ static void _setdata(Prop* _prop) {
+ }
+ static void _hoc_setdata(void* _vptr) { Prop* _prop;
+ _prop = ((Point_process*)_vptr)->_prop;
+   _setdata(_prop);
+ }
+ static void nrn_alloc(Prop*);
+static void nrn_init(_nrn_model_sorted_token const&, NrnThread*, Memb_list*, int);
+static void nrn_state(_nrn_model_sorted_token const&, NrnThread*, Memb_list*, int);
+ static void nrn_cur(_nrn_model_sorted_token const&, NrnThread*, Memb_list*, int);
+static void nrn_jacob(_nrn_model_sorted_token const&, NrnThread*, Memb_list*, int);
+ static void _hoc_destroy_pnt(void* _vptr) {
+   destroy_point_process(_vptr);
+}
+ /* connect range variables in _p that hoc is supposed to know about */
+ static const char *_mechanism[] = {
+ "7.7.0",
+"Tracker",
+ "tbegin",
+ "tend",
+ "thresh",
+ 0,
+ "xmax",
+ "tmax",
+ "xmin",
+ "tmin",
+ "integral",
+ "ncross",
+ "nsamples",
+ 0,
+ 0,
+ "x",
+ 0};
+ 
+ /* Used by NrnProperty */
+ static _nrn_mechanism_std_vector<double> _parm_default{
+     0, /* tbegin */
+     1e+09, /* tend */
+     0, /* thresh */
+ }; 
+ 
+ 
+extern Prop* need_memb(Symbol*);
+static void nrn_alloc(Prop* _prop) {
+  Prop *prop_ion{};
+  Datum *_ppvar{};
+  if (nrn_point_prop_) {
+    _nrn_mechanism_access_alloc_seq(_prop) = _nrn_mechanism_access_alloc_seq(nrn_point_prop_);
+    _ppvar = _nrn_mechanism_access_dparam(nrn_point_prop_);
+  } else {
+   _ppvar = nrn_prop_datum_alloc(_mechtype, 3, _prop);
+    _nrn_mechanism_access_dparam(_prop) = _ppvar;
+     _nrn_mechanism_cache_instance _ml_real{_prop};
+    auto* const _ml = &_ml_real;
+    size_t const _iml{};
+    assert(_nrn_mechanism_get_num_vars(_prop) == 15);
+ 	/*initialize range parameters*/
+ 	tbegin = _parm_default[0]; /* 0 */
+ 	tend = _parm_default[1]; /* 1e+09 */
+ 	thresh = _parm_default[2]; /* 0 */
+  }
+ 	 assert(_nrn_mechanism_get_num_vars(_prop) == 15);
+ 	_nrn_mechanism_access_dparam(_prop) = _ppvar;
+ 	/*connect ionic variables to this model*/
+ 
+}
+ static void _initlists();
+ extern Symbol* hoc_lookup(const char*);
+extern void _nrn_thread_reg(int, int, void(*)(Datum*));
+void _nrn_thread_table_reg(int, nrn_thread_table_check_t);
+extern void hoc_register_tolerance(int, HocStateTolerance*, Symbol***);
+extern void _cvode_abstol( Symbol**, double*, int);
+
+ extern "C" void _tracker_reg() {
+	int _vectorized = 1;
+  _initlists();
+ 	_pointtype = point_register_mech(_mechanism,
+	 nrn_alloc,nrn_cur, nrn_jacob, nrn_state, nrn_init,
+	 hoc_nrnpointerindex, 1,
+	 _hoc_create_pnt, _hoc_destroy_pnt, _member_func);
+ _mechtype = nrn_get_mechtype(_mechanism[1]);
+ hoc_register_parm_default(_mechtype, &_parm_default);
+     _nrn_setdata_reg(_mechtype, _setdata);
+ #if NMODL_TEXT
+  register_nmodl_text_and_filename(_mechtype);
+#endif
+   _nrn_mechanism_register_data_fields(_mechtype,
+                                       _nrn_mechanism_field<double>{"tbegin"} /* 0 */,
+                                       _nrn_mechanism_field<double>{"tend"} /* 1 */,
+                                       _nrn_mechanism_field<double>{"thresh"} /* 2 */,
+                                       _nrn_mechanism_field<double>{"xmax"} /* 3 */,
+                                       _nrn_mechanism_field<double>{"tmax"} /* 4 */,
+                                       _nrn_mechanism_field<double>{"xmin"} /* 5 */,
+                                       _nrn_mechanism_field<double>{"tmin"} /* 6 */,
+                                       _nrn_mechanism_field<double>{"integral"} /* 7 */,
+                                       _nrn_mechanism_field<double>{"ncross"} /* 8 */,
+                                       _nrn_mechanism_field<double>{"nsamples"} /* 9 */,
+                                       _nrn_mechanism_field<double>{"above"} /* 10 */,
+                                       _nrn_mechanism_field<double>{"xlast"} /* 11 */,
+                                       _nrn_mechanism_field<double>{"tlast"} /* 12 */,
+                                       _nrn_mechanism_field<double>{"v"} /* 13 */,
+                                       _nrn_mechanism_field<double>{"_g"} /* 14 */,
+                                       _nrn_mechanism_field<double*>{"_nd_area", "area"} /* 0 */,
+                                       _nrn_mechanism_field<Point_process*>{"_pntproc", "pntproc"} /* 1 */,
+                                       _nrn_mechanism_field<double*>{"x", "pointer"} /* 2 */);
+  hoc_register_prop_size(_mechtype, 15, 3);
+  hoc_register_dparam_semantics(_mechtype, 0, "area");
+  hoc_register_dparam_semantics(_mechtype, 1, "pntproc");
+  hoc_register_dparam_semantics(_mechtype, 2, "pointer");
+ 
+    hoc_register_var(hoc_scdoub, hoc_vdoub, hoc_intfunc);
+ 	ivoc_help("help ?1 Tracker /root/package/tracker.mod\n");
+ hoc_register_limits(_mechtype, _hoc_parm_limits);
+ hoc_register_units(_mechtype, _hoc_parm_units);
+ }
+static int _reset;
+static const char *modelname = "Online reducers over a pointed-to variable";
+
+static int error;
+static int _ninits = 0;
+static int _match_recurse=1;
+static void _modl_cleanup(){ _match_recurse=1;}
+static int sample(_internalthreadargsproto_);
+ 
+static int  sample ( _internalthreadargsproto_ ) {
+   if ( t >= tbegin - dt / 2.0  && t < tend - dt / 2.0 ) {
+     if ( x > xmax ) {
+       xmax = x ;
+       tmax = t ;
+       }
+     if ( x < xmin ) {
+       xmin = x ;
+       tmin = t ;
+       }
+     if ( nsamples > 0.0 ) {
+       integral = integral + ( x + xlast ) * ( t - tlast ) / 2.0 ;
+       }
+     if ( x >= thresh ) {
+       if ( above  == 0.0 ) {
+         ncross = ncross + 1.0 ;
+         }
+       above = 1.0 ;
+       }
+     else {
+       above = 0.0 ;
+       }
+     xlast = x ;
+     tlast = t ;
+     nsamples = nsamples + 1.0 ;
+     }
+    return 0; }
+ 
+static double _hoc_sample(void* _vptr) {
+ double _r;
+ Datum* _ppvar; Datum* _thread; NrnThread* _nt;
+   auto* const _pnt = static_cast<Point_process*>(_vptr);
+  auto* const _p = _pnt->_prop;
+  if (!_p) {
+    hoc_execerror("POINT_PROCESS data instance not valid", NULL);
+  }
+   _nrn_mechanism_cache_instance _ml_real{_p};
+  auto* const _ml = &_ml_real;
+  size_t const _iml{};
+  _ppvar = _nrn_mechanism_access_dparam(_p);
+  _thread = _extcall_thread.data();
+  double* _globals = nullptr;
+  if (gind != 0 && _thread != nullptr) { _globals = _thread[_gth].get<double*>(); }
+  _nt = static_cast<NrnThread*>(_pnt->_vnt);
+ _r = 1.;
+ sample ( _threadargs_ );
+ return(_r);
+}
+
+static void initmodel(_internalthreadargsproto_) {
+  int _i; double _save;{
+ {
+   xmax = - 1e300 ;
+   tmax = - 1.0 ;
+   xmin = 1e300 ;
+   tmin = - 1.0 ;
+   integral = 0.0 ;
+   ncross = 0.0 ;
+   nsamples = 0.0 ;
+   above = 0.0 ;
+   sample ( _threadargs_ ) ;
+   }
+ 
+}
+}
+
+static void nrn_init(_nrn_model_sorted_token const& _sorted_token, NrnThread* _nt, Memb_list* _ml_arg, int _type){
+_nrn_mechanism_cache_range _lmr{_sorted_token, *_nt, *_ml_arg, _type};
+auto* const _vec_v = _nt->node_voltage_storage();
+auto* const _ml = &_lmr;
+Datum* _ppvar; Datum* _thread;
+Node *_nd; double _v; int* _ni; int _iml, _cntml;
+_ni = _ml_arg->_nodeindices;
+_cntml = _ml_arg->_nodecount;
+_thread = _ml_arg->_thread;
+double* _globals = nullptr;
+if (gind != 0 && _thread != nullptr) { _globals = _thread[_gth].get<double*>(); }
+for (_iml = 0; _iml < _cntml; ++_iml) {
+ _ppvar = _ml_arg->_pdata[_iml];
+   _v = _vec_v[_ni[_iml]];
+ v = _v;
+ initmodel(_threadargs_);
+}
+}
+
+static double _nrn_current(_internalthreadargsprotocomma_ double _v) {
+double _current=0.; v=_v;
+{
+} return _current;
+}
+
+static void nrn_cur(_nrn_model_sorted_token const& _sorted_token, NrnThread* _nt, Memb_list* _ml_arg, int _type) {
+_nrn_mechanism_cache_range _lmr{_sorted_token, *_nt, *_ml_arg, _type};
+auto const _vec_rhs = _nt->node_rhs_storage();
+auto const _vec_sav_rhs = _nt->node_sav_rhs_storage();
+auto const _vec_v = _nt->node_voltage_storage();
+auto* const _ml = &_lmr;
+Datum* _ppvar; Datum* _thread;
+Node *_nd; int* _ni; double _rhs, _v; int _iml, _cntml;
+_ni = _ml_arg->_nodeindices;
+_cntml = _ml_arg->_nodecount;
+_thread = _ml_arg->_thread;
+double* _globals = nullptr;
+if (gind != 0 && _thread != nullptr) { _globals = _thread[_gth].get<double*>(); }
+for (_iml = 0; _iml < _cntml; ++_iml) {
+ _ppvar = _ml_arg->_pdata[_iml];
+   _v = _vec_v[_ni[_iml]];
+ 
+}
+ 
+}
+
+static void nrn_jacob(_nrn_model_sorted_token const& _sorted_token, NrnThread* _nt, Memb_list* _ml_arg, int _type) {
+_nrn_mechanism_cache_range _lmr{_sorted_token, *_nt, *_ml_arg, _type};
+auto const _vec_d = _nt->node_d_storage();
+auto const _vec_sav_d = _nt->node_sav_d_storage();
+auto* const _ml = &_lmr;
+Datum* _ppvar; Datum* _thread;
+Node *_nd; int* _ni; int _iml, _cntml;
+_ni = _ml_arg->_nodeindices;
+_cntml = _ml_arg->_nodecount;
+_thread = _ml_arg->_thread;
+double* _globals = nullptr;
+if (gind != 0 && _thread != nullptr) { _globals = _thread[_gth].get<double*>(); }
+for (_iml = 0; _iml < _cntml; ++_iml) {
+  _vec_d[_ni[_iml]] += _g;
+ 
+}
+ 
+}
+
+static void nrn_state(_nrn_model_sorted_token const& _sorted_token, NrnThread* _nt, Memb_list* _ml_arg, int _type) {
+_nrn_mechanism_cache_range _lmr{_sorted_token, *_nt, *_ml_arg, _type};
+auto* const _vec_v = _nt->node_voltage_storage();
+auto* const _ml = &_lmr;
+Datum* _ppvar; Datum* _thread;
+Node *_nd; double _v = 0.0; int* _ni;
+_ni = _ml_arg->_nodeindices;
+size_t _cntml = _ml_arg->_nodecount;
+_thread = _ml_arg->_thread;
+double* _globals = nullptr;
+if (gind != 0 && _thread != nullptr) { _globals = _thread[_gth].get<double*>(); }
+for (size_t _iml = 0; _iml < _cntml; ++_iml) {
+ _ppvar = _ml_arg->_pdata[_iml];
+ _nd = _ml_arg->_nodelist[_iml];
+   _v = _vec_v[_ni[_iml]];
+ v=_v;
+{
+ {  { sample(_threadargs_); }
+  } {
+   }
+}}
+
+}
+
+static void terminal(){}
+
+static void _initlists(){
+ int _i; static int _first = 1;
+  if (!_first) return;
+_first = 0;
+}
+
+#if NMODL_TEXT
+static void register_nmodl_text_and_filename(int mech_type) {
+    const char* nmodl_filename = "/root/package/tracker.mod";
+    const char* nmodl_file_text = 
+  "\n"
+  "TITLE Online reducers over a pointed-to variable\n"
+  "\n"
+  "NEURON {\n"
+  "    THREADSAFE\n"
+  "    POINT_PROCESS Tracker\n"
+  "    POINTER x\n"
+  "    RANGE tbegin, tend, thresh\n"
+  "    RANGE xmax, tmax, xmin, tmin, integral, ncross, nsamples\n"
+  "}\n"
+  "\n"
+  "UNITS {\n"
+  "    (mV) = (millivolt)\n"
+  "}\n"
+  "\n"
+  "PARAMETER {\n"
+  "    tbegin = 0 (ms)\n"
+  "    tend = 1e9 (ms)\n"
+  "    thresh = 0\n"
+  "}\n"
+  "\n"
+  "ASSIGNED {\n"
+  "    x\n"
+  "    dt (ms)\n"
+  "    xmax\n"
+  "    tmax (ms)\n"
+  "    xmin\n"
+  "    tmin (ms)\n"
+  "    integral\n"
+  "    ncross\n"
+  "    nsamples\n"
+  "    above\n"
+  "    xlast\n"
+  "    tlast (ms)\n"
+  "}\n"
+  "\n"
+  "INITIAL {\n"
+  "    xmax = -1e300\n"
+  "    tmax = -1\n"
+  "    xmin = 1e300\n"
+  "    tmin = -1\n"
+  "    integral = 0\n"
+  "    ncross = 0\n"
+  "    nsamples = 0\n"
+  "    above = 0\n"
+  "    sample()\n"
+  "}\n"
+  "\n"
+  "BREAKPOINT {\n"
+  "    SOLVE sample METHOD after_cvode\n"
+  "}\n"
+  "\n"
+  "PROCEDURE sample() {\n"
+  "    : same half-open window as slicing a recorded trace by round(t/dt)\n"
+  "    if (t >= tbegin - dt/2 && t < tend - dt/2) {\n"
+  "        if (x > xmax) {\n"
+  "            xmax = x\n"
+  "            tmax = t\n"
+  "        }\n"
+  "        if (x < xmin) {\n"
+  "            xmin = x\n"
+  "            tmin = t\n"
+  "        }\n"
+  "        if (nsamples > 0) {\n"
+  "            integral = integral + (x + xlast) * (t - tlast) / 2\n"
+  "        }\n"
+  "        : upward crossings, counted like APCount\n"
+  "        if (x >= thresh) {\n"
+  "            if (above == 0) {\n"
+  "                ncross = ncross + 1\n"
+  "            }\n"
+  "            above = 1\n"
+  "        } else {\n"
+  "            above = 0\n"
+  "        }\n"
+  "        xlast = x\n"
+  "        tlast = t\n"
+  "        nsamples = nsamples + 1\n"
+  "    }\n"
+  "}\n"
+  ;
+    hoc_reg_nmodl_filename(mech_type, nmodl_filename);
+    hoc_reg_nmodl_text(mech_type, nmodl_file_text);
+}
+#endif